@@ -0,0 +1,63 @@
+import random
+import string
+import sys
+import time
+
+import fooster.web.json
+
+
+def make_payloads(rows):
+    rand = random.Random(0)
+
+    def word(length):
+        return ''.join(rand.choice(string.ascii_letters) for _ in range(length))
+
+    # an api-like object, an export-like array of rows, and a deeply nested tree
+    small = {'id': 1234, 'name': word(12), 'tags': [word(6) for _ in range(4)], 'active': True, 'score': 0.5}
+    export = [{'id': idx, 'name': word(16), 'email': word(8) + '@example.com', 'balance': rand.random() * 1000, 'flags': [rand.random() < 0.5 for _ in range(4)]} for idx in range(rows)]
+    nested = {'root': {}}
+
+    node = nested['root']
+    for _ in range(64):
+        node['values'] = list(range(16))
+        node['child'] = {}
+        node = node['child']
+
+    return {'small': small, 'export': export, 'nested': nested}
+
+
+def measure(func, arg, size):
+    # repeat until a run takes long enough to time reliably
+    count = 1
+    while True:
+        start = time.perf_counter()
+        for _ in range(count):
+            func(arg)
+        elapsed = time.perf_counter() - start
+
+        if elapsed >= 0.2:
+            return size * count / elapsed / 1048576
+
+        count *= 2
+
+
+def run(rows):
+    payloads = make_payloads(rows)
+
+    for name in sorted(fooster.web.json.codecs):
+        codec = fooster.web.json.get_codec(name)
+
+        for payload_name, payload in payloads.items():
+            encoded = codec.dumps(payload)
+
+            encode = measure(codec.dumps, payload, len(encoded))
+            decode = measure(codec.loads, encoded, len(encoded))
+
+            print('{:>8} {:>8} {:>10} B: encode {:8.1f} MB/s, decode {:8.1f} MB/s'.format(name, payload_name, len(encoded), encode, decode))
+
+
+if __name__ == '__main__':
+    counts = [int(arg) for arg in sys.argv[1:]] or [10000]
+
+    for count in counts:
+        run(count)
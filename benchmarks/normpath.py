@@ -0,0 +1,99 @@
+import collections
+import random
+import timeit
+import urllib.parse
+
+from fooster.web import file
+
+
+def normpath_deque(path):
+    # previous implementation kept for comparison
+    if not path:
+        return ''
+
+    old_path = path.split('/')
+    new_path = collections.deque()
+
+    for entry in old_path:
+        if not entry:
+            continue
+        elif entry == '.':
+            continue
+        elif entry == '..':
+            if len(new_path) > 0:
+                new_path.pop()
+        else:
+            new_path.append(entry)
+
+    if old_path[0] == '':
+        new_path.appendleft('')
+
+    if old_path[-1] == '':
+        new_path.append('')
+
+    norm = '/'.join(new_path)
+    if not norm:
+        norm = '/'
+
+    return norm
+
+
+def corpus(size=10000, working_set=2000, seed=0):
+    rand = random.Random(seed)
+
+    dirs = ['static', 'assets', 'css', 'js', 'img', 'fonts', 'docs', 'api', 'v1', 'users', 'releases', 'build-' + str(rand.randrange(1000))]
+    names = ['index.html', 'app.js', 'style.css', 'logo.png', 'favicon.ico', 'robots.txt', 'main.0123abcd.js', 'café menu.pdf', 'report (final).txt']
+
+    urls = []
+    for _ in range(working_set):
+        path = '/' + '/'.join(rand.choice(dirs) for _ in range(rand.randrange(0, 5)))
+        path = path.rstrip('/') + '/' + rand.choice(names + [''])
+
+        # a few crawler and scanner style abnormal paths
+        roll = rand.random()
+        if roll < 0.03:
+            path = path.replace('/', '//', 1)
+        elif roll < 0.06:
+            path = '/' + rand.choice(dirs) + '/..' + path
+        elif roll < 0.08:
+            path = path + '/.'
+
+        urls.append(urllib.parse.quote(path))
+
+    # crawler traffic revisits a bounded working set with a skew towards popular urls
+    return [urls[int(working_set * rand.random() ** 3)] for _ in range(size)]
+
+
+def run(number=20):
+    urls = corpus()
+    paths = [urllib.parse.unquote(url) for url in urls]
+
+    def deque_only():
+        for path in paths:
+            normpath_deque(path)
+
+    def fast_only():
+        for path in paths:
+            file.normpath(path)
+
+    def deque_unquote():
+        for url in urls:
+            normpath_deque(urllib.parse.unquote(url))
+
+    def fast_unquote():
+        for url in urls:
+            file.normpath(urllib.parse.unquote(url))
+
+    def cached():
+        for url in urls:
+            file.resolve(url)
+
+    for name, func in [('deque normpath', deque_only), ('fast normpath', fast_only), ('deque normpath + unquote', deque_unquote), ('fast normpath + unquote', fast_unquote), ('resolve (lru cached)', cached)]:
+        elapsed = min(timeit.repeat(func, number=number, repeat=3)) / number
+        print('{:<28} {:>8.2f} us/url'.format(name, elapsed / len(urls) * 1e6))
+
+    print(file.resolve.cache_info())
+
+
+if __name__ == '__main__':
+    run()
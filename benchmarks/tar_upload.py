@@ -0,0 +1,95 @@
+import http.client
+import io
+import logging
+import os
+import sys
+import tarfile
+import tempfile
+import time
+
+from fooster import web
+import fooster.web.file
+
+
+def make_files(count, size):
+    # a deploy-like tree of small files spread over a few directories
+    return {'dir{}/file{}.txt'.format(idx % 16, idx): os.urandom(size) for idx in range(count)}
+
+
+def make_tar(files, compression=''):
+    archive_bytes = io.BytesIO()
+
+    with tarfile.open(fileobj=archive_bytes, mode='w:' + compression) as archive:
+        for name, contents in files.items():
+            info = tarfile.TarInfo(name)
+            info.size = len(contents)
+            info.mode = 0o644
+            archive.addfile(info, io.BytesIO(contents))
+
+    return archive_bytes.getvalue()
+
+
+def put_files(port, files):
+    conn = http.client.HTTPConnection('localhost', port)
+
+    for name, contents in files.items():
+        conn.request('PUT', '/files/' + name, contents)
+        response = conn.getresponse()
+        response.read()
+
+        assert response.status == 204
+
+    conn.close()
+
+
+def put_tar(port, tar):
+    conn = http.client.HTTPConnection('localhost', port)
+
+    conn.request('PUT', '/tar/', tar, headers={'Content-Type': 'application/x-tar'})
+    response = conn.getresponse()
+    response.read()
+
+    assert response.status == 204
+
+    conn.close()
+
+
+def run(count, size):
+    files = make_files(count, size)
+    tar = make_tar(files)
+    tar_gz = make_tar(files, 'gz')
+
+    with tempfile.TemporaryDirectory() as tmp:
+        # keep the access log out of the results
+        http_log = logging.getLogger('benchmark')
+        http_log.addHandler(logging.NullHandler())
+        http_log.propagate = False
+
+        httpd = web.HTTPServer(('localhost', 0), fooster.web.file.new(tmp, modify=True), num_processes=1, max_processes=1, http_log=http_log)
+        httpd.start()
+
+        try:
+            port = httpd.address[1]
+
+            start = time.perf_counter()
+            put_files(port, files)
+            per_file = time.perf_counter() - start
+
+            start = time.perf_counter()
+            put_tar(port, tar)
+            bulk = time.perf_counter() - start
+
+            start = time.perf_counter()
+            put_tar(port, tar_gz)
+            bulk_gz = time.perf_counter() - start
+        finally:
+            httpd.close()
+
+    print('{:>6} files of {:>6} B: per-file PUT {:8.3f} s, tar PUT {:8.3f} s ({:5.1f}x), tar.gz PUT {:8.3f} s ({:5.1f}x)'.format(count, size, per_file, bulk, per_file / bulk, bulk_gz, per_file / bulk_gz))
+
+
+if __name__ == '__main__':
+    counts = [int(arg) for arg in sys.argv[1:]] or [100, 1000, 5000]
+
+    for count in counts:
+        run(count, 4096)
@@ -14,7 +14,7 @@ from .web import status_messages
 from .web import mktime, mklog
 
 # classes
-from .web import HTTPServer, HTTPHandler, HTTPErrorHandler, HTTPHandlerWrapper, HTTPError, HTTPHeaders, HTTPLogFormatter, HTTPLogFilter
+from .web import HTTPServer, HTTPHandler, HTTPErrorHandler, HTTPHandlerWrapper, HTTPError, HTTPHeaders, IterIO, HTTPLogFormatter, HTTPLogFilter
 
 # export everything
-__all__ = ['server_version', 'http_version', 'http_encoding', 'default_encoding', 'start_method', 'max_line_size', 'max_headers', 'max_request_size', 'stream_chunk_size', 'status_messages', 'mktime', 'mklog', 'HTTPServer', 'HTTPHandler', 'HTTPErrorHandler', 'HTTPHandlerWrapper', 'HTTPError', 'HTTPHeaders', 'HTTPLogFormatter', 'HTTPLogFilter']
+__all__ = ['server_version', 'http_version', 'http_encoding', 'default_encoding', 'start_method', 'max_line_size', 'max_headers', 'max_request_size', 'stream_chunk_size', 'status_messages', 'mktime', 'mklog', 'HTTPServer', 'HTTPHandler', 'HTTPErrorHandler', 'HTTPHandlerWrapper', 'HTTPError', 'HTTPHeaders', 'IterIO', 'HTTPLogFormatter', 'HTTPLogFilter']
@@ -1,4 +1,10 @@
+import collections
+import fnmatch
 import html
+import inspect
+import itertools
+import json
+import operator
 import os
 import stat
 import time
@@ -8,9 +14,10 @@ import functools
 
 from fooster import web
 import fooster.web.file
+import fooster.web.search
 
 
-__all__ = ['default_index_template', 'default_index_entry', 'default_index_content_type', 'DirEntry', 'FancyIndexHandler', 'new']
+__all__ = ['default_index_template', 'default_index_entry', 'default_index_content_type', 'default_index_pagination', 'index_sorts', 'index_formats', 'index_media_types', 'index_batch_size', 'listing_cache_size', 'listing_cache_ttl', 'DirEntry', 'takes_entry', 'list_dir', 'cached_listing', 'FancyIndexHandler', 'new']
 
 
 default_index_template = '''<!DOCTYPE html>
@@ -33,7 +40,7 @@ default_index_template = '''<!DOCTYPE html>
                 </thead>
                 <tbody>{entries}
                 </tbody>
-            </table>{postindex}
+            </table>{pagination}{postindex}
         </div>{postcontent}
     </body>
 </html>
@@ -44,10 +51,47 @@ default_index_entry = '''
 
 default_index_content_type = 'text/html; charset=utf-8'
 
+default_index_pagination = '''
+            <p id="pagination"><a href="{previous}" rel="prev">Previous</a> Page {page} of {pages} <a href="{next}" rel="next">Next</a></p>'''
+
+# sort name -> key over cached (name, size, modified, rendered entry, is directory) items, where name is already the sort class order
+index_sorts = {
+    'name': None,
+    'size': lambda item: -1 if item[1] is None else item[1],
+    'modified': lambda item: item[2],
+}
+
+# format -> content type, where None means index_content_type
+index_formats = {
+    'html': None,
+    'json': 'application/json',
+    'ndjson': 'application/x-ndjson',
+}
+
+# accepted media type -> format
+index_media_types = {
+    'text/html': 'html',
+    'application/json': 'json',
+    'application/x-ndjson': 'ndjson',
+    'application/ndjson': 'ndjson',
+    '*/*': 'html',
+}
+
+# number of entries formatted into each piece of a streamed index
+index_batch_size = 512
+
+listing_cache_size = 64
+listing_cache_ttl = 60  # 1 minute
+
+# per-process cache of key -> (directory identity, rendered entries, time rendered)
+listing_cache = collections.OrderedDict()
+
 
 @functools.total_ordering
 class DirEntry:
-    def __init__(self, dirname, filename):
+    __slots__ = ('dirname', 'filename', 'dirname_l', 'filename_l', 'path', 'stat', 'mode', 'modified', 'is_dir', 'size', 'key')
+
+    def __init__(self, dirname, filename, entry=None):
         self.dirname = dirname
         self.filename = filename
 
@@ -56,7 +100,11 @@ class DirEntry:
 
         self.path = os.path.join(dirname, filename)
 
-        self.stat = os.stat(self.path)
+        # reuse the stat cached on a scandir entry if there is one and list broken links as themselves
+        try:
+            self.stat = entry.stat() if entry else os.stat(self.path)
+        except FileNotFoundError:
+            self.stat = entry.stat(follow_symlinks=False) if entry else os.lstat(self.path)
 
         self.mode = self.stat.st_mode
         self.modified = time.localtime(self.stat.st_mtime)
@@ -70,6 +118,9 @@ class DirEntry:
             self.is_dir = False
             self.size = self.stat.st_size
 
+        # precomputed so sorting never calls back into python
+        self.key = (self.dirname_l, self.dirname, not self.is_dir, self.filename_l, self.filename)
+
     def __repr__(self):
         return '<' + self.__class__.__name__ + ' (' + repr(self.dirname) + ') ' + repr(self.filename) + '>'
 
@@ -80,25 +131,33 @@ class DirEntry:
         return self.path == other.path
 
     def __lt__(self, other):
-        # compare parents if different
-        if self.dirname != other.dirname:
-            # if lower case names are different, compare them
-            if self.dirname_l != other.dirname_l:
-                return self.dirname_l < other.dirname_l
+        # parents case insensitively then exactly, directories first, then names case insensitively then exactly
+        return self.key < other.key
+
+
+sort_key = operator.attrgetter('key')
+
+# per-process record of sort class -> whether it takes a scandir entry
+sortclass_entries = {}
+
 
-            # if nothing else, sort by dirname
-            return self.dirname < other.dirname
+def takes_entry(sortclass):
+    try:
+        return sortclass_entries[sortclass]
+    except KeyError:
+        pass
 
-        # directories are always less
-        if self.is_dir != other.is_dir:
-            return self.is_dir
+    # sort classes written before entries were passed only take a dirname and filename
+    try:
+        parameters = inspect.signature(sortclass).parameters.values()
+    except (TypeError, ValueError):
+        takes = False
+    else:
+        takes = any(parameter.name == 'entry' or parameter.kind == parameter.VAR_KEYWORD for parameter in parameters)
 
-        # if lower case names are different, compare them
-        if self.filename_l != other.filename_l:
-            return self.filename_l < other.filename_l
+    sortclass_entries[sortclass] = takes
 
-        # if nothing else, sort by filename
-        return self.filename < other.filename
+    return takes
 
 
 def list_dir(dirname, root=False, sortclass=DirEntry):
@@ -107,14 +166,51 @@ def list_dir(dirname, root=False, sortclass=DirEntry):
     if not root:
         direntries.append(sortclass(dirname, '..'))
 
-    for filename in os.listdir(dirname):
-        direntries.append(sortclass(dirname, filename))
+    with os.scandir(dirname) as entries:
+        if takes_entry(sortclass):
+            for entry in entries:
+                direntries.append(sortclass(dirname, entry.name, entry=entry))
+        else:
+            for entry in entries:
+                direntries.append(sortclass(dirname, entry.name))
 
-    direntries.sort()
+    # only fall back to comparisons for sort classes that define their own
+    if sortclass.__lt__ is DirEntry.__lt__:
+        direntries.sort(key=sort_key)
+    else:
+        direntries.sort()
 
     return direntries
 
 
+def cached_listing(dirname, key, render):
+    dir_stat = os.stat(dirname)
+    identity = (dir_stat.st_dev, dir_stat.st_ino, dir_stat.st_mtime_ns)
+
+    now = time.time()
+
+    # reuse the rendering if the directory has not changed and sizes and times in it are not too old
+    try:
+        cached_identity, listing, rendered = listing_cache[key]
+        if cached_identity == identity and now - rendered < listing_cache_ttl:
+            listing_cache.move_to_end(key)
+            return listing
+    except KeyError:
+        pass
+
+    listing = render()
+
+    # do not trust an mtime so recent that another change could share it
+    if now - dir_stat.st_mtime >= 2:
+        listing_cache[key] = identity, listing, now
+        listing_cache.move_to_end(key)
+
+        while len(listing_cache) > listing_cache_size:
+            listing_cache.popitem(last=False)
+
+    return listing
+
+
 def human_readable_size(size, fmt='{size:.2f} {unit}', units=None, default='-'):
     # bail with default value if no size
     if size is None:
@@ -150,6 +246,12 @@ class FancyIndexHandler(fooster.web.file.PathHandler):
     index_entry = default_index_entry
     index_entry_join = ''
     index_content_type = default_index_content_type
+    index_pagination = default_index_pagination
+    index_limit = None
+    index_file = None
+    search = False
+    search_limit = fooster.web.search.max_results
+    dir_sizes = False
 
     def __init__(self, *args, **kwargs):
         self.head = kwargs.pop('head', self.head)
@@ -162,18 +264,286 @@ class FancyIndexHandler(fooster.web.file.PathHandler):
         self.index_entry = kwargs.pop('index_entry', self.index_entry)
         self.index_entry_join = kwargs.pop('index_entry_join', self.index_entry_join)
         self.index_content_type = kwargs.pop('index_content_type', self.index_content_type)
+        self.index_pagination = kwargs.pop('index_pagination', self.index_pagination)
+        self.index_limit = kwargs.pop('index_limit', self.index_limit)
+        self.index_file = kwargs.pop('index_file', self.index_file)
+        self.search = kwargs.pop('search', self.search)
+        self.search_limit = kwargs.pop('search_limit', self.search_limit)
+        self.dir_sizes = kwargs.pop('dir_sizes', self.dir_sizes)
 
         super().__init__(*args, **kwargs)
 
-    def index(self):
-        self.response.headers.set('Content-Type', self.index_content_type)
+    def respond(self):
+        # keep an index of everything under local up to date in the background
+        if self.index_file:
+            fooster.web.search.start_indexer(self.local, self.index_file)
+
+        return super().respond()
+
+    def load_index(self):
+        # None until the background index is first built
+        return fooster.web.search.load(self.index_file) if self.index_file else None
+
+    def render_entry(self, direntry):
+        return self.index_entry.format(url=urllib.parse.quote(str(direntry)), name=html.escape(str(direntry)), size=human_readable_size(direntry.size), modified=human_readable_time(direntry.modified))
+
+    def render_item(self, direntry, sizes=None):
+        # fill in recursive sizes of directories from the index
+        if sizes is not None and direntry.is_dir:
+            direntry.size = sizes.get(self.path + str(direntry))
+
+        # keep only what sorting, filtering, and rendering need instead of every stat
+        return (str(direntry).rstrip('/'), direntry.size, direntry.stat.st_mtime, self.render_entry(direntry), direntry.is_dir)
+
+    def render_index(self, sizes=None):
+        return [self.render_item(direntry, sizes) for direntry in list_dir(self.filename, True, self.sortclass)]
+
+    def listing(self, sort='name', pattern=None):
+        index = self.load_index() if self.dir_sizes else None
+        sizes = index.sizes() if index else None
+
+        def render_index():
+            return self.render_index(sizes)
+
+        # rendered entries depend on everything that goes into rendering them including any sizes from the index
+        key = (self.filename, self.sortclass, self.index_entry, index.identity if index else None)
+
+        if sort == 'name' and not pattern:
+            return cached_listing(self.filename, key, render_index)
+
+        def render_view():
+            view = cached_listing(self.filename, key, render_index)
+
+            if pattern:
+                view = [item for item in view if fnmatch.fnmatchcase(item[0], pattern)]
+
+            if index_sorts[sort]:
+                view = sorted(view, key=index_sorts[sort])
+
+            return view
+
+        # sorted and filtered views are derived from the cached index once and then cached themselves
+        return cached_listing(self.filename, key + (sort, pattern), render_view)
+
+    def search_listing(self, term, prefix_match=False, sort='name', pattern=None):
+        index = self.load_index()
+
+        # HTTP Status 503
+        # index is still being built
+        if index is None:
+            error_headers = web.HTTPHeaders()
+            error_headers.set('Retry-After', str(fooster.web.search.search_interval))
+
+            raise web.HTTPError(503, headers=error_headers)
+
+        sizes = index.sizes() if self.dir_sizes else None
+
+        view = []
+
+        # look up matches in the index and only touch the filesystem for what was found
+        for path in index.search(term, self.path, prefix_match, self.search_limit):
+            try:
+                view.append(self.render_item(self.sortclass(self.filename, path[len(self.path):].rstrip('/')), sizes))
+            except OSError:
+                continue
+
+        if pattern:
+            view = [item for item in view if fnmatch.fnmatchcase(item[0], pattern)]
+
+        if index_sorts[sort]:
+            view.sort(key=index_sorts[sort])
+
+        return view
+
+    def page_url(self, query, page):
+        return '?' + urllib.parse.urlencode(dict(query, page=page))
+
+    def index_format(self, query):
+        if 'format' in query:
+            if query['format'] not in index_formats:
+                raise web.HTTPError(400)
+
+            return query['format']
+
+        # take the first listed media type that is not refused - application/json;q=0
+        for media_type in (self.request.headers.get('Accept') or '').split(','):
+            name, *params = media_type.split(';')
+            name = name.strip().lower()
+
+            if name not in index_media_types:
+                continue
+
+            try:
+                if any(float(param.strip()[2:]) == 0 for param in params if param.strip().startswith('q=')):
+                    continue
+            except ValueError:
+                continue
+
+            return index_media_types[name]
+
+        return 'html'
+
+    def page_items(self, listing, page, limit, order):
+        # only slice out the requested page
+        if limit is None:
+            start, stop = 0, len(listing)
+        else:
+            start, stop = min((page - 1) * limit, len(listing)), min(page * limit, len(listing))
+
+        if order == 'desc':
+            return reversed(listing[len(listing) - stop:len(listing) - start])
+
+        return iter(listing[start:stop])
+
+    def stream_index(self, head, tail, rows, separator):
+        # the top of the page goes out before the directory is even read
+        yield head
+        yield ''
+
+        rows = rows()
+
+        joiner = ''
+
+        while True:
+            batch = list(itertools.islice(rows, index_batch_size))
+            if not batch:
+                break
+
+            yield joiner + separator.join(batch)
+
+            joiner = separator
+
+        yield tail
+
+    def send_index(self):
+        query = self.query()
+
+        index_format = self.index_format(query)
+
+        # the same url gives different representations
+        self.response.headers.set('Vary', 'Accept')
+
+        dir_stat = os.stat(self.filename)
+
+        # search results change with anything beneath the directory
+        if 'search' in query and self.search:
+            return 200, self.index(query, index_format)
+
+        # listings change with the directory but do not trust an mtime so recent that another change could share it
+        if time.time() - dir_stat.st_mtime >= 2:
+            etag = 'W/"{:x}-{:x}-{}"'.format(dir_stat.st_ino, dir_stat.st_mtime_ns, index_format)
+
+            # recursive sizes change with anything beneath the directory
+            if self.dir_sizes:
+                index = self.load_index()
+                etag = etag[:-1] + '-{:x}"'.format(index.identity[2] if index else 0)
+
+            self.response.headers.set('ETag', etag)
+
+            # HTTP Status 304
+            # client already has this listing
+            if fooster.web.file.match_etag(self.request.headers.get('If-None-Match'), etag):
+                return 304, ''
+
+        return 200, self.index(query, index_format)
+
+    def index(self, query=None, index_format='html'):
+        if query is None:
+            query = self.query()
+
+        self.response.headers.set('Content-Type', index_formats[index_format] or self.index_content_type)
+
+        sort = query.get('sort', 'name')
+        order = query.get('order', 'asc')
+        pattern = query.get('filter')
+
+        if sort not in index_sorts or order not in ('asc', 'desc'):
+            raise web.HTTPError(400)
+
+        try:
+            page = int(query.get('page', 1))
+            limit = int(query['limit']) if 'limit' in query else self.index_limit
+        except ValueError as error:
+            raise web.HTTPError(400) from error
+
+        if page < 1 or (limit is not None and limit < 1):
+            raise web.HTTPError(400)
+
+        listing = None
+        pagination = ''
+
+        if 'search' in query and self.search:
+            if query.get('match', 'substring') not in ('substring', 'prefix') or '\n' in query['search']:
+                raise web.HTTPError(400)
+
+            listing = self.search_listing(query['search'], query.get('match') == 'prefix', sort, pattern)
+
+        # page links need the size of the listing up front
+        if limit is not None and listing is None:
+            listing = self.listing(sort, pattern)
+
+        if limit is not None:
+            pages = max(-(-len(listing) // limit), 1)
+
+            previous_url = self.page_url(query, max(min(page - 1, pages), 1))
+            next_url = self.page_url(query, min(page + 1, pages))
+
+            links = []
+            if page > 1:
+                links.append('<' + previous_url + '>; rel="prev"')
+            if page < pages:
+                links.append('<' + next_url + '>; rel="next"')
+
+            if links:
+                self.response.headers.set('Link', ', '.join(links))
+
+            pagination = self.index_pagination.format(previous=html.escape(previous_url), next=html.escape(next_url), page=page, pages=pages)
+
+        def items():
+            return self.page_items(self.listing(sort, pattern) if listing is None else listing, page, limit, order)
+
+        if index_format == 'html':
+            def rows():
+                entries = (item[3] for item in items())
+
+                # the parent directory heads every page
+                if self.path != '/':
+                    entries = itertools.chain([self.render_entry(self.sortclass(self.filename, '..'))], entries)
+
+                return entries
+
+            # format index_template with the unquoted resource as a title and split it where the entries go
+            marker = '\x00entries\x00'
+            head, _, tail = self.index_template.format(dirname=html.escape(self.path), head=self.head, precontent=self.precontent, preindex=self.preindex, postindex=self.postindex, postcontent=self.postcontent, pagination=pagination, entries=marker).partition(marker)
+
+            separator = self.index_entry_join
+        else:
+            def rows():
+                entries = (json.dumps({'name': name, 'size': size, 'modified': modified, 'is_dir': is_dir}, separators=(',', ':')) for name, size, modified, _row, is_dir in items())
+
+                # one object per line
+                if index_format == 'ndjson':
+                    entries = (entry + '\n' for entry in entries)
+
+                return entries
+
+            if index_format == 'ndjson':
+                head, tail, separator = '', '', ''
+            else:
+                head, tail, separator = '{"path":' + json.dumps(self.path) + ',"entries":[', ']}', ','
+
+        # entries are formatted as they are sent so no length is known and it goes out chunked
+        return web.IterIO(self.stream_index(head, tail, rows, separator))
 
-        # magic for formatting index_template with the unquoted resource as a title and a joined list comprehension that formats index_entry for each entry in the directory
-        return self.index_template.format(dirname=html.escape(self.path), head=self.head, precontent=self.precontent, preindex=self.preindex, postindex=self.postindex, postcontent=self.postcontent, entries=self.index_entry_join.join(self.index_entry.format(url=urllib.parse.quote(str(direntry)), name=html.escape(str(direntry)), size=human_readable_size(direntry.size), modified=human_readable_time(direntry.modified)) for direntry in list_dir(self.filename, self.path == '/', self.sortclass)))
 
+def new(local, remote='', *, modify=False, cache_policy=None, manifest=None, watch=False, archive=False, head='', precontent='', preindex='', postindex='', postcontent='', sortclass=DirEntry, index_template=default_index_template, index_entry=default_index_entry, index_entry_join='', index_content_type=default_index_content_type, index_pagination=default_index_pagination, index_limit=None, search=False, search_limit=fooster.web.search.max_results, dir_sizes=False, index_file=None, handler=FancyIndexHandler):
+    # search and directory sizes share one background index
+    if not search and not dir_sizes:
+        index_file = None
+    elif index_file is None:
+        index_file = fooster.web.search.default_index_file(local)
 
-def new(local, remote='', *, modify=False, head='', precontent='', preindex='', postindex='', postcontent='', sortclass=DirEntry, index_template=default_index_template, index_entry=default_index_entry, index_entry_join='', index_content_type=default_index_content_type, handler=FancyIndexHandler):
-    return fooster.web.file.new(local, remote, dir_index=True, modify=modify, handler=web.HTTPHandlerWrapper(handler, head=head, precontent=precontent, preindex=preindex, postindex=postindex, postcontent=postcontent, sortclass=sortclass, index_template=index_template, index_entry=index_entry, index_entry_join=index_entry_join, index_content_type=index_content_type))
+    return fooster.web.file.new(local, remote, dir_index=True, modify=modify, cache_policy=cache_policy, manifest=manifest, watch=watch, archive=archive, handler=web.HTTPHandlerWrapper(handler, head=head, precontent=precontent, preindex=preindex, postindex=postindex, postcontent=postcontent, sortclass=sortclass, index_template=index_template, index_entry=index_entry, index_entry_join=index_entry_join, index_content_type=index_content_type, index_pagination=index_pagination, index_limit=index_limit, index_file=index_file, search=search, search_limit=search_limit, dir_sizes=dir_sizes))
 
 
 if __name__ == '__main__':
@@ -185,11 +555,15 @@ if __name__ == '__main__':
     parser.add_argument('-a', '--address', default='localhost', dest='address', help='address to serve HTTP on (default: \'localhost\')')
     parser.add_argument('-p', '--port', default=8000, type=int, dest='port', help='port to serve HTTP on (default: 8000)')
     parser.add_argument('--allow-modify', action='store_true', default=False, dest='modify', help='allow file and directory modifications using PUT and DELETE methods')
+    parser.add_argument('--archive', action='store_true', default=False, dest='archive', help='allow downloading directories as tar or zip archives with ?archive=tar or ?archive=zip')
+    parser.add_argument('--limit', type=int, default=None, dest='limit', help='default number of entries per directory index page (default: all)')
+    parser.add_argument('--search', action='store_true', default=False, dest='search', help='allow searching for files beneath a directory with ?search=name (indexed in the background)')
+    parser.add_argument('--dir-sizes', action='store_true', default=False, dest='dir_sizes', help='show the total size of everything beneath each directory (indexed in the background)')
     parser.add_argument('local_dir', nargs='?', default='.', help='local directory to serve over HTTP (default: \'.\')')
 
     cli = parser.parse_args()
 
-    httpd = web.HTTPServer((cli.address, cli.port), new(cli.local_dir, modify=cli.modify))
+    httpd = web.HTTPServer((cli.address, cli.port), new(cli.local_dir, modify=cli.modify, archive=cli.archive, index_limit=cli.limit, search=cli.search, dir_sizes=cli.dir_sizes))
     httpd.start()
 
     signal.signal(signal.SIGINT, lambda signum, frame: httpd.close())
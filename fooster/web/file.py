@@ -1,17 +1,126 @@
 import collections
+import ctypes
+import ctypes.util
+import errno
+import fcntl
+import fnmatch
+import functools
+import hashlib
+import io
+import json
 import mimetypes
+import mmap
+import multiprocessing
 import os
+import platform
 import re
-import shutil
+import secrets
+import stat
+import sys
+import tarfile
+import time
 import urllib.parse
+import zipfile
 
 from fooster import web
+import fooster.web.watch
 
 
-__all__ = ['max_file_size', 'normpath', 'FileHandler', 'PathMixIn', 'PathHandler', 'ModifyMixIn', 'DeleteMixIn', 'ModifyFileHandler', 'ModifyPathHandler', 'new']
+__all__ = ['max_file_size', 'max_archive_size', 'max_extract_size', 'max_extract_members', 'archive_types', 'archive_formats', 'archive_chunk_size', 'archive_compresslevel', 'resolve_cache_size', 'upload_buffer_size', 'copy_chunk_size', 'mmap_min_size', 'mmap_max_size', 'mmap_max_files', 'negative_cache_size', 'root_check_interval', 'reaper_batch', 'reaper_pause', 'reaper_nice', 'reaper_ioprio', 'staging_regex', 'staging_ttl', 'fingerprint_regex', 'fingerprint_length', 'normpath', 'resolve', 'quote', 'parse_ranges', 'parse_content_range', 'add_range', 'format_ranges', 'match_etag', 'open_root', 'open_beneath', 'watch_local', 'invalidate', 'remember_missing', 'is_missing', 'cached_mapping', 'open_mapped', 'upload_buffer', 'copy_body', 'preallocate', 'sync_dir', 'lock_staging', 'still_staging', 'load_staging', 'save_staging', 'expire_staging', 'copy_fd', 'copy_file', 'copy_tree', 'remove_tree', 'make_beneath', 'exchange', 'default_trash', 'set_priority', 'reap_entry', 'reap', 'run_reaper', 'start_reaper', 'ArchiveSink', 'tar_stream', 'zip_stream', 'MappedIO', 'MultipartRangeIO', 'BodyIO', 'CacheRule', 'CachePolicy', 'hash_file', 'ManifestEntry', 'Manifest', 'build_manifest', 'FileHandler', 'PathMixIn', 'PathHandler', 'ModifyMixIn', 'DeleteMixIn', 'ModifyFileHandler', 'ModifyPathHandler', 'new']
 
 
 max_file_size = 20971520  # 20 MB
+max_archive_size = 1073741824  # 1 GB
+max_extract_size = 4294967296  # 4 GB
+max_extract_members = 65536
+
+resolve_cache_size = 4096
+
+upload_buffer_size = 1048576  # 1 MB
+copy_chunk_size = 1073741824  # 1 GB
+
+mmap_min_size = 524288  # 512 KB
+mmap_max_size = 52428800  # 50 MB
+mmap_max_files = 64
+
+staging_regex = r'^\..+\.[0-9a-f]{32}\.partial(\.ranges(\.[0-9a-f]{16})?)?$'
+staging_ttl = 86400  # 1 day
+
+fingerprint_regex = r'\.[0-9a-f]{8,}(\.[^./]+)?$'
+fingerprint_length = 16
+
+# request content types extracted by a PUT to a directory
+archive_types = ['application/x-tar', 'application/x-gtar']
+
+# directory download formats - ?archive=format
+archive_formats = {'tar': 'application/x-tar', 'zip': 'application/zip'}
+archive_chunk_size = 1048576  # 1 MB
+archive_compresslevel = 1
+
+# per-process cache of filename -> (identity, mapping, stat, checked)
+mmap_cache = collections.OrderedDict()
+
+negative_cache_size = 4096
+
+# per-process cache of missing filename -> (directory, inode, mtime, checked)
+negative_cache = collections.OrderedDict()
+
+# per-process upload buffer
+upload_view = None
+
+# per-process filesystem watcher that invalidates the caches above
+watcher = None
+
+root_check_interval = 1  # 1 second
+
+# per-process open directories for served roots - local -> (fd, identity, checked)
+root_fds = {}
+
+# background deletion - trash entries are removed in batches at a low priority
+reaper_batch = 1000
+reaper_pause = 0.01  # 10 ms
+reaper_nice = 19
+reaper_ioprio = (2, 7)  # best effort class, lowest level
+
+# per-process reaper processes - trash -> process
+reapers = {}
+
+# ioprio_set from <linux/ioprio.h> differs by architecture
+ioprio_syscalls = {'x86_64': 251, 'i386': 289, 'i686': 289, 'aarch64': 30, 'armv7l': 314, 'ppc64le': 273, 's390x': 282}
+ioprio_who_process = 1
+ioprio_class_shift = 13
+
+# struct open_how and flags from <linux/openat2.h>
+openat2_syscall = 437
+openat2_resolve_beneath = 0x08
+openat2_resolve_no_magiclinks = 0x02
+
+
+class OpenHow(ctypes.Structure):
+    _fields_ = [('flags', ctypes.c_uint64), ('mode', ctypes.c_uint64), ('resolve', ctypes.c_uint64)]
+
+
+# flags from <fcntl.h> and <linux/fs.h>
+at_fdcwd = -100
+rename_exchange = 0x02
+
+
+try:
+    libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+    libc_syscall = libc.syscall
+    openat2_available = sys.platform.startswith('linux')
+except (OSError, AttributeError, TypeError):
+    libc = None
+    openat2_available = False
+
+# glibc 2.28 and later
+try:
+    libc_renameat2 = libc.renameat2
+    libc_renameat2.argtypes = [ctypes.c_int, ctypes.c_char_p, ctypes.c_int, ctypes.c_char_p, ctypes.c_uint]
+    libc_renameat2.restype = ctypes.c_int
+    renameat2_available = True
+except AttributeError:
+    renameat2_available = False
 
 
 def normpath(path):
@@ -19,8 +128,12 @@ def normpath(path):
     if not path:
         return ''
 
+    # fast path for the common case of an already normal path - no empty, '.' or '..' segments (dotfiles take the slow path)
+    if '//' not in path and '/.' not in path and path[0] != '.':
+        return path
+
     old_path = path.split('/')
-    new_path = collections.deque()
+    new_path = []
 
     for entry in old_path:
         # ignore empty paths - A//B -> A/B
@@ -31,120 +144,1556 @@ def normpath(path):
             continue
         # go back a level by popping the last directory off (if there is one) - A/foo/../B -> A/B
         elif entry == '..':
-            if len(new_path) > 0:
+            if new_path:
                 new_path.pop()
         else:
             new_path.append(entry)
 
-    # special case for leading slashes
-    if old_path[0] == '':
-        new_path.appendleft('')
+    # special case for leading slashes
+    if old_path[0] == '':
+        new_path.insert(0, '')
+
+    # special case for trailing slashes
+    if old_path[-1] == '':
+        new_path.append('')
+
+    # special case for single slash left
+    norm = '/'.join(new_path)
+    if not norm:
+        norm = '/'
+
+    return norm
+
+
+@functools.lru_cache(maxsize=resolve_cache_size)
+def resolve(pathstr):
+    # unquote and normalise in one step so repeated URLs are a single lookup
+    path = urllib.parse.unquote(pathstr)
+
+    return path, normpath(path)
+
+
+@functools.lru_cache(maxsize=resolve_cache_size)
+def quote(path):
+    return urllib.parse.quote(path)
+
+
+def parse_ranges(range_header, size):
+    # only byte ranges are understood - anything else is ignored
+    unit, sep, specs = range_header.partition('=')
+    if not sep or unit.strip().lower() != 'bytes':
+        return None
+
+    ranges = []
+    valid = False
+
+    for spec in specs.split(','):
+        # ignore empty list elements - bytes=0-1,,2-3
+        if not spec.strip():
+            continue
+
+        range_match = re.match(r'^\s*(\d*)-(\d*)\s*$', spec)
+        if not range_match or not (range_match.group(1) or range_match.group(2)):
+            return None
+
+        valid = True
+
+        if range_match.group(1):
+            # get lower and upper bounds
+            lower = int(range_match.group(1))
+            if range_match.group(2):
+                upper = int(range_match.group(2))
+
+                # an inverted range invalidates the whole header
+                if upper < lower:
+                    return None
+            else:
+                upper = size - 1
+
+            # skip unsatisfiable range
+            if lower >= size:
+                continue
+
+            # clamp range to end of file
+            upper = min(upper, size - 1)
+        else:
+            # suffix range - bytes=-500 is the last 500 bytes
+            suffix = int(range_match.group(2))
+
+            # skip unsatisfiable range
+            if not suffix or not size:
+                continue
+
+            lower = max(size - suffix, 0)
+            upper = size - 1
+
+        ranges.append((lower, upper))
+
+    if not valid:
+        return None
+
+    # coalesce overlapping and adjacent ranges
+    ranges.sort()
+
+    merged = []
+    for lower, upper in ranges:
+        if merged and lower <= merged[-1][1] + 1:
+            merged[-1] = (merged[-1][0], max(merged[-1][1], upper))
+        else:
+            merged.append((lower, upper))
+
+    return merged
+
+
+def parse_content_range(content_range):
+    # bytes 0-499/1234 or bytes */1234 - a complete length is required to know when an upload is done
+    range_match = re.match(r'^\s*bytes\s+(?:(\d+)-(\d+)|(\*))/(\d+)\s*$', content_range, re.IGNORECASE)
+    if not range_match:
+        return None
+
+    total = int(range_match.group(4))
+
+    if range_match.group(3):
+        return None, None, total
+
+    lower, upper = int(range_match.group(1)), int(range_match.group(2))
+    if upper < lower:
+        return None
+
+    return lower, upper, total
+
+
+def add_range(ranges, lower, upper):
+    # coalesce the new range with overlapping and adjacent ones
+    merged = []
+    for range_lower, range_upper in sorted(ranges + [[lower, upper]]):
+        if merged and range_lower <= merged[-1][1] + 1:
+            merged[-1][1] = max(merged[-1][1], range_upper)
+        else:
+            merged.append([range_lower, range_upper])
+
+    return merged
+
+
+def format_ranges(ranges):
+    return 'bytes=' + ','.join(str(lower) + '-' + str(upper) for lower, upper in ranges)
+
+
+def cached_mapping(filename):
+    # apply any pending invalidations first
+    if watcher:
+        watcher.check()
+
+        # skip the open if the directory is watched and the mapping was checked recently enough
+        try:
+            _identity, view, file_stat, checked = mmap_cache[filename]
+            if watcher.fresh(os.path.dirname(filename), checked):
+                mmap_cache.move_to_end(filename)
+                return MappedIO(view), file_stat
+        except KeyError:
+            pass
+
+    return None, None
+
+
+def open_mapped(filename, fd, file_stat):
+    # only map non-empty regular files in the configured size window
+    if not stat.S_ISREG(file_stat.st_mode) or not file_stat.st_size or not mmap_min_size <= file_stat.st_size <= mmap_max_size:
+        return None
+
+    # fd and file_stat come from what the caller actually opened so the mapping is of that file
+    identity = (file_stat.st_dev, file_stat.st_ino, file_stat.st_mtime_ns, file_stat.st_size)
+
+    # reuse mapping if the file has not changed since it was mapped
+    try:
+        mapped_identity, view, _file_stat, _checked = mmap_cache[filename]
+        if mapped_identity == identity:
+            mmap_cache[filename] = identity, view, file_stat, time.time()
+            mmap_cache.move_to_end(filename)
+            return MappedIO(view)
+    except KeyError:
+        pass
+
+    view = memoryview(mmap.mmap(fd, 0, access=mmap.ACCESS_READ))
+
+    # old mappings are unmapped once any responses still using them are finished
+    mmap_cache[filename] = identity, view, file_stat, time.time()
+    mmap_cache.move_to_end(filename)
+
+    while len(mmap_cache) > mmap_max_files:
+        mmap_cache.popitem(last=False)
+
+    return MappedIO(view)
+
+
+def open_root(local):
+    # empty local means the filesystem root
+    local = local or '/'
+
+    now = time.time()
+
+    try:
+        fd, identity, checked = root_fds[local]
+    except KeyError:
+        fd, identity, checked = None, None, 0
+
+    if fd is not None and now - checked < root_check_interval:
+        return fd
+
+    # reopen if local was swapped for another directory (e.g. a symlink flip on deploy)
+    local_stat = os.stat(local)
+    if fd is not None and identity == (local_stat.st_dev, local_stat.st_ino):
+        root_fds[local] = fd, identity, now
+        return fd
+
+    if fd is not None:
+        os.close(fd)
+        del root_fds[local]
+
+    fd = os.open(local, os.O_RDONLY | os.O_DIRECTORY | os.O_CLOEXEC)
+
+    root_stat = os.fstat(fd)
+    root_fds[local] = fd, (root_stat.st_dev, root_stat.st_ino), now
+
+    return fd
+
+
+def open_beneath(dir_fd, path, flags=os.O_RDONLY | os.O_CLOEXEC, confine=False):
+    global openat2_available  # pylint: disable=global-statement
+
+    # relative to dir_fd - '/a/b/' -> 'a/b/'
+    path = path.lstrip('/') or '.'
+
+    if not confine:
+        return os.open(path, flags, dir_fd=dir_fd)
+
+    # let the kernel refuse anything resolving outside of dir_fd
+    if openat2_available:
+        how = OpenHow(flags, 0, openat2_resolve_beneath | openat2_resolve_no_magiclinks)
+        fd = libc_syscall(openat2_syscall, dir_fd, os.fsencode(path), ctypes.byref(how), ctypes.c_size_t(ctypes.sizeof(how)))
+        if fd >= 0:
+            return fd
+
+        error = ctypes.get_errno()
+        if error not in (errno.ENOSYS, errno.EPERM):
+            raise OSError(error, os.strerror(error), path)
+
+        # kernel too old or syscall filtered
+        openat2_available = False
+
+    # otherwise walk one component at a time refusing all symlinks
+    components = [component for component in path.split('/') if component]
+    if path.endswith('/'):
+        flags |= os.O_DIRECTORY
+
+    fd = dir_fd
+    try:
+        for component in components[:-1]:
+            next_fd = os.open(component, os.O_RDONLY | os.O_DIRECTORY | os.O_NOFOLLOW | os.O_CLOEXEC, dir_fd=fd)
+            if fd != dir_fd:
+                os.close(fd)
+            fd = next_fd
+
+        return os.open(components[-1] if components else '.', flags | os.O_NOFOLLOW, dir_fd=fd)
+    finally:
+        if fd != dir_fd:
+            os.close(fd)
+
+
+def watch_local(local, ttl=fooster.web.watch.default_ttl):
+    global watcher  # pylint: disable=global-statement
+
+    if watcher is None:
+        watcher = fooster.web.watch.Watcher(ttl=ttl)
+        watcher.subscribe(invalidate)
+
+    if local not in watcher.roots:
+        watcher.add(local)
+
+    return watcher
+
+
+def invalidate(path):
+    # drop everything if the watcher lost track
+    if path is None:
+        mmap_cache.clear()
+        negative_cache.clear()
+        return
+
+    mmap_cache.pop(path, None)
+
+    # any change in a directory may resolve misses recorded against it
+    parent = os.path.dirname(path)
+    for filename, entry in list(negative_cache.items()):
+        if entry[0] in (parent, path):
+            del negative_cache[filename]
+
+
+def remember_missing(filename):
+    # find the nearest existing directory - its mtime changes when anything that could fix the miss is created
+    dirname = os.path.dirname(filename.rstrip('/'))
+    while True:
+        try:
+            dir_stat = os.stat(dirname)
+            if stat.S_ISDIR(dir_stat.st_mode):
+                break
+        except OSError:
+            pass
+
+        parent = os.path.dirname(dirname)
+        if parent == dirname:
+            return False
+
+        dirname = parent
+
+    now = time.time()
+
+    # do not trust an mtime so recent that another change could share it unless changes are being watched
+    if now - dir_stat.st_mtime < 2 and not (watcher and watcher.covers(dirname)):
+        return False
+
+    negative_cache[filename] = (dirname, dir_stat.st_ino, dir_stat.st_mtime_ns, now)
+    negative_cache.move_to_end(filename)
+
+    while len(negative_cache) > negative_cache_size:
+        negative_cache.popitem(last=False)
+
+    return True
+
+
+def is_missing(filename):
+    # apply any pending invalidations first
+    if watcher:
+        watcher.check()
+
+    try:
+        dirname, ino, mtime, checked = negative_cache[filename]
+    except KeyError:
+        return False
+
+    # skip the stat if the directory is watched or was checked recently enough
+    if watcher and watcher.fresh(dirname, checked):
+        return True
+
+    try:
+        dir_stat = os.stat(dirname)
+        if dir_stat.st_ino == ino and dir_stat.st_mtime_ns == mtime:
+            negative_cache[filename] = (dirname, ino, mtime, time.time())
+            return True
+    except OSError:
+        pass
+
+    # directory changed so forget the miss
+    del negative_cache[filename]
+
+    return False
+
+
+def match_etag(header, etag):
+    if not header:
+        return False
+
+    if header.strip() == '*':
+        return True
+
+    # weak comparison as required for If-None-Match
+    if etag.startswith('W/'):
+        etag = etag[2:]
+
+    for tag in header.split(','):
+        tag = tag.strip()
+        if tag.startswith('W/'):
+            tag = tag[2:]
+
+        if tag == etag:
+            return True
+
+    return False
+
+
+class MappedIO(io.RawIOBase):
+    def __init__(self, view):
+        super().__init__()
+
+        self.view = view
+        self.position = 0
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_SET:
+            self.position = offset
+        elif whence == io.SEEK_CUR:
+            self.position += offset
+        elif whence == io.SEEK_END:
+            self.position = len(self.view) + offset
+        else:
+            raise ValueError('invalid whence')
+
+        self.position = max(self.position, 0)
+
+        return self.position
+
+    def tell(self):
+        return self.position
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            end = len(self.view)
+        else:
+            end = min(self.position + size, len(self.view))
+
+        # hand out slices of the mapping instead of copies
+        chunk = self.view[self.position:end]
+        self.position = max(end, self.position)
+
+        return chunk
+
+    def readinto(self, buffer):
+        chunk = self.read(len(buffer))
+        buffer[:len(chunk)] = chunk
+
+        return len(chunk)
+
+
+class MultipartRangeIO(io.RawIOBase):
+    def __init__(self, file, ranges, size, mime=None):
+        super().__init__()
+
+        self.file = file
+        self.boundary = secrets.token_hex(16)
+
+        # build a list of parts that are either literal bytes or (offset, length) of the file
+        self.parts = collections.deque()
+
+        for lower, upper in ranges:
+            part_headers = '--' + self.boundary + '\r\n'
+            if mime:
+                part_headers += 'Content-Type: ' + mime + '\r\n'
+            part_headers += 'Content-Range: bytes ' + str(lower) + '-' + str(upper) + '/' + str(size) + '\r\n\r\n'
+
+            self.parts.append(part_headers.encode(web.http_encoding))
+            self.parts.append((lower, upper - lower + 1))
+            self.parts.append(b'\r\n')
+
+        self.parts.append(('--' + self.boundary + '--\r\n').encode(web.http_encoding))
+
+        self.length = sum(len(part) if isinstance(part, bytes) else part[1] for part in self.parts)
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        while self.parts:
+            part = self.parts[0]
+
+            if isinstance(part, bytes):
+                # copy as much of the literal as fits and keep the rest
+                amount = min(len(part), len(buffer))
+                buffer[:amount] = part[:amount]
+
+                if amount < len(part):
+                    self.parts[0] = part[amount:]
+                else:
+                    self.parts.popleft()
+
+                return amount
+
+            offset, remaining = part
+
+            # read the next piece of the range from the file
+            self.file.seek(offset)
+            chunk = self.file.read(min(remaining, len(buffer)))
+
+            # give up on the range if the file got shorter
+            if not chunk:
+                self.parts.popleft()
+                continue
+
+            amount = len(chunk)
+            buffer[:amount] = chunk
+
+            if amount < remaining:
+                self.parts[0] = (offset + amount, remaining - amount)
+            else:
+                self.parts.popleft()
+
+            return amount
+
+        return 0
+
+    def close(self):
+        self.file.close()
+
+        super().close()
+
+
+class BodyIO(io.RawIOBase):
+    def __init__(self, rfile, length=None, limit=None):
+        self.rfile = rfile
+
+        # None for a chunked body
+        self.length = length
+        self.limit = limit
+
+        self.remaining = length
+        self.total = 0
+        self.done = False
+
+    def readable(self):
+        return True
+
+    def next_chunk(self):
+        length_str = self.rfile.readline().decode(web.http_encoding)
+        if length_str[-2:] != '\r\n':
+            raise web.HTTPError(400)
+
+        try:
+            length = int(length_str[:-2], 16)
+        except ValueError as error:
+            raise web.HTTPError(400) from error
+
+        if not length:
+            # no trailers are understood so only the final empty line may follow
+            line = self.rfile.readline().decode(web.http_encoding)
+
+            if line != '\r\n':
+                raise web.HTTPError(400)
+
+            self.done = True
+
+            return
+
+        self.total += length
+
+        if self.limit is not None and self.total > self.limit:
+            raise web.HTTPError(413)
+
+        self.remaining = length
+
+    def readinto(self, buffer):
+        if self.done:
+            return 0
+
+        if not self.remaining:
+            # all of a fixed length body has been read
+            if self.length is not None:
+                self.done = True
+                return 0
+
+            # end of the last chunk must be marked
+            if self.remaining is not None:
+                line = self.rfile.readline().decode(web.http_encoding)
+
+                if line != '\r\n':
+                    raise web.HTTPError(400)
+
+            self.next_chunk()
+            if self.done:
+                return 0
+
+        view = memoryview(buffer)
+        read = self.rfile.readinto(view[:min(len(view), self.remaining)])
+
+        # a short body means the client went away
+        if not read:
+            raise web.HTTPError(400)
+
+        self.remaining -= read
+
+        return read
+
+
+class ArchiveSink:
+    def __init__(self):
+        self.chunks = []
+
+    def write(self, data):
+        self.chunks.append(bytes(data))
+
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def drain(self):
+        chunks, self.chunks = self.chunks, []
+
+        return chunks
+
+
+def tar_stream(entries):
+    view = memoryview(bytearray(archive_chunk_size))
+
+    for name, entry_stat, file in entries:
+        info = tarfile.TarInfo(name)
+        info.mode = stat.S_IMODE(entry_stat.st_mode)
+        info.mtime = int(entry_stat.st_mtime)
+
+        if file is None:
+            info.type = tarfile.DIRTYPE
+
+            yield info.tobuf(tarfile.PAX_FORMAT)
+
+            continue
+
+        info.size = entry_stat.st_size
+
+        yield info.tobuf(tarfile.PAX_FORMAT)
+
+        with file:
+            remaining = info.size
+
+            while remaining:
+                read = file.readinto(view[:min(remaining, len(view))])
+                if not read:
+                    break
+
+                remaining -= read
+
+                yield view[:read]
+
+        # the header promised this much so fill in for a file that shrank
+        while remaining:
+            length = min(remaining, len(view))
+            remaining -= length
+
+            yield bytes(length)
+
+        # pad out to a whole block
+        if info.size % tarfile.BLOCKSIZE:
+            yield bytes(tarfile.BLOCKSIZE - info.size % tarfile.BLOCKSIZE)
+
+    # end of archive marker
+    yield bytes(2 * tarfile.BLOCKSIZE)
+
+
+def zip_stream(entries, compression=zipfile.ZIP_DEFLATED):
+    view = memoryview(bytearray(archive_chunk_size))
+
+    # the sink cannot seek so zipfile writes sizes after each entry's data instead
+    sink = ArchiveSink()
+
+    with zipfile.ZipFile(sink, 'w', compression) as archive:
+        for name, entry_stat, file in entries:
+            # zip cannot store times before 1980
+            info = zipfile.ZipInfo(name + '/' if file is None else name, max(time.localtime(entry_stat.st_mtime)[:6], (1980, 1, 1, 0, 0, 0)))
+            info.external_attr = (entry_stat.st_mode & 0xFFFF) << 16
+
+            if file is None:
+                # mark as an MS-DOS directory too
+                info.external_attr |= 0x10
+
+                archive.writestr(info, b'')
+            else:
+                info.compress_type = compression
+                info.file_size = entry_stat.st_size
+
+                # entries only take a compression level from python 3.7 and zipfile only sets it for entries given by name
+                if hasattr(info, '_compresslevel'):
+                    info._compresslevel = archive_compresslevel  # pylint: disable=protected-access
+
+                with file, archive.open(info, 'w', force_zip64=entry_stat.st_size > zipfile.ZIP64_LIMIT) as dest:
+                    while True:
+                        read = file.readinto(view)
+                        if not read:
+                            break
+
+                        dest.write(view[:read])
+
+                        yield from sink.drain()
+
+            yield from sink.drain()
+
+    # central directory
+    yield from sink.drain()
+
+
+class CacheRule:
+    def __init__(self, pattern=None, *, mime=None, max_age=None, public=False, private=False, no_cache=False, no_store=False, must_revalidate=False, immutable=False, expires=True):
+        # globs without a slash match the basename and compiled regexes search the full filename
+        if pattern is None or hasattr(pattern, 'search'):
+            self.pattern = pattern
+            self.basename = False
+        else:
+            self.pattern = re.compile(fnmatch.translate(pattern))
+            self.basename = '/' not in pattern
+
+        self.mime = re.compile(fnmatch.translate(mime)) if mime else None
+
+        self.max_age = max_age
+        self.expires = expires and max_age is not None
+
+        # precompute Cache-Control value
+        directives = []
+        if public:
+            directives.append('public')
+        if private:
+            directives.append('private')
+        if no_cache:
+            directives.append('no-cache')
+        if no_store:
+            directives.append('no-store')
+        if max_age is not None:
+            directives.append('max-age=' + str(max_age))
+        if must_revalidate:
+            directives.append('must-revalidate')
+        if immutable:
+            directives.append('immutable')
+
+        self.cache_control = ', '.join(directives)
+
+        # Expires only changes once a second so remember the last one
+        self.expires_at = None
+        self.expires_value = None
+
+    def __repr__(self):
+        return '<' + self.__class__.__name__ + ' ' + repr(self.cache_control) + '>'
+
+    def match(self, filename, mime):
+        if self.pattern is not None:
+            if not self.pattern.search(os.path.basename(filename) if self.basename else filename):
+                return False
+
+        if self.mime is not None:
+            if not mime or not self.mime.match(mime):
+                return False
+
+        return True
+
+    def apply(self, headers):
+        if self.cache_control:
+            headers.set('Cache-Control', self.cache_control, True)
+
+        if self.expires:
+            now = int(time.time())
+            if now != self.expires_at:
+                self.expires_at = now
+                self.expires_value = web.mktime(time.gmtime(now + self.max_age))
+
+            headers.set('Expires', self.expires_value, True)
+
+
+class CachePolicy:
+    def __init__(self, rules=None, *, fingerprint=True, default=None, max_lookups=4096):
+        # fill in default argument values
+        if rules is None:
+            rules = []
+
+        # fingerprinted assets never change so cache them for a year
+        if fingerprint:
+            self.fingerprint = CacheRule(re.compile(fingerprint_regex), public=True, max_age=31536000, immutable=True)
+        else:
+            self.fingerprint = None
+
+        self.rules = list(rules)
+
+        if default is not None:
+            self.rules.append(default)
+
+        # (resource, mime, fingerprinted) -> rule
+        self.lookups = {}
+        self.max_lookups = max_lookups
+
+    def lookup(self, resource, mime=None, fingerprinted=False):
+        key = (resource, mime, fingerprinted)
+
+        try:
+            return self.lookups[key]
+        except KeyError:
+            pass
+
+        # only names known to be fingerprinted can be cached forever since date stamps and the like look the same
+        if fingerprinted and self.fingerprint is not None and self.fingerprint.match(resource, mime):
+            rule = self.fingerprint
+        else:
+            for rule in self.rules:
+                if rule.match(resource, mime):
+                    break
+            else:
+                rule = None
+
+        # forget everything rather than grow without bound
+        if len(self.lookups) >= self.max_lookups:
+            self.lookups.clear()
+
+        self.lookups[key] = rule
+
+        return rule
+
+    def apply(self, headers, resource, mime=None, fingerprinted=False):
+        rule = self.lookup(resource, mime, fingerprinted)
+        if rule:
+            rule.apply(headers)
+
+        return rule
+
+
+def hash_file(filename, algorithm='sha256'):
+    digest = hashlib.new(algorithm)
+
+    with open(filename, 'rb') as file:
+        file_stat = os.fstat(file.fileno())
+
+        while True:
+            chunk = file.read(1048576)
+            if not chunk:
+                break
+
+            digest.update(chunk)
+
+    return filename, digest.hexdigest(), file_stat.st_size, file_stat.st_mtime
+
+
+class ManifestEntry:
+    def __init__(self, name, fingerprinted, filename, digest, size, mtime):
+        self.name = name
+        self.fingerprinted = fingerprinted
+        self.filename = filename
+        self.digest = digest
+        self.size = size
+        self.mtime = mtime
+
+        # precompute everything needed to send the file
+        self.etag = '"' + digest + '"'
+        self.last_modified = web.mktime(time.gmtime(mtime))
+        self.mime = mimetypes.guess_type(filename)[0]
+
+    def __repr__(self):
+        return '<' + self.__class__.__name__ + ' ' + repr(self.name) + ' -> ' + repr(self.fingerprinted) + '>'
+
+
+class Manifest:
+    cache_control = 'public, max-age=31536000, immutable'
+
+    def __init__(self, local, remote='', entries=None):
+        # fill in default argument values
+        if entries is None:
+            entries = []
+
+        self.local = local.rstrip('/')
+        self.remote = remote.rstrip('/')
+
+        # logical name -> entry
+        self.entries = {}
+        # fingerprinted local filename -> entry
+        self.files = {}
+
+        for entry in entries:
+            self.add(entry)
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __iter__(self):
+        return iter(self.entries)
+
+    def __contains__(self, name):
+        return name in self.entries
+
+    def __getitem__(self, name):
+        # allows templates to use {assets[/css/style.css]}
+        return self.url(name)
+
+    def add(self, entry):
+        self.entries[entry.name] = entry
+        self.files[self.local + entry.fingerprinted] = entry
+
+    def get(self, name, default=None):
+        return self.entries.get(name, default)
+
+    def lookup(self, filename):
+        return self.files.get(filename)
+
+    def url(self, name):
+        return self.remote + urllib.parse.quote(self.entries[name].fingerprinted)
+
+
+def build_manifest(local, remote='', *, algorithm='sha256', processes=1):
+    local = local.rstrip('/')
+
+    filenames = []
+    for dirpath, _dirnames, files in os.walk(local):
+        for filename in files:
+            path = os.path.join(dirpath, filename)
+            if os.path.isfile(path):
+                filenames.append(path)
+
+    # hash in parallel if asked
+    if processes != 1:
+        with multiprocessing.get_context(web.start_method).Pool(processes) as pool:
+            hashes = pool.starmap(hash_file, ((filename, algorithm) for filename in filenames))
+    else:
+        hashes = [hash_file(filename, algorithm) for filename in filenames]
+
+    manifest = Manifest(local, remote)
+
+    for filename, digest, size, mtime in hashes:
+        name = filename[len(local):]
+
+        # insert fingerprint before the extension - /css/style.css -> /css/style.0123456789abcdef.css
+        dirname, basename = name.rsplit('/', 1)
+        stem, dot, ext = basename.rpartition('.')
+        if not stem:
+            stem, dot, ext = basename, '.', ''
+
+        fingerprinted = dirname + '/' + stem + '.' + digest[:fingerprint_length] + (dot + ext if ext else '')
+
+        manifest.add(ManifestEntry(name, fingerprinted, filename, digest, size, mtime))
+
+    return manifest
+
+
+def upload_buffer():
+    global upload_view  # pylint: disable=global-statement
+
+    # one buffer per worker process is reused for every upload
+    if upload_view is None:
+        upload_view = memoryview(bytearray(upload_buffer_size))
+
+    return upload_view
+
+
+def copy_body(rfile, file, view, length=None, offset=None):
+    copied = 0
+
+    # copy everything when no length is given
+    while length is None or copied < length:
+        read = rfile.readinto(view[:len(view) if length is None else min(length - copied, len(view))])
+        if not read:
+            break
+
+        written = 0
+        while written < read:
+            if offset is None:
+                written += file.write(view[written:read])
+            else:
+                # write in place without touching the shared file position
+                written += os.pwrite(file.fileno(), view[written:read], offset + copied + written)
+
+        copied += read
+
+    return copied
+
+
+def preallocate(fd, length):
+    if not length:
+        return False
+
+    try:
+        os.posix_fallocate(fd, 0, length)
+    except AttributeError:
+        # not available on this platform
+        return False
+    except OSError as error:
+        # filesystem cannot do it but the write will still work
+        if error.errno in (errno.EOPNOTSUPP, errno.EINVAL, errno.ENOSYS):
+            return False
+
+        raise
+
+    return True
+
+
+def sync_dir(dirname):
+    fd = os.open(dirname, os.O_RDONLY | os.O_DIRECTORY | os.O_CLOEXEC)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def lock_staging(partname, create=True, dir_fd=None):
+    while True:
+        file = open(os.open(partname, os.O_RDWR | (os.O_CREAT if create else 0) | os.O_NOFOLLOW | os.O_CLOEXEC, 0o666, dir_fd=dir_fd), 'r+b', buffering=0)
+
+        fcntl.flock(file.fileno(), fcntl.LOCK_EX)
+
+        # make sure another request did not finish the upload and move the file while waiting
+        try:
+            if os.stat(partname, dir_fd=dir_fd, follow_symlinks=False).st_ino == os.fstat(file.fileno()).st_ino:
+                return file
+        except FileNotFoundError:
+            pass
+
+        file.close()
+
+
+def still_staging(file, partname, dir_fd=None):
+    fcntl.flock(file.fileno(), fcntl.LOCK_EX)
+
+    try:
+        return os.stat(partname, dir_fd=dir_fd, follow_symlinks=False).st_ino == os.fstat(file.fileno()).st_ino
+    except FileNotFoundError:
+        return False
+
+
+def load_staging(statename, dir_fd=None):
+    try:
+        with open(os.open(statename, os.O_RDONLY | os.O_NOFOLLOW | os.O_CLOEXEC, dir_fd=dir_fd), 'r', encoding=web.default_encoding) as state:
+            return json.load(state)
+    except (FileNotFoundError, ValueError):
+        return None
+
+
+def save_staging(statename, state, dir_fd=None):
+    tmpname = statename + '.' + secrets.token_hex(8)
+
+    with open(os.open(tmpname, os.O_WRONLY | os.O_CREAT | os.O_EXCL | os.O_NOFOLLOW | os.O_CLOEXEC, 0o666, dir_fd=dir_fd), 'w', encoding=web.default_encoding) as file:
+        json.dump(state, file)
+
+    os.replace(tmpname, statename, src_dir_fd=dir_fd, dst_dir_fd=dir_fd)
+
+
+def expire_staging(dir_fd):
+    now = time.time()
+
+    # abandoned uploads would otherwise stay around forever
+    for name in os.listdir(dir_fd):
+        if not re.match(staging_regex, name):
+            continue
+
+        try:
+            if now - os.stat(name, dir_fd=dir_fd, follow_symlinks=False).st_mtime > staging_ttl:
+                os.remove(name, dir_fd=dir_fd)
+        except OSError:
+            pass
+
+
+def copy_fd(src_fd, dst_fd, size):
+    offset = 0
+
+    # let the kernel copy (or reflink) the data without it passing through userspace
+    try:
+        while offset < size:
+            copied = os.copy_file_range(src_fd, dst_fd, min(size - offset, copy_chunk_size), offset, offset)
+            if not copied:
+                break
+
+            offset += copied
+    except AttributeError:
+        # not available on this platform
+        pass
+    except OSError as error:
+        # not possible between these files so copy by hand
+        if error.errno not in (errno.EXDEV, errno.ENOSYS, errno.EOPNOTSUPP, errno.EINVAL):
+            raise
+
+    while offset < size:
+        chunk = memoryview(os.pread(src_fd, min(size - offset, upload_buffer_size), offset))
+        if not chunk:
+            break
+
+        written = 0
+        while written < len(chunk):
+            written += os.pwrite(dst_fd, chunk[written:], offset + written)
+
+        offset += written
+
+    return offset
+
+
+def copy_file(src_name, src_dir_fd, dst_name, dst_dir_fd):
+    # names are relative to the directory descriptors and neither side follows a symlink
+    src_fd = os.open(src_name, os.O_RDONLY | os.O_NOFOLLOW | os.O_CLOEXEC, dir_fd=src_dir_fd)
+    try:
+        src_stat = os.fstat(src_fd)
+
+        dst_fd = os.open(dst_name, os.O_WRONLY | os.O_CREAT | os.O_EXCL | os.O_NOFOLLOW | os.O_CLOEXEC, 0o666, dir_fd=dst_dir_fd)
+        try:
+            copy_fd(src_fd, dst_fd, src_stat.st_size)
+
+            os.fchmod(dst_fd, stat.S_IMODE(src_stat.st_mode))
+        finally:
+            os.close(dst_fd)
+    finally:
+        os.close(src_fd)
+
+
+def copy_tree(src_name, src_dir_fd, dst_name, dst_dir_fd):
+    src_fd = os.open(src_name, os.O_RDONLY | os.O_DIRECTORY | os.O_NOFOLLOW | os.O_CLOEXEC, dir_fd=src_dir_fd)
+    try:
+        os.mkdir(dst_name, 0o700, dir_fd=dst_dir_fd)
+
+        dst_fd = os.open(dst_name, os.O_RDONLY | os.O_DIRECTORY | os.O_NOFOLLOW | os.O_CLOEXEC, dir_fd=dst_dir_fd)
+        try:
+            # scandir only takes a descriptor from python 3.7
+            for name in os.listdir(src_fd):
+                mode = os.stat(name, dir_fd=src_fd, follow_symlinks=False).st_mode
+
+                # copy symlinks as they are so nothing outside of local gets pulled in
+                if stat.S_ISLNK(mode):
+                    os.symlink(os.readlink(name, dir_fd=src_fd), name, dir_fd=dst_fd)
+                elif stat.S_ISDIR(mode):
+                    copy_tree(name, src_fd, name, dst_fd)
+                elif stat.S_ISREG(mode):
+                    copy_file(name, src_fd, name, dst_fd)
+
+            # only take on the real permissions once everything is in
+            os.fchmod(dst_fd, stat.S_IMODE(os.fstat(src_fd).st_mode))
+        finally:
+            os.close(dst_fd)
+    finally:
+        os.close(src_fd)
+
+
+def remove_tree(name, dir_fd):
+    # remove bottom up relative to the directory descriptor without following symlinks
+    fd = os.open(name, os.O_RDONLY | os.O_DIRECTORY | os.O_NOFOLLOW | os.O_CLOEXEC, dir_fd=dir_fd)
+    try:
+        # scandir only takes a descriptor from python 3.7
+        for entry in os.listdir(fd):
+            if stat.S_ISDIR(os.stat(entry, dir_fd=fd, follow_symlinks=False).st_mode):
+                remove_tree(entry, fd)
+            else:
+                os.remove(entry, dir_fd=fd)
+    finally:
+        os.close(fd)
+
+    os.rmdir(name, dir_fd=dir_fd)
+
+
+def make_beneath(dir_fd, path):
+    # create and open each directory of path in turn without following symlinks
+    fd = os.open('.', os.O_RDONLY | os.O_DIRECTORY | os.O_CLOEXEC, dir_fd=dir_fd)
+
+    try:
+        for component in path.split('/'):
+            if not component:
+                continue
+
+            try:
+                os.mkdir(component, dir_fd=fd)
+            except FileExistsError:
+                pass
+
+            next_fd = os.open(component, os.O_RDONLY | os.O_DIRECTORY | os.O_NOFOLLOW | os.O_CLOEXEC, dir_fd=fd)
+            os.close(fd)
+            fd = next_fd
+    except BaseException:
+        os.close(fd)
+        raise
+
+    return fd
+
+
+def exchange(src, dst, dir_fd=None):
+    global renameat2_available  # pylint: disable=global-statement
+
+    # atomically swap two existing paths
+    if renameat2_available:
+        base_fd = at_fdcwd if dir_fd is None else dir_fd
+        if libc_renameat2(base_fd, os.fsencode(src), base_fd, os.fsencode(dst), rename_exchange) == 0:
+            return True
+
+        error = ctypes.get_errno()
+        if error not in (errno.ENOSYS, errno.EINVAL, errno.EOPNOTSUPP):
+            raise OSError(error, os.strerror(error), src)
+
+        # kernel or filesystem cannot do it
+        if error == errno.ENOSYS:
+            renameat2_available = False
+
+    # otherwise there is a short window where dst is missing
+    tmpname = dst.rstrip('/') + '.' + secrets.token_hex(8) + '.old'
+
+    os.rename(dst, tmpname, src_dir_fd=dir_fd, dst_dir_fd=dir_fd)
+
+    try:
+        os.rename(src, dst, src_dir_fd=dir_fd, dst_dir_fd=dir_fd)
+    except OSError:
+        # put the original back rather than leave nothing there
+        os.rename(tmpname, dst, src_dir_fd=dir_fd, dst_dir_fd=dir_fd)
+        raise
+
+    os.rename(tmpname, src, src_dir_fd=dir_fd, dst_dir_fd=dir_fd)
+
+    return False
+
+
+def default_trash(local):
+    # next to local so it is on the same filesystem but never served
+    local = os.path.abspath(local or '/').rstrip('/')
+
+    return os.path.join(os.path.dirname(local), '.' + os.path.basename(local) + '.trash')
+
+
+def set_priority():
+    # stay out of the way of request handling
+    try:
+        os.nice(reaper_nice)
+    except OSError:
+        pass
+
+    syscall = ioprio_syscalls.get(platform.machine())
+    if libc is None or syscall is None or not sys.platform.startswith('linux'):
+        return False
+
+    ioprio_class, ioprio_level = reaper_ioprio
+
+    return libc_syscall(syscall, ioprio_who_process, 0, (ioprio_class << ioprio_class_shift) | ioprio_level) == 0
+
+
+def save_progress(trash, name, removed):
+    tmpname = os.path.join(trash, name + '.progress.' + secrets.token_hex(8))
+
+    with open(tmpname, 'w', encoding=web.default_encoding) as file:
+        file.write(str(removed))
+
+    os.replace(tmpname, os.path.join(trash, name + '.progress'))
+
+
+def load_progress(trash, name):
+    try:
+        with open(os.path.join(trash, name + '.progress'), 'r', encoding=web.default_encoding) as file:
+            return int(file.read())
+    except (OSError, ValueError):
+        return 0
+
+
+def reap_entry(trash, name):
+    path = os.path.join(trash, name)
+
+    removed = 0
+
+    def remove(unlink, target):
+        nonlocal removed
+
+        try:
+            unlink(target)
+        except FileNotFoundError:
+            pass
+
+        removed += 1
+
+        # record progress and give the disk a rest every so often
+        if removed % reaper_batch == 0:
+            save_progress(trash, name, removed)
+            time.sleep(reaper_pause)
+
+    if os.path.isdir(path) and not os.path.islink(path):
+        # remove bottom up without following symlinks
+        for dirpath, dirnames, filenames in os.walk(path, topdown=False):
+            for filename in filenames:
+                remove(os.unlink, os.path.join(dirpath, filename))
+
+            for dirname in dirnames:
+                dirname = os.path.join(dirpath, dirname)
+                remove(os.unlink if os.path.islink(dirname) else os.rmdir, dirname)
+
+        remove(os.rmdir, path)
+    else:
+        remove(os.unlink, path)
+
+    try:
+        os.remove(os.path.join(trash, name + '.progress'))
+    except FileNotFoundError:
+        pass
+
+    return removed
+
+
+def reap(trash):
+    removed = 0
+
+    while True:
+        with open(os.path.join(trash, '.lock'), 'a') as lock:
+            # only one reaper works on a trash at a time
+            try:
+                fcntl.flock(lock.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                return removed
+
+            while True:
+                entries = [name for name in os.listdir(trash) if '.' not in name]
+                if not entries:
+                    break
 
-    # special case for trailing slashes
-    if old_path[-1] == '':
-        new_path.append('')
+                for name in entries:
+                    removed += reap_entry(trash, name)
 
-    # special case for single slash left
-    norm = '/'.join(new_path)
-    if not norm:
-        norm = '/'
+        # pick up anything trashed while another reaper gave up on the lock
+        if not any('.' not in name for name in os.listdir(trash)):
+            return removed
 
-    return norm
+
+def run_reaper(trash):
+    set_priority()
+
+    return reap(trash)
+
+
+def start_reaper(trash):
+    process = reapers.get(trash)
+    if process is not None and process.is_alive():
+        return process
+
+    process = multiprocessing.get_context(web.start_method).Process(target=run_reaper, args=(trash,), name='http-reaper', daemon=True)
+    process.start()
+
+    reapers[trash] = process
+
+    return process
 
 
 class FileHandler(web.HTTPHandler):
     filename = None
     index_files = []
     dir_index = False
+    use_mmap = False
+    cache_policy = None
+    manifest = None
+    archive = False
 
     def __init__(self, *args, **kwargs):
         self.filename = kwargs.pop('filename', self.filename)
         self.index_files = kwargs.pop('index_files', self.index_files)
         self.dir_index = kwargs.pop('dir_index', self.dir_index)
+        self.use_mmap = kwargs.pop('use_mmap', self.use_mmap)
+        self.cache_policy = kwargs.pop('cache_policy', self.cache_policy)
+        self.manifest = kwargs.pop('manifest', self.manifest)
+        self.archive = kwargs.pop('archive', self.archive)
 
         super().__init__(*args, **kwargs)
 
+    def query(self):
+        # routes from new capture the raw query string with its leading ?
+        querystr = self.groups.get('query') if isinstance(self.groups, dict) else None
+        if not querystr or not querystr.startswith('?'):
+            return {}
+
+        return dict(urllib.parse.parse_qsl(querystr[1:].partition('#')[0], True))
+
     def index(self):
         # magic for stringing together everything in the directory with a newline and adding a / at the end for directories
         return ''.join(filename + '/\n' if os.path.isdir(os.path.join(self.filename, filename)) else filename + '\n' for filename in os.listdir(self.filename))
 
+    def send_index(self):
+        return 200, self.index()
+
     def get_body(self):
         return False
 
+    def resource(self):
+        # cache rules match the path the client asked for rather than where it is on disk
+        return urllib.parse.unquote(self.request.resource.partition('?')[0].partition('#')[0])
+
+    def send_file(self, file, size, etag, last_modified, mime, fingerprinted=False):
+        length = size
+
+        self.response.headers.set('ETag', etag)
+        self.response.headers.set('Last-Modified', last_modified)
+
+        # tell client we allow selecting ranges of bytes
+        self.response.headers.set('Accept-Ranges', 'bytes')
+
+        if self.cache_policy:
+            self.cache_policy.apply(self.response.headers, self.resource(), mime, fingerprinted)
+
+        # HTTP Status 304
+        # client already has this exact file
+        if match_etag(self.request.headers.get('If-None-Match'), etag):
+            file.close()
+
+            return 304, ''
+
+        # HTTP status that changes if partial data is sent
+        status = 200
+
+        # handle range header and modify file pointer and content length as necessary
+        range_header = self.request.headers.get('Range')
+        if_range = self.request.headers.get('If-Range')
+        if range_header and (not if_range or if_range in (etag, last_modified)):
+            ranges = parse_ranges(range_header, size)
+
+            if ranges is not None:
+                # HTTP Status 416
+                if not ranges:
+                    file.close()
+
+                    error_headers = web.HTTPHeaders()
+                    error_headers.set('Content-Range', 'bytes */' + str(size))
+                    raise web.HTTPError(416, headers=error_headers)
+
+                status = 206
+
+                if len(ranges) == 1:
+                    # single range is sent directly from the file
+                    lower, upper = ranges[0]
+
+                    file.seek(lower)
+                    self.response.headers.set('Content-Range', 'bytes ' + str(lower) + '-' + str(upper) + '/' + str(size))
+                    length = upper - lower + 1
+                else:
+                    # multiple ranges are sent as a multipart body
+                    file = MultipartRangeIO(file, ranges, size, mime)
+                    length = file.length
+
+                    mime = 'multipart/byteranges; boundary=' + file.boundary
+
+        self.response.headers.set('Content-Length', str(length))
+
+        if mime:
+            self.response.headers.set('Content-Type', mime)
+
+        return status, file
+
+    def open_path(self, filename, flags=os.O_RDONLY | os.O_CLOEXEC):  # pylint: disable=no-self-use
+        return os.open(filename, flags)
+
+    def archive_entries(self):
+        root = self.filename
+
+        # directory symlinks are not followed and files go through open_path so nothing escapes
+        for dirpath, dirnames, filenames in os.walk(root):
+            dirnames.sort()
+
+            relative = dirpath[len(root):]
+
+            if relative:
+                try:
+                    yield relative, os.stat(dirpath), None
+                except OSError:
+                    continue
+
+            for filename in sorted(filenames):
+                try:
+                    fd = self.open_path(os.path.join(dirpath, filename))
+                except OSError:
+                    continue
+
+                file_stat = os.fstat(fd)
+                if not stat.S_ISREG(file_stat.st_mode):
+                    os.close(fd)
+                    continue
+
+                yield os.path.join(relative, filename), file_stat, open(fd, 'rb', buffering=0)
+
+    def send_archive(self, archive_format, store=False):
+        if archive_format not in archive_formats:
+            raise web.HTTPError(400)
+
+        # name it after the requested directory rather than anything local
+        name = (os.path.basename(urllib.parse.unquote(urllib.parse.urlsplit(self.request.resource).path).rstrip('/')) or 'index') + '.' + archive_format
+
+        self.response.headers.set('Content-Type', archive_formats[archive_format])
+        self.response.headers.set('Content-Disposition', 'attachment; filename*=UTF-8\'\'' + urllib.parse.quote(name))
+
+        if archive_format == 'zip':
+            stream = zip_stream(self.archive_entries(), zipfile.ZIP_STORED if store else zipfile.ZIP_DEFLATED)
+        else:
+            stream = tar_stream(self.archive_entries())
+
+        # generated as it is sent so no length is known and it goes out chunked
+        return 200, web.IterIO(stream)
+
+    def get_dir(self):
+        # if necessary, redirect to add trailing slash
+        if not self.filename.endswith('/'):
+            self.response.headers.set('Location', self.request.resource + '/')
+
+            return 307, ''
+
+        # stream the whole directory if asked
+        if self.archive:
+            query = self.query()
+            if 'archive' in query:
+                return self.send_archive(query['archive'], 'store' in query)
+
+        # check for index file
+        for index_file in self.index_files:
+            index = self.filename + index_file
+
+            try:
+                fd = self.open_path(index)
+            except OSError:
+                continue
+
+            index_stat = os.fstat(fd)
+            if not stat.S_ISREG(index_stat.st_mode):
+                os.close(fd)
+                continue
+
+            # return index file
+            etag = '"{:x}-{:x}"'.format(index_stat.st_mtime_ns, index_stat.st_size)
+            last_modified = web.mktime(time.gmtime(index_stat.st_mtime))
+
+            return self.send_file(open(fd, 'rb'), index_stat.st_size, etag, last_modified, mimetypes.guess_type(index)[0])
+
+        if self.dir_index:
+            if self.cache_policy:
+                self.cache_policy.apply(self.response.headers, self.resource())
+
+            # if no index and directory indexing enabled, send a generated one
+            return self.send_index()
+
+        raise web.HTTPError(403)
+
     def do_get(self):
         if '\x00' in self.filename:
             raise web.HTTPError(400)
 
         try:
-            if os.path.isdir(self.filename):
-                # if necessary, redirect to add trailing slash
-                if not self.filename.endswith('/'):
-                    self.response.headers.set('Location', self.request.resource + '/')
-
-                    return 307, ''
-
-                # check for index file
-                index = None
-                for index_file in self.index_files:
-                    if os.path.exists(self.filename + index_file) and os.path.isfile(self.filename + index_file):
-                        index = self.filename + index_file
-                        break
-
-                if index:
-                    # return index file
-                    indexfile = open(index, 'rb')
-                    self.response.headers.set('Content-Length', str(os.path.getsize(index)))
-
-                    mime = mimetypes.guess_type(index)[0]
-                    if mime:
-                        self.response.headers.set('Content-Type', mime)
-
-                    return 200, indexfile
-                elif self.dir_index:
-                    # if no index and directory indexing enabled, send a generated one
-                    return 200, self.index()
+            # serve fingerprinted names straight from the manifest without hashing or stat
+            if self.manifest is not None:
+                entry = self.manifest.lookup(self.filename)
+                if entry:
+                    file = open(entry.filename, 'rb')
+
+                    # the file changed since the manifest was built so its fingerprint is no longer true
+                    file_stat = os.fstat(file.fileno())
+                    if file_stat.st_size != entry.size or file_stat.st_mtime != entry.mtime:
+                        file.close()
+
+                        raise web.HTTPError(404)
+
+                    if not self.cache_policy:
+                        self.response.headers.set('Cache-Control', self.manifest.cache_control)
+
+                    return self.send_file(file, entry.size, entry.etag, entry.last_modified, entry.mime, True)
+
+            file = None
+
+            # try a recent shared mapping of the file if enabled
+            if self.use_mmap:
+                file, file_stat = cached_mapping(self.filename)
+
+            if file is None:
+                # resolve the path once and use the descriptor for everything else
+                fd = self.open_path(self.filename)
+
+                try:
+                    file_stat = os.fstat(fd)
+
+                    if self.use_mmap:
+                        file = open_mapped(self.filename, fd, file_stat)
+                except OSError:
+                    os.close(fd)
+                    raise
+
+                if stat.S_ISDIR(file_stat.st_mode):
+                    os.close(fd)
+
+                    return self.get_dir()
+
+                # the mapping holds its own reference to the file
+                if file is None:
+                    file = open(fd, 'rb')
                 else:
-                    raise web.HTTPError(403)
-            else:
-                file = open(self.filename, 'rb')
-
-                # get file size from metadata
-                size = os.path.getsize(self.filename)
-                length = size
-
-                # HTTP status that changes if partial data is sent
-                status = 200
-
-                # handle range header and modify file pointer and content length as necessary
-                range_header = self.request.headers.get('Range')
-                if range_header:
-                    range_match = re.match(r'bytes=(\d+)-(\d+)?', range_header)
-                    if range_match:
-                        # get lower and upper bounds
-                        lower = int(range_match.group(1))
-                        if range_match.group(2):
-                            upper = int(range_match.group(2))
-                        else:
-                            upper = size - 1
-
-                        # sanity checks
-                        if lower <= upper < size:
-                            file.seek(lower)
-                            self.response.headers.set('Content-Range', 'bytes ' + str(lower) + '-' + str(upper) + '/' + str(size))
-                            length = upper - lower + 1
-                            status = 206
-
-                self.response.headers.set('Content-Length', str(length))
-
-                # tell client we allow selecting ranges of bytes
-                self.response.headers.set('Accept-Ranges', 'bytes')
-
-                # guess MIME by extension
-                mime = mimetypes.guess_type(self.filename)[0]
-                if mime:
-                    self.response.headers.set('Content-Type', mime)
-
-                return status, file
+                    os.close(fd)
+
+            # validators for conditional requests
+            etag = '"{:x}-{:x}"'.format(file_stat.st_mtime_ns, file_stat.st_size)
+            last_modified = web.mktime(time.gmtime(file_stat.st_mtime))
+
+            # guess MIME by extension
+            mime = mimetypes.guess_type(self.filename)[0]
+
+            return self.send_file(file, file_stat.st_size, etag, last_modified, mime)
         except FileNotFoundError as error:
             raise web.HTTPError(404) from error
         except NotADirectoryError as error:
@@ -159,121 +1708,722 @@ class PathMixIn:
 
     pathstr = None
 
+    cache_missing = True
+    watch = False
+    confine = False
+
     def __init__(self, *args, **kwargs):
         self.local = kwargs.pop('local', self.local)
         self.remote = kwargs.pop('remote', self.remote)
+        self.cache_missing = kwargs.pop('cache_missing', self.cache_missing)
+        self.watch = kwargs.pop('watch', self.watch)
+        self.confine = kwargs.pop('confine', self.confine)
 
         super().__init__(*args, **kwargs)
 
+    def open_path(self, filename, flags=os.O_RDONLY | os.O_CLOEXEC):
+        # resolve relative to an open descriptor for local instead of from /
+        local = self.local.rstrip('/')
+        if not filename.startswith(local + '/'):
+            raise web.HTTPError(403)
+
+        return open_beneath(open_root(local), filename[len(local):], flags, confine=self.confine)
+
     def respond(self):
         if self.pathstr is None:
             self.pathstr = self.groups['path'] if 'path' in self.groups else ''
 
-        self.path = urllib.parse.unquote(self.pathstr)
+        self.path, norm_request = resolve(self.pathstr)
 
-        norm_request = normpath(self.path)
         if not self.path or self.path != norm_request:
             if not norm_request:
                 norm_request = '/'
 
-            self.response.headers.set('Location', self.remote.rstrip('/') + urllib.parse.quote(norm_request))
+            self.response.headers.set('Location', self.remote.rstrip('/') + quote(norm_request))
 
             return 307, ''
 
         self.filename = self.local.rstrip('/') + self.path
 
+        # make sure this worker is watching local for cache invalidation
+        if self.watch:
+            watch_local(self.local)
+
+        # HTTP Status 404
+        # answer recently missed paths without touching the filesystem again
+        if self.cache_missing and self.method in ('get', 'head') and is_missing(self.filename):
+            raise web.HTTPError(404)
+
         return super().respond()
 
+    def do_get(self):
+        try:
+            return super().do_get()
+        except web.HTTPError as error:
+            if error.code == 404 and self.cache_missing:
+                remember_missing(self.filename)
+
+            raise
+
 
 class PathHandler(PathMixIn, FileHandler):
     pass
 
 
 class ModifyMixIn:
+    fsync = None
+
+    def __init__(self, *args, **kwargs):
+        self.fsync = kwargs.pop('fsync', self.fsync)
+
+        super().__init__(*args, **kwargs)
+
+        # ranged writes to the same file coordinate among themselves so let them run in parallel
+        if self.method in ('put', 'patch') and self.request.headers.get('Content-Range'):
+            self.reader = self.reader + [self.method]
+
+    def do_get(self):
+        # staging files of ranged uploads are not for serving
+        if self.filename and re.match(staging_regex, os.path.basename(self.filename)):
+            raise web.HTTPError(404)
+
+        return super().do_get()
+
+    def send_continue(self):
+        # send a 100 continue if expected
+        if self.request.headers.get('Expect') == '100-continue':
+            self.check_continue()
+            self.response.wfile.write((web.http_version[-1] + ' 100 ' + web.status_messages[100] + '\r\n\r\n').encode(web.http_encoding))
+            self.response.wfile.flush()
+
+    def body(self, limit):
+        if self.request.headers.get('Transfer-Encoding') and self.request.headers['Transfer-Encoding'].lower() == 'chunked':
+            return BodyIO(self.request.rfile, limit=limit)
+        elif self.request.headers.get('Content-Length'):
+            try:
+                length = int(self.request.headers['Content-Length'])
+            except ValueError as error:
+                raise web.HTTPError(400) from error
+
+            if length > limit:
+                raise web.HTTPError(413)
+
+            return BodyIO(self.request.rfile, length)
+        else:
+            return BodyIO(self.request.rfile, 0)
+
+    def write_body(self, file):
+        body = self.body(max_file_size)
+
+        # reserve the space up front so the file is laid out contiguously and a full disk fails early
+        if body.length:
+            preallocate(file.fileno(), body.length)
+
+        copy_body(body, file, upload_buffer())
+
+    def open_dir(self, dirname, create=False):
+        # directories are resolved through open_path so changes are confined as much as reads
+        if create:
+            self.make_dirs(dirname)
+
+        return self.open_path(dirname.rstrip('/') + '/', os.O_RDONLY | os.O_DIRECTORY | os.O_CLOEXEC)
+
+    def extract_body(self, dir_fd):
+        view = upload_buffer()
+
+        body = self.body(max_archive_size)
+
+        # a small compressed body can unpack to far more so limit what comes out too
+        members = 0
+        extracted = 0
+
+        # members usually come grouped by directory so keep the last one open
+        parent = None
+        parent_fd = None
+
+        try:
+            # let tarfile work out any compression itself while reading the body as a stream
+            with tarfile.open(fileobj=body, mode='r|*') as archive:
+                for member in archive:
+                    if '\x00' in member.name:
+                        raise web.HTTPError(400)
+
+                    members += 1
+                    extracted += member.size
+
+                    # HTTP Status 413
+                    if members > max_extract_members or extracted > max_extract_size:
+                        raise web.HTTPError(413)
+
+                    # keep every entry beneath the directory
+                    name = normpath('/' + member.name).strip('/')
+                    if not name:
+                        continue
+
+                    if member.isdir():
+                        fd = make_beneath(dir_fd, name)
+                        try:
+                            os.fchmod(fd, member.mode & 0o777 | stat.S_IRWXU)
+                        finally:
+                            os.close(fd)
+                    elif member.isfile():
+                        if member.size > max_file_size:
+                            raise web.HTTPError(413)
+
+                        dirname, _, basename = name.rpartition('/')
+
+                        if dirname != parent or parent_fd is None:
+                            if parent_fd is not None:
+                                os.close(parent_fd)
+                                parent_fd = None
+
+                            parent_fd = make_beneath(dir_fd, dirname)
+                            parent = dirname
+
+                        with open(os.open(basename, os.O_WRONLY | os.O_CREAT | os.O_TRUNC | os.O_NOFOLLOW | os.O_CLOEXEC, member.mode & 0o777 | stat.S_IRUSR | stat.S_IWUSR, dir_fd=parent_fd), 'wb', buffering=0) as file:
+                            preallocate(file.fileno(), member.size)
+                            copy_body(archive.extractfile(member), file, view, member.size)
+
+                            os.utime(file.fileno(), (member.mtime, member.mtime))
+                    else:
+                        # links and special files could point anywhere
+                        raise web.HTTPError(400)
+        except tarfile.TarError as error:
+            raise web.HTTPError(400) from error
+        finally:
+            if parent_fd is not None:
+                os.close(parent_fd)
+
+        # tarfile stops at the end of archive marker so skip any padding after it
+        while body.readinto(view):
+            pass
+
+    def put_archive(self):
+        dirname = self.filename.rstrip('/')
+
+        # the swap needs a parent inside local
+        if isinstance(self, PathMixIn) and dirname == self.local.rstrip('/'):
+            raise web.HTTPError(403)
+
+        parent, basename = os.path.split(dirname)
+
+        dir_fd = self.open_dir(parent, True)
+
+        try:
+            try:
+                target_stat = os.stat(basename, dir_fd=dir_fd)
+            except FileNotFoundError:
+                target_stat = None
+
+            if target_stat and (not stat.S_ISDIR(target_stat.st_mode) or not os.access(basename, os.W_OK, dir_fd=dir_fd)):
+                raise web.HTTPError(403)
+
+            self.send_continue()
+
+            # fill a temporary directory next to the target so readers never see a partial tree
+            tmpname = '.' + basename + '.' + secrets.token_hex(8) + '.extract'
+
+            os.mkdir(tmpname, dir_fd=dir_fd)
+
+            try:
+                tmp_fd = os.open(tmpname, os.O_RDONLY | os.O_DIRECTORY | os.O_NOFOLLOW | os.O_CLOEXEC, dir_fd=dir_fd)
+                try:
+                    self.extract_body(tmp_fd)
+
+                    if target_stat:
+                        os.fchmod(tmp_fd, stat.S_IMODE(target_stat.st_mode))
+                finally:
+                    os.close(tmp_fd)
+
+                if target_stat:
+                    # swap the old tree out for the new one
+                    exchange(tmpname, basename, dir_fd)
+                else:
+                    os.rename(tmpname, basename, src_dir_fd=dir_fd, dst_dir_fd=dir_fd)
+            finally:
+                # clean up either the old tree or a failed extraction
+                try:
+                    remove_tree(tmpname, dir_fd)
+                except OSError:
+                    pass
+
+            if self.fsync == 'full':
+                os.fsync(dir_fd)
+        finally:
+            os.close(dir_fd)
+
+        invalidate(None)
+
+        return 204, ''
+
+    def put_range(self, dir_fd, target_stat):
+        content_range = parse_content_range(self.request.headers['Content-Range'])
+        if content_range is None:
+            raise web.HTTPError(400)
+
+        lower, upper, total = content_range
+
+        if total > max_file_size:
+            raise web.HTTPError(413)
+
+        # each upload stages into its own file named by a token that the client sends back in If-Match
+        if_match = self.request.headers.get('If-Match')
+        if if_match is None:
+            token = secrets.token_hex(16)
+        else:
+            token = if_match.strip().strip('"')
+
+            # HTTP Status 412
+            # not a token this handler could have made
+            if not re.fullmatch('[0-9a-f]{32}', token):
+                raise web.HTTPError(412)
+
+        partname = '.' + os.path.basename(self.filename) + '.' + token + '.partial'
+        statename = partname + '.ranges'
+
+        if lower is None:
+            # HTTP Status 400
+            # uploads start with an actual range so an empty request cannot reserve space
+            if total and if_match is None:
+                raise web.HTTPError(400)
+
+            # only report what has been received so far of a started upload
+            if total:
+                state = load_staging(statename, dir_fd)
+                if not state:
+                    raise web.HTTPError(412)
+
+                self.check_staging(state, total)
+
+                return self.range_status(state['ranges'], token)
+        else:
+            # HTTP Status 416
+            if upper >= total:
+                error_headers = web.HTTPHeaders()
+                error_headers.set('Content-Range', 'bytes */' + str(total))
+
+                raise web.HTTPError(416, headers=error_headers)
+
+            # the body must be exactly the range
+            try:
+                length = int(self.request.headers.get('Content-Length', ''))
+            except ValueError as error:
+                raise web.HTTPError(411) from error
+
+            if length != upper - lower + 1:
+                raise web.HTTPError(400)
+
+        # starting an upload is a good time to clear out abandoned ones
+        if if_match is None:
+            expire_staging(dir_fd)
+
+        try:
+            file = lock_staging(partname, if_match is None, dir_fd)
+        except FileNotFoundError as error:
+            # the upload was finished or never started
+            raise web.HTTPError(412) from error
+
+        with file:
+            state = load_staging(statename, dir_fd)
+            if state:
+                self.check_staging(state, total)
+            elif if_match is not None:
+                raise web.HTTPError(412)
+            else:
+                state = {'length': total, 'ranges': []}
+
+                os.ftruncate(file.fileno(), 0)
+                preallocate(file.fileno(), total)
+                os.ftruncate(file.fileno(), total)
+
+                save_staging(statename, state, dir_fd)
+
+            # let other ranges be written while this one streams in
+            fcntl.flock(file.fileno(), fcntl.LOCK_UN)
+
+            if lower is not None and copy_body(self.request.rfile, file, upload_buffer(), length, lower) != length:
+                raise web.HTTPError(400)
+
+            # another request already completed the upload
+            if not still_staging(file, partname, dir_fd):
+                return 204, ''
+
+            state = load_staging(statename, dir_fd) or state
+
+            if lower is not None:
+                state['ranges'] = add_range(state['ranges'], lower, upper)
+
+            if total and state['ranges'] != [[0, total - 1]]:
+                save_staging(statename, state, dir_fd)
+
+                return self.range_status(state['ranges'], token)
+
+            # keep the permissions of the file being replaced
+            if target_stat:
+                os.fchmod(file.fileno(), stat.S_IMODE(target_stat.st_mode))
+
+            if self.fsync:
+                os.fsync(file.fileno())
+
+            # atomically swap in the finished file
+            os.replace(partname, os.path.basename(self.filename), src_dir_fd=dir_fd, dst_dir_fd=dir_fd)
+            os.remove(statename, dir_fd=dir_fd)
+
+        if self.fsync == 'full':
+            # make the rename itself durable
+            os.fsync(dir_fd)
+
+        invalidate(self.filename)
+
+        return 204, ''
+
+    def check_staging(self, state, total):  # pylint: disable=no-self-use
+        # HTTP Status 416
+        # ranges of some other upload
+        if state['length'] != total:
+            error_headers = web.HTTPHeaders()
+            error_headers.set('Content-Range', 'bytes */' + str(state['length']))
+
+            raise web.HTTPError(416, headers=error_headers)
+
+    def range_status(self, ranges, token):
+        # the token identifies this upload for the rest of its ranges
+        self.response.headers.set('ETag', '"' + token + '"')
+
+        # tell the client which ranges are still needed
+        if ranges:
+            self.response.headers.set('Range', format_ranges(ranges))
+
+        return 202, ''
+
     def do_put(self):
         if '\x00' in self.filename:
             raise web.HTTPError(400)
 
         try:
+            # unpack archives sent to a directory
+            if self.filename.endswith('/') and self.request.headers.get('Content-Type', '').partition(';')[0].strip().lower() in archive_types:
+                return self.put_archive()
+
             # make sure directories are there (including the given one if not given a file)
-            os.makedirs(os.path.dirname(self.filename), exist_ok=True)
+            dirname, basename = os.path.split(self.filename)
 
-            # send a 100 continue if expected
-            if self.request.headers.get('Expect') == '100-continue':
-                self.check_continue()
-                self.response.wfile.write((web.http_version[-1] + ' 100 ' + web.status_messages[100] + '\r\n\r\n').encode(web.http_encoding))
-                self.response.wfile.flush()
+            dir_fd = self.open_dir(dirname, True)
 
-            # open (possibly new) file and fill it with request body
-            with open(self.filename, 'wb') as file:
-                if self.request.headers.get('Transfer-Encoding') and self.request.headers['Transfer-Encoding'].lower() == 'chunked':
-                    request_length = 0
+            try:
+                # refuse to replace directories or files that could not have been written in place
+                if not basename:
+                    raise web.HTTPError(403)
 
-                    while True:
-                        length_str = self.request.rfile.readline().decode(web.http_encoding)
-                        if length_str[-2:] != '\r\n':
-                            raise web.HTTPError(400)
+                try:
+                    target_stat = os.stat(basename, dir_fd=dir_fd)
+                except FileNotFoundError:
+                    target_stat = None
 
-                        try:
-                            length = int(length_str[:-2], 16)
-                        except ValueError as error:
-                            raise web.HTTPError(400) from error
+                if target_stat and (stat.S_ISDIR(target_stat.st_mode) or not os.access(basename, os.W_OK, dir_fd=dir_fd)):
+                    raise web.HTTPError(403)
 
-                        if not length:
-                            break
+                self.send_continue()
 
-                        request_length += length
+                # write part of the file in place
+                if self.request.headers.get('Content-Range'):
+                    return self.put_range(dir_fd, target_stat)
 
-                        if request_length > max_file_size:
-                            raise web.HTTPError(413)
+                # fill a temporary file next to the target so readers never see a partial upload
+                tmpname = '.' + basename + '.' + secrets.token_hex(8) + '.upload'
 
-                        chunk = self.request.rfile.read(length)
-                        if not chunk or len(chunk) != length:
-                            raise web.HTTPError(400)
+                try:
+                    with open(os.open(tmpname, os.O_WRONLY | os.O_CREAT | os.O_EXCL | os.O_NOFOLLOW | os.O_CLOEXEC, 0o666, dir_fd=dir_fd), 'wb', buffering=0) as file:
+                        # keep the permissions of the file being replaced
+                        if target_stat:
+                            os.fchmod(file.fileno(), stat.S_IMODE(target_stat.st_mode))
 
-                        file.write(chunk)
+                        self.write_body(file)
 
-                        line = self.request.rfile.readline().decode(web.http_encoding)
+                        if self.fsync:
+                            os.fsync(file.fileno())
 
-                        if line != '\r\n':
-                            raise web.HTTPError(400)
+                    # atomically swap in the new file
+                    os.replace(tmpname, basename, src_dir_fd=dir_fd, dst_dir_fd=dir_fd)
+                except BaseException:
+                    try:
+                        os.remove(tmpname, dir_fd=dir_fd)
+                    except OSError:
+                        pass
 
-                    line = self.request.rfile.readline().decode(web.http_encoding)
+                    raise
 
-                    if line != '\r\n':
-                        raise web.HTTPError(400)
-                elif self.request.headers.get('Content-Length'):
-                    bytes_left = int(self.request.headers['Content-Length'])
+                if self.fsync == 'full':
+                    # make the rename itself durable
+                    os.fsync(dir_fd)
+            finally:
+                os.close(dir_fd)
 
-                    if bytes_left > max_file_size:
-                        raise web.HTTPError(413)
+            invalidate(self.filename)
 
-                    while True:
-                        chunk = self.request.rfile.read(min(bytes_left, web.stream_chunk_size))
-                        if not chunk:
-                            break
+            return 204, ''
+        except OSError as error:
+            if error.errno in (errno.ENOSPC, errno.EDQUOT):
+                raise web.HTTPError(507) from error
+
+            raise web.HTTPError(403) from error
 
-                        bytes_left -= len(chunk)
+    def do_patch(self):
+        # only ranged writes make sense as a patch
+        if not self.request.headers.get('Content-Range'):
+            raise web.HTTPError(400)
 
-                        file.write(chunk)
+        return self.do_put()
 
-            return 204, ''
+    def destination(self):
+        destination = self.request.headers.get('Destination')
+        if not destination or '\x00' in destination:
+            raise web.HTTPError(400)
+
+        # only handlers that map paths onto local can work out where the destination is
+        if not isinstance(self, PathMixIn):
+            raise web.HTTPError(403)
+
+        # HTTP Status 403
+        # destination must be served by this handler too
+        path = urllib.parse.urlsplit(destination).path
+        remote = self.remote.rstrip('/')
+        if path != remote and not path.startswith(remote + '/'):
+            raise web.HTTPError(403)
+
+        _, norm_destination = resolve(path[len(remote):] or '/')
+
+        filename = self.local.rstrip('/') + norm_destination
+
+        # refuse to copy or move a file onto or into itself
+        source = self.filename.rstrip('/')
+        if filename.rstrip('/') == source or filename.startswith(source + '/'):
+            raise web.HTTPError(403)
+
+        return filename
+
+    def transfer(self, move):
+        if '\x00' in self.filename:
+            raise web.HTTPError(400)
+
+        destination = self.destination()
+
+        src_dirname, src_basename = os.path.split(self.filename.rstrip('/'))
+        dst_dirname, dst_basename = os.path.split(destination.rstrip('/'))
+
+        src_dir_fd = None
+        dst_dir_fd = None
+
+        try:
+            # resolve both sides relative to local so a symlink cannot take either outside of it
+            src_dir_fd = self.open_dir(src_dirname)
+            src_stat = os.stat(src_basename, dir_fd=src_dir_fd, follow_symlinks=not move)
+
+            dst_dir_fd = self.open_dir(dst_dirname, True)
+
+            try:
+                dst_stat = os.stat(dst_basename, dir_fd=dst_dir_fd, follow_symlinks=False)
+            except FileNotFoundError:
+                dst_stat = None
+
+            if dst_stat:
+                # HTTP Status 412
+                if self.request.headers.get('Overwrite', 'T').upper() == 'F':
+                    raise web.HTTPError(412)
+
+                # a file cannot simply replace a directory (or vice versa) so clear it out of the way
+                if stat.S_ISDIR(dst_stat.st_mode):
+                    remove_tree(dst_basename, dst_dir_fd)
+                elif stat.S_ISDIR(src_stat.st_mode):
+                    os.remove(dst_basename, dir_fd=dst_dir_fd)
+
+            renamed = False
+            if move:
+                try:
+                    # within a filesystem a move is just a rename
+                    os.rename(src_basename, dst_basename, src_dir_fd=src_dir_fd, dst_dir_fd=dst_dir_fd)
+                    renamed = True
+                except OSError as error:
+                    # across filesystems it has to be copied instead
+                    if error.errno != errno.EXDEV:
+                        raise
+
+            if not renamed:
+                self.copy(src_stat, src_dir_fd, src_basename, dst_dir_fd, dst_basename)
+
+                # finish a move across filesystems by removing the source
+                if move:
+                    if stat.S_ISDIR(src_stat.st_mode):
+                        remove_tree(src_basename, src_dir_fd)
+                    else:
+                        os.remove(src_basename, dir_fd=src_dir_fd)
+
+            if self.fsync == 'full':
+                # make the new entries durable
+                os.fsync(dst_dir_fd)
+                if move:
+                    os.fsync(src_dir_fd)
+
+            invalidate(destination.rstrip('/'))
+            if move:
+                invalidate(self.filename.rstrip('/'))
+
+            # HTTP Status 201 for a new resource or 204 for a replaced one
+            return (204 if dst_stat else 201), ''
+        except FileNotFoundError as error:
+            raise web.HTTPError(404) from error
         except OSError as error:
+            if error.errno in (errno.ENOSPC, errno.EDQUOT):
+                raise web.HTTPError(507) from error
+
             raise web.HTTPError(403) from error
+        finally:
+            if src_dir_fd is not None:
+                os.close(src_dir_fd)
+            if dst_dir_fd is not None:
+                os.close(dst_dir_fd)
+
+    def make_dirs(self, dirname):
+        # create missing directories one at a time through open_path so none can be made outside of local
+        try:
+            os.close(self.open_path(dirname + '/', os.O_RDONLY | os.O_DIRECTORY | os.O_CLOEXEC))
+            return
+        except FileNotFoundError:
+            pass
+
+        parent, name = os.path.split(dirname.rstrip('/'))
+
+        self.make_dirs(parent)
+
+        parent_fd = self.open_path(parent + '/', os.O_RDONLY | os.O_DIRECTORY | os.O_CLOEXEC)
+        try:
+            os.mkdir(name, dir_fd=parent_fd)
+        except FileExistsError:
+            pass
+        finally:
+            os.close(parent_fd)
+
+    def copy(self, src_stat, src_dir_fd, src_basename, dst_dir_fd, dst_basename):
+        tmpname = '.' + dst_basename + '.' + secrets.token_hex(8) + '.copy'
+
+        try:
+            if stat.S_ISDIR(src_stat.st_mode):
+                # only the collection itself for Depth: 0
+                if self.request.headers.get('Depth', 'infinity') == '0':
+                    os.mkdir(tmpname, stat.S_IMODE(src_stat.st_mode), dir_fd=dst_dir_fd)
+                else:
+                    copy_tree(src_basename, src_dir_fd, tmpname, dst_dir_fd)
+            else:
+                src_fd = self.open_path(self.filename)
+                try:
+                    dst_fd = os.open(tmpname, os.O_WRONLY | os.O_CREAT | os.O_EXCL | os.O_CLOEXEC, 0o666, dir_fd=dst_dir_fd)
+                    try:
+                        os.fchmod(dst_fd, stat.S_IMODE(src_stat.st_mode))
+
+                        copy_fd(src_fd, dst_fd, src_stat.st_size)
+
+                        if self.fsync:
+                            os.fsync(dst_fd)
+                    finally:
+                        os.close(dst_fd)
+                finally:
+                    os.close(src_fd)
+
+            # atomically swap in the copy
+            os.replace(tmpname, dst_basename, src_dir_fd=dst_dir_fd, dst_dir_fd=dst_dir_fd)
+        except BaseException:
+            try:
+                if stat.S_ISDIR(os.stat(tmpname, dir_fd=dst_dir_fd, follow_symlinks=False).st_mode):
+                    remove_tree(tmpname, dst_dir_fd)
+                else:
+                    os.remove(tmpname, dir_fd=dst_dir_fd)
+            except OSError:
+                pass
+
+            raise
+
+    def do_copy(self):
+        return self.transfer(False)
+
+    def do_move(self):
+        return self.transfer(True)
 
 
 class DeleteMixIn:
+    trash = None
+    trash_progress = False
+
+    def __init__(self, *args, **kwargs):
+        self.trash = kwargs.pop('trash', self.trash)
+        self.trash_progress = kwargs.pop('trash_progress', self.trash_progress)
+
+        super().__init__(*args, **kwargs)
+
+    def delete_status(self, name):
+        if not re.match('^[0-9a-f]{16}$', name):
+            raise web.HTTPError(400)
+
+        self.response.headers.set('Content-Type', 'application/json')
+
+        return 200, json.dumps({'removed': load_progress(self.trash, name), 'done': not os.path.lexists(os.path.join(self.trash, name))})
+
+    def do_get(self):
+        # report on a background delete
+        if self.trash and self.trash_progress:
+            query = self.query()
+            if 'deleting' in query:
+                return self.delete_status(query['deleting'])
+
+        return super().do_get()
+
     def do_delete(self):
         if '\x00' in self.filename:
             raise web.HTTPError(400)
 
+        dirname, basename = os.path.split(self.filename.rstrip('/'))
+
         try:
-            if os.path.isdir(self.filename):
-                # recursively remove directory
-                shutil.rmtree(self.filename)
-            else:
-                # remove single file
-                os.remove(self.filename)
+            # work relative to the parent so deletes are confined as much as reads
+            dir_fd = self.open_path(dirname + '/', os.O_RDONLY | os.O_DIRECTORY | os.O_CLOEXEC)
+
+            try:
+                if self.trash:
+                    name = secrets.token_hex(8)
+
+                    try:
+                        os.makedirs(self.trash, exist_ok=True)
+
+                        # move it out of the way at once and leave the actual removal to the reaper
+                        os.rename(basename, os.path.join(self.trash, name), src_dir_fd=dir_fd)
+                    except FileNotFoundError:
+                        raise
+                    except OSError:
+                        # trash cannot be made or is on another filesystem so remove it here
+                        name = None
+
+                    if name:
+                        invalidate(self.filename.rstrip('/'))
+
+                        start_reaper(self.trash)
+
+                        if self.trash_progress:
+                            # point the client at where progress can be followed
+                            self.response.headers.set('Location', getattr(self, 'remote', '').rstrip('/') + '/?deleting=' + name)
+
+                            return 202, ''
+
+                        return 204, ''
+
+                if stat.S_ISDIR(os.stat(basename, dir_fd=dir_fd, follow_symlinks=False).st_mode):
+                    # recursively remove directory
+                    remove_tree(basename, dir_fd)
+                else:
+                    # remove single file
+                    os.remove(basename, dir_fd=dir_fd)
+            finally:
+                os.close(dir_fd)
+
+            invalidate(self.filename.rstrip('/'))
 
             return 204, ''
         except FileNotFoundError as error:
@@ -290,7 +2440,7 @@ class ModifyPathHandler(ModifyMixIn, DeleteMixIn, PathHandler):
     pass
 
 
-def new(local, remote='', *, index_files=None, dir_index=False, modify=False, handler=None):
+def new(local, remote='', *, index_files=None, dir_index=False, modify=False, use_mmap=False, cache_policy=None, manifest=None, cache_missing=True, watch=False, confine=False, archive=False, fsync=None, trash=None, trash_progress=False, handler=None):
     # set the appropriate defaults depending on arguments supplied
     if not handler:
         if modify:
@@ -301,7 +2451,16 @@ def new(local, remote='', *, index_files=None, dir_index=False, modify=False, ha
     if index_files is None:
         index_files = ['index.html'] if dir_index else []
 
-    return {remote.rstrip('/') + r'(?P<path>|/[^?#]*)(?P<query>[?#].*)?': web.HTTPHandlerWrapper(handler, local=local.rstrip('/'), remote=remote.rstrip('/'), index_files=index_files, dir_index=dir_index)}
+    # only pass modification options that were asked for since only modifying handlers take them
+    modify_args = {}
+    if fsync is not None:
+        modify_args['fsync'] = fsync
+    if trash:
+        modify_args['trash'] = default_trash(local) if trash is True else trash
+    if trash_progress:
+        modify_args['trash_progress'] = trash_progress
+
+    return {remote.rstrip('/') + r'(?P<path>|/[^?#]*)(?P<query>[?#].*)?': web.HTTPHandlerWrapper(handler, local=local.rstrip('/'), remote=remote.rstrip('/'), index_files=index_files, dir_index=dir_index, use_mmap=use_mmap, cache_policy=cache_policy, manifest=manifest, cache_missing=cache_missing, watch=watch, confine=confine, archive=archive, **modify_args)}
 
 
 if __name__ == '__main__':
@@ -313,12 +2472,17 @@ if __name__ == '__main__':
     parser.add_argument('-a', '--address', default='localhost', dest='address', help='address to serve HTTP on (default: \'localhost\')')
     parser.add_argument('-p', '--port', default=8000, type=int, dest='port', help='port to serve HTTP on (default: 8000)')
     parser.add_argument('--no-index', action='store_false', default=True, dest='indexing', help='disable directory listings')
-    parser.add_argument('--allow-modify', action='store_true', default=False, dest='modify', help='allow file and directory modifications using PUT and DELETE methods')
+    parser.add_argument('--allow-modify', action='store_true', default=False, dest='modify', help='allow file and directory modifications using PUT, PATCH, COPY, MOVE, and DELETE methods')
+    parser.add_argument('--mmap', action='store_true', default=False, dest='use_mmap', help='serve medium-sized files from per-worker memory maps')
+    parser.add_argument('--confine', action='store_true', default=False, dest='confine', help='refuse to follow symlinks out of the local directory')
+    parser.add_argument('--archive', action='store_true', default=False, dest='archive', help='allow downloading directories as tar or zip archives with ?archive=tar or ?archive=zip')
+    parser.add_argument('--fsync', choices=['file', 'full'], default=None, dest='fsync', help='flush uploaded files (and with \'full\' their directory entries) to disk before responding')
+    parser.add_argument('--trash', action='store_true', default=None, dest='trash', help='delete by moving into a trash directory next to the local directory and removing it in the background')
     parser.add_argument('local_dir', nargs='?', default='.', help='local directory to serve over HTTP (default: \'.\')')
 
     cli = parser.parse_args()
 
-    httpd = web.HTTPServer((cli.address, cli.port), new(cli.local_dir, dir_index=cli.indexing, modify=cli.modify))
+    httpd = web.HTTPServer((cli.address, cli.port), new(cli.local_dir, dir_index=cli.indexing, modify=cli.modify, use_mmap=cli.use_mmap, confine=cli.confine, archive=cli.archive, fsync=cli.fsync, trash=cli.trash))
     httpd.start()
 
     signal.signal(signal.SIGINT, lambda signum, frame: httpd.close())
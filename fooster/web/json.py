@@ -1,25 +1,249 @@
+import collections.abc
+import itertools
 import json
 
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
 from fooster import web
 
 
-__all__ = ['JSONMixIn', 'JSONHandler', 'JSONErrorMixIn', 'JSONErrorHandler', 'new_error']
+__all__ = ['stream_length', 'stream_batch_length', 'join_chunks', 'JSONCodec', 'ORJSONCodec', 'codecs', 'default_codec', 'register_codec', 'get_codec', 'iterencode', 'JSONMixIn', 'JSONHandler', 'JSONErrorMixIn', 'JSONErrorHandler', 'new_error']
+
+
+# containers with more top level items than this are streamed
+stream_length = 1024
+
+# top level items in the first batch encoded at once while streaming
+stream_batch_length = 16
+
+
+def join_chunks(start, pieces, end, separator):
+    # gather encoded items up to the stream chunk size
+    chunk = [start]
+    size = 0
+
+    for idx, piece in enumerate(pieces):
+        if idx:
+            chunk.append(separator)
+
+        chunk.append(piece)
+        size += len(piece)
+
+        if size >= web.stream_chunk_size:
+            yield b''.join(chunk)
+
+            chunk.clear()
+            size = 0
+
+    chunk.append(end)
+
+    yield b''.join(chunk)
+
+
+class JSONCodec:
+    def __init__(self, separators=None, default=None, sort_keys=False):
+        self.encoder = json.JSONEncoder(separators=separators, default=default, sort_keys=sort_keys)
+
+        self.item_separator = self.encoder.item_separator.encode(web.default_encoding)
+
+    def dumps(self, body):
+        return self.encoder.encode(body).encode(web.default_encoding)
+
+    def batches(self, items, container):
+        # the incremental encoder is pure python so encode batches of items through the c encoder instead
+        batch = stream_batch_length
+        idx = 0
+
+        while idx < len(items):
+            piece = self.encoder.encode(container(items[idx:idx + batch]))[1:-1].encode(web.default_encoding)
+
+            yield piece
+
+            idx += batch
+
+            # size the next batch to come out at around half the stream chunk size so chunks stay near it
+            batch = max(batch * web.stream_chunk_size // (2 * max(len(piece), 1)), 1)
+
+    def chunks(self, body):
+        if isinstance(body, (list, tuple)):
+            yield from join_chunks(b'[', self.batches(body, tuple), b']', self.item_separator)
+        elif isinstance(body, dict):
+            items = sorted(body.items()) if self.encoder.sort_keys else list(body.items())
+
+            yield from join_chunks(b'{', self.batches(items, dict), b'}', self.item_separator)
+        else:
+            yield self.dumps(body)
+
+    def loads(self, body):  # pylint: disable=no-self-use
+        # json detects the encoding of bytes itself
+        return json.loads(body)
+
+
+class ORJSONCodec:
+    def __init__(self, separators=None, default=None, sort_keys=False):
+        if orjson is None:
+            raise ImportError('orjson is not installed')
+
+        # orjson only writes compact output
+        if separators is not None and tuple(separators) != (',', ':'):
+            raise ValueError('orjson only supports compact separators')
+
+        self.default = default
+        self.sort_keys = sort_keys
+
+        # stdlib json turns non-string keys into strings too
+        self.option = orjson.OPT_NON_STR_KEYS
+        if sort_keys:
+            self.option |= orjson.OPT_SORT_KEYS
+
+        self.item_separator = b','
+
+    def dumps(self, body):
+        return orjson.dumps(body, default=self.default, option=self.option)
+
+    def key(self, item):
+        # order keys by their string form like orjson does for non-string keys
+        return self.dumps({item[0]: None})[2:-7]
+
+    def chunks(self, body):
+        # there is no incremental encoder so large containers are encoded an item at a time
+        if isinstance(body, (list, tuple)):
+            start, end = b'[', b']'
+            pieces = (self.dumps(item) for item in body)
+        elif isinstance(body, dict):
+            start, end = b'{', b'}'
+            items = sorted(body.items(), key=self.key) if self.sort_keys else body.items()
+            pieces = (self.dumps({key: value})[1:-1] for key, value in items)
+        else:
+            yield self.dumps(body)
+            return
+
+        yield from join_chunks(start, pieces, end, self.item_separator)
+
+    def loads(self, body):  # pylint: disable=no-self-use
+        return orjson.loads(body)
+
+
+# name -> codec class
+codecs = {'json': JSONCodec}
+
+if orjson is not None:
+    codecs['orjson'] = ORJSONCodec
+
+# stdlib json unless a handler asks for another codec
+default_codec = 'json'
+
+# per-process cache of (name, options) -> codec
+compiled = {}
+
+
+def register_codec(name, codec):
+    codecs[name] = codec
+
+
+def get_codec(name=None, **options):
+    if name is None:
+        name = default_codec
+
+    # options are compiled into a codec once and shared by every handler using them
+    key = (name, tuple(sorted((option, tuple(value) if isinstance(value, (list, tuple)) else value) for option, value in options.items())))
+
+    codec = compiled.get(key)
+    if codec is None:
+        codec = codecs[name](**options)
+        compiled[key] = codec
+
+    return codec
+
+
+def iterencode(body, lines=False, codec=None):
+    if codec is None:
+        codec = get_codec()
+
+    if not isinstance(body, collections.abc.Iterator):
+        yield from codec.chunks(body)
+        return
+
+    # iterators become an array or one document per line
+    separator = b'\n' if lines else codec.item_separator
+
+    pieces = [] if lines else [b'[']
+    size = 0
+
+    for idx, item in enumerate(body):
+        if idx and not lines:
+            pieces.append(separator)
+
+        piece = codec.dumps(item)
+        pieces.append(piece)
+        size += len(piece)
+
+        if lines:
+            pieces.append(separator)
+
+        if size >= web.stream_chunk_size:
+            yield b''.join(pieces)
+
+            pieces.clear()
+            size = 0
+
+    if not lines:
+        pieces.append(b']')
+
+    if pieces:
+        yield b''.join(pieces)
 
 
 class JSONMixIn:
+    json_codec = None
+    json_options = {}
+    json_lines = False
+    json_stream_length = stream_length
+
+    def __init__(self, *args, **kwargs):
+        self.json_codec = kwargs.pop('json_codec', self.json_codec)
+        self.json_options = kwargs.pop('json_options', self.json_options)
+
+        super().__init__(*args, **kwargs)
+
+        self.codec = get_codec(self.json_codec, **self.json_options)
+
     def encode(self, body):
         if body is None:
             return super().encode(''.encode(web.default_encoding))
 
+        if isinstance(body, collections.abc.Iterator):
+            self.response.headers.set('Content-Type', 'application/x-ndjson' if self.json_lines else 'application/json')
+
+            # get the first item now so errors before any output still become error responses
+            try:
+                first = next(body)
+            except StopIteration:
+                return ''.encode(web.default_encoding) if self.json_lines else '[]'.encode(web.default_encoding)
+
+            return web.IterIO(iterencode(itertools.chain([first], body), self.json_lines, self.codec))
+
         self.response.headers.set('Content-Type', 'application/json')
 
-        return json.dumps(body).encode(web.default_encoding)
+        # large containers are encoded as they are sent instead of all at once
+        if isinstance(body, (list, tuple, dict)) and len(body) > self.json_stream_length:
+            chunks = iterencode(body, codec=self.codec)
+
+            # encode the first chunk now so early errors still become error responses
+            first = next(chunks)
+
+            return web.IterIO(itertools.chain([first], chunks))
+
+        return self.codec.dumps(body)
 
     def decode(self, body):
         content_type = self.request.headers.get('Content-Type')
         if content_type is not None and content_type.lower().startswith('application/json'):
             try:
-                return json.loads(body.decode(web.default_encoding))
+                return self.codec.loads(body)
             except Exception as error:
                 raise web.HTTPError(400) from error
 
@@ -30,21 +254,48 @@ class JSONHandler(JSONMixIn, web.HTTPHandler):
     pass
 
 
+# per-process cache of (codec, code) -> encoded body for errors with neither a message nor a custom status message
+error_bodies = {}
+
+
 class JSONErrorMixIn:
+    json_codec = None
+    json_options = {}
+
+    def __init__(self, *args, **kwargs):
+        self.json_codec = kwargs.pop('json_codec', self.json_codec)
+        self.json_options = kwargs.pop('json_options', self.json_options)
+
+        super().__init__(*args, **kwargs)
+
+        self.codec = get_codec(self.json_codec, **self.json_options)
+
     def respond(self):
         self.response.headers.set('Content-Type', 'application/json')
 
         if self.error.message is not None:
-            message = self.error.message
-        else:
-            message = {'error': self.error.code, 'status': self.error.status_message}
+            return self.error.code, self.error.status_message, self.codec.dumps(self.error.message)
 
-        return self.error.code, self.error.status_message, json.dumps(message).encode(web.default_encoding)
+        # a standard status message is the same for every error of a code so only encode the body once
+        if self.error.status_message != web.status_messages.get(self.error.code):
+            return self.error.code, self.error.status_message, self.codec.dumps({'error': self.error.code, 'status': self.error.status_message})
+
+        key = (self.codec, self.error.code)
+
+        body = error_bodies.get(key)
+        if body is None:
+            body = self.codec.dumps({'error': self.error.code, 'status': self.error.status_message})
+            error_bodies[key] = body
+
+        return self.error.code, self.error.status_message, body
 
 
 class JSONErrorHandler(JSONErrorMixIn, web.HTTPErrorHandler):
     pass
 
 
-def new_error(error='[0-9]{3}', *, handler=JSONErrorHandler):
+def new_error(error='[0-9]{3}', *, json_codec=None, json_options=None, handler=JSONErrorHandler):
+    if json_codec is not None or json_options is not None:
+        handler = web.HTTPHandlerWrapper(handler, json_codec=json_codec, json_options=json_options or {})
+
     return {error: handler}
@@ -0,0 +1,241 @@
+import collections
+import gzip
+import hashlib
+import json
+import mimetypes
+import mmap
+import os
+import struct
+import time
+
+from fooster import web
+import fooster.web.file
+
+
+__all__ = ['magic', 'header_format', 'min_compress_size', 'build', 'load', 'accepts_gzip', 'Pack', 'PackHandler', 'new']
+
+
+magic = b'FWPACK1\n'
+header_format = '>8sQQ'  # magic, index offset, index length
+
+min_compress_size = 256  # 256 B
+
+# per-process cache of packfile -> pack
+packs = {}
+
+
+def build(local, packfile, *, compress=True):
+    local = local.rstrip('/')
+
+    header_size = struct.calcsize(header_format)
+
+    # name -> [offset, size, mtime, digest, gzip offset, gzip size]
+    index = collections.OrderedDict()
+
+    # write to a temporary file in the same directory so the swap is atomic
+    tmpfile = packfile + '.tmp'
+
+    with open(tmpfile, 'wb') as pack:
+        # leave room for the header until the index location is known
+        pack.write(b'\x00' * header_size)
+
+        for dirpath, dirnames, filenames in os.walk(local):
+            dirnames.sort()
+
+            for filename in sorted(filenames):
+                path = os.path.join(dirpath, filename)
+                if not os.path.isfile(path):
+                    continue
+
+                with open(path, 'rb') as file:
+                    contents = file.read()
+                    mtime = os.fstat(file.fileno()).st_mtime
+
+                offset = pack.tell()
+                pack.write(contents)
+
+                entry = [offset, len(contents), mtime, hashlib.sha256(contents).hexdigest(), None, None]
+
+                # store a precompressed copy if it is worth it
+                if compress and len(contents) >= min_compress_size:
+                    compressed = gzip.compress(contents, mtime=0)
+                    if len(compressed) < len(contents):
+                        entry[4] = pack.tell()
+                        entry[5] = len(compressed)
+                        pack.write(compressed)
+
+                index[path[len(local):]] = entry
+
+        index_bytes = json.dumps(index, separators=(',', ':')).encode(web.default_encoding)
+        index_offset = pack.tell()
+        pack.write(index_bytes)
+
+        pack.seek(0)
+        pack.write(struct.pack(header_format, magic, index_offset, len(index_bytes)))
+
+    os.replace(tmpfile, packfile)
+
+    return len(index)
+
+
+class Pack:
+    def __init__(self, packfile):
+        self.packfile = packfile
+
+        with open(packfile, 'rb') as file:
+            file_stat = os.fstat(file.fileno())
+            self.identity = (file_stat.st_dev, file_stat.st_ino, file_stat.st_mtime_ns, file_stat.st_size)
+
+            # a single mapping is shared for every entry
+            self.view = memoryview(mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ))
+
+        header_size = struct.calcsize(header_format)
+
+        pack_magic, index_offset, index_length = struct.unpack(header_format, self.view[:header_size])
+        if pack_magic != magic:
+            raise ValueError('not a pack file: ' + repr(packfile))
+
+        index = json.loads(bytes(self.view[index_offset:index_offset + index_length]).decode(web.default_encoding))
+
+        # name -> (offset, size, etag, last modified, mime, gzip offset, gzip size)
+        self.entries = {}
+        # directory -> [child names]
+        self.dirs = {'/': []}
+
+        for name, (offset, size, mtime, digest, gzip_offset, gzip_size) in index.items():
+            self.entries[name] = (offset, size, '"' + digest + '"', web.mktime(time.gmtime(mtime)), mimetypes.guess_type(name)[0], gzip_offset, gzip_size)
+
+            # register every parent directory
+            child = name
+            while child != '/':
+                parent = child[:child.rstrip('/').rfind('/') + 1]
+
+                if parent in self.dirs:
+                    self.dirs[parent].append(child[len(parent):])
+                    break
+
+                self.dirs[parent] = [child[len(parent):]]
+                child = parent
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __contains__(self, name):
+        return name in self.entries
+
+    def get(self, name):
+        return self.entries.get(name)
+
+    def slice(self, offset, size):
+        return fooster.web.file.MappedIO(self.view[offset:offset + size])
+
+
+def load(packfile):
+    file_stat = os.stat(packfile)
+    identity = (file_stat.st_dev, file_stat.st_ino, file_stat.st_mtime_ns, file_stat.st_size)
+
+    # reload if the pack was swapped since it was loaded
+    pack = packs.get(packfile)
+    if pack is None or pack.identity != identity:
+        pack = Pack(packfile)
+        packs[packfile] = pack
+
+    return pack
+
+
+def accepts_gzip(header):
+    if not header:
+        return False
+
+    for coding in header.split(','):
+        name, _, params = coding.partition(';')
+        if name.strip().lower() not in ('gzip', '*'):
+            continue
+
+        # make sure it is not explicitly refused - gzip;q=0
+        params = params.replace(' ', '')
+        if params.startswith('q='):
+            try:
+                if float(params[2:]) == 0:
+                    return False
+            except ValueError:
+                return False
+
+        return True
+
+    return False
+
+
+class PackHandler(fooster.web.file.PathHandler):
+    pack = None
+
+    def index(self):
+        # list the children recorded in the pack
+        return ''.join(name + '\n' for name in sorted(self.pack.dirs[self.path]))
+
+    def send_entry(self, entry):
+        offset, size, etag, last_modified, mime, gzip_offset, gzip_size = entry
+
+        # send the precompressed copy to clients that can take it
+        if gzip_offset is not None:
+            self.response.headers.set('Vary', 'Accept-Encoding')
+
+            if accepts_gzip(self.request.headers.get('Accept-Encoding')):
+                self.response.headers.set('Content-Encoding', 'gzip')
+
+                offset, size, etag = gzip_offset, gzip_size, etag[:-1] + '-gzip"'
+
+        return self.send_file(self.pack.slice(offset, size), size, etag, last_modified, mime)
+
+    def do_get(self):
+        try:
+            self.pack = load(self.local)
+        except OSError as error:
+            raise web.HTTPError(404) from error
+
+        entry = self.pack.get(self.path)
+        if entry:
+            return self.send_entry(entry)
+
+        # check for directories
+        dirname = self.path.rstrip('/') + '/'
+        if dirname not in self.pack.dirs:
+            raise web.HTTPError(404)
+
+        # if necessary, redirect to add trailing slash
+        if not self.path.endswith('/'):
+            self.response.headers.set('Location', self.request.resource + '/')
+
+            return 307, ''
+
+        # check for index file
+        for index_file in self.index_files:
+            entry = self.pack.get(self.path + index_file)
+            if entry:
+                return self.send_entry(entry)
+
+        if self.dir_index:
+            if self.cache_policy:
+                self.cache_policy.apply(self.response.headers, self.resource())
+
+            # if no index and directory indexing enabled, send a generated one
+            return 200, self.index()
+
+        raise web.HTTPError(403)
+
+
+def new(packfile, remote='', *, index_files=None, dir_index=False, cache_policy=None, handler=PackHandler):
+    return fooster.web.file.new(packfile, remote, index_files=index_files, dir_index=dir_index, cache_policy=cache_policy, handler=handler)
+
+
+if __name__ == '__main__':
+    from argparse import ArgumentParser
+
+    parser = ArgumentParser(description='pack a local directory into a single indexed file for serving')
+    parser.add_argument('--no-compress', action='store_false', default=True, dest='compress', help='do not store precompressed copies of files')
+    parser.add_argument('local_dir', help='local directory to pack')
+    parser.add_argument('pack_file', help='pack file to create or atomically replace')
+
+    cli = parser.parse_args()
+
+    print('Packed ' + str(build(cli.local_dir, cli.pack_file, compress=cli.compress)) + ' files into ' + cli.pack_file)
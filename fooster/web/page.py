@@ -1,15 +1,73 @@
 import html
 import os.path
+import time
 
 from fooster import web
 
 
-__all__ = ['PageHandler', 'PageErrorHandler', 'new_error']
+__all__ = ['template_check_interval', 'Template', 'load_template', 'PageHandler', 'PageErrorHandler', 'new_error']
+
+
+template_check_interval = 1  # 1 second
+
+# per-process cache of (directory, page) -> template
+templates = {}
+
+
+class Template:
+    __slots__ = ('identity', 'text', 'render', 'checked', 'rendered')
+
+    def __init__(self, identity, text, checked):
+        self.identity = identity
+        self.text = text
+
+        # str.format parses in C so binding it once is the cheapest compiled form
+        self.render = text.format
+
+        self.checked = checked
+
+        # status -> page for errors that render the same every time
+        self.rendered = {}
+
+
+def load_template(directory, page):
+    key = (directory, page)
+    now = time.time()
+
+    # skip the stat if the template was checked recently enough
+    template = templates.get(key)
+    if template is not None and now - template.checked < template_check_interval:
+        return template
+
+    filename = os.path.join(directory, page)
+
+    file_stat = os.stat(filename)
+    identity = (file_stat.st_dev, file_stat.st_ino, file_stat.st_mtime_ns, file_stat.st_size)
+
+    # reuse template if the file has not changed since it was read
+    if template is not None and template.identity == identity:
+        template.checked = now
+        return template
+
+    with open(filename, 'r') as file:
+        template = Template(identity, file.read(), now)
+
+    templates[key] = template
+
+    return template
 
 
 class PageHandler(web.HTTPHandler):
     directory = '.'
     page = 'index.html'
+    manifest = None
+
+    def asset(self, name):
+        # look up fingerprinted URL for a static asset if there is a manifest
+        if self.manifest is not None and name in self.manifest:
+            return self.manifest.url(name)
+
+        return name
 
     def format(self, page):  # pylint: disable=no-self-use
         return page
@@ -17,17 +75,14 @@ class PageHandler(web.HTTPHandler):
     def do_get(self):
         self.response.headers.set('Content-Type', 'text/html; charset=' + web.default_encoding)
 
-        with open(os.path.join(self.directory, self.page), 'r') as file:
-            page = file.read()
-
-        return 200, self.format(page)
+        return 200, self.format(load_template(self.directory, self.page).text)
 
 
 class PageErrorHandler(web.HTTPErrorHandler):
     directory = '.'
     page = 'error.html'
 
-    def format(self, page):
+    def fields(self):
         status_message = html.escape(self.error.status_message)
 
         if self.error.message:
@@ -35,15 +90,29 @@ class PageErrorHandler(web.HTTPErrorHandler):
         else:
             message = str(self.error.code) + ' - ' + status_message
 
-        return page.format(code=self.error.code, status_message=status_message, message=message)
+        return {'code': self.error.code, 'status_message': status_message, 'message': message}
+
+    def format(self, page):
+        return page.format(**self.fields())
 
     def respond(self):
         self.response.headers.set('Content-Type', 'text/html; charset=' + web.default_encoding)
 
-        with open(os.path.join(self.directory, self.page), 'r') as file:
-            page = file.read()
+        template = load_template(self.directory, self.page)
+
+        # errors without their own message render the same for a standard status so keep the page
+        if not self.error.message and self.error.status_message == web.status_messages.get(self.error.code) and type(self).format is PageErrorHandler.format:
+            key = (self.error.code, self.error.status_message)
+
+            rendered = template.rendered.get(key)
+            if rendered is None:
+                # the same as format but through the already bound template
+                rendered = template.render(**self.fields())
+                template.rendered[key] = rendered
+
+            return self.error.code, self.error.status_message, rendered
 
-        return self.error.code, self.error.status_message, self.format(page)
+        return self.error.code, self.error.status_message, self.format(template.text)
 
 
 def new_error(error='[0-9]{3}', *, handler=PageErrorHandler):
@@ -0,0 +1,449 @@
+import array
+import bisect
+import fcntl
+import hashlib
+import mmap
+import multiprocessing
+import os
+import select
+import stat
+import struct
+import tempfile
+import time
+
+from fooster import web
+import fooster.web.file
+import fooster.web.watch
+
+
+__all__ = ['magic', 'header_format', 'search_interval', 'poll_interval', 'start_interval', 'max_results', 'private_dir', 'default_index_file', 'open_lock', 'scan', 'update_totals', 'build', 'Index', 'load', 'run_indexer', 'start_indexer']
+
+
+magic = b'FWSRCH2\n'
+header_format = '>8sQQ'  # magic, number of paths, number of directories
+
+search_interval = 1  # 1 second to gather changes before rewriting the index
+poll_interval = 30  # 30 seconds between rescans when changes are not watched
+start_interval = 1  # 1 second between checks for a running indexer
+
+max_results = 1000
+
+# per-process cache of index file -> index
+indexes = {}
+
+# per-process record of index file -> (indexer process, time checked)
+indexers = {}
+
+
+def private_dir():
+    dirname = os.path.join(tempfile.gettempdir(), 'fooster-search-' + str(os.getuid()))
+
+    try:
+        os.mkdir(dirname, 0o700)
+    except FileExistsError:
+        pass
+
+    # anyone can get the name first in a shared temporary directory so only trust it if it is ours alone
+    dir_stat = os.lstat(dirname)
+    if not stat.S_ISDIR(dir_stat.st_mode) or dir_stat.st_uid != os.getuid() or stat.S_IMODE(dir_stat.st_mode) & 0o077:
+        return tempfile.mkdtemp(prefix='fooster-search-')
+
+    return dirname
+
+
+def default_index_file(local):
+    # kept out of local so read-only roots can be searched
+    local = os.path.abspath(local or '/').rstrip('/')
+
+    return os.path.join(private_dir(), hashlib.sha256(os.fsencode(local)).hexdigest()[:16])
+
+
+def open_lock(index_file):
+    return os.open(index_file + '.lock', os.O_RDWR | os.O_CREAT | os.O_NOFOLLOW | os.O_CLOEXEC, 0o600)
+
+
+def parent(dirname):
+    return os.path.dirname(dirname.rstrip('/')).rstrip('/') + '/'
+
+
+def scan(dirs, local, dirname):
+    # rescan dirname and walk anything new beneath it where dirs is relative directory -> (mtime, [(name, is_dir, usage)], total)
+    touched = set()
+
+    pending = [dirname]
+
+    while pending:
+        dirname = pending.pop()
+
+        old = dirs.get(dirname)
+
+        try:
+            dir_stat = os.stat(local + dirname)
+            if not stat.S_ISDIR(dir_stat.st_mode):
+                raise NotADirectoryError(dirname)
+
+            contents = []
+
+            with os.scandir(local + dirname) as entries:
+                for entry in entries:
+                    if '\n' in entry.name:
+                        continue
+
+                    # symlinked directories are not followed so they are listed as files
+                    is_dir = entry.is_dir(follow_symlinks=False)
+
+                    # du-style disk usage of files
+                    try:
+                        usage = 0 if is_dir else entry.stat(follow_symlinks=False).st_blocks * 512
+                    except OSError:
+                        usage = 0
+
+                    contents.append((entry.name, is_dir, usage))
+
+            contents.sort()
+        except OSError:
+            contents = None
+
+        if contents is None:
+            # forget directories that went away along with everything beneath them
+            if old is not None:
+                for subdir in [subdir for subdir in dirs if subdir.startswith(dirname)]:
+                    del dirs[subdir]
+
+                if dirname != '/':
+                    touched.add(parent(dirname))
+
+            continue
+
+        dirs[dirname] = (dir_stat.st_mtime_ns, contents, old[2] if old is not None else 0)
+
+        if old is not None and old[1] == contents:
+            continue
+
+        touched.add(dirname)
+
+        old_subdirs = {name for name, is_dir, _usage in old[1] if is_dir} if old is not None else set()
+        subdirs = {name for name, is_dir, _usage in contents if is_dir}
+
+        for name in old_subdirs - subdirs:
+            prefix = dirname + name + '/'
+            for subdir in [subdir for subdir in dirs if subdir.startswith(prefix)]:
+                del dirs[subdir]
+
+        for name in subdirs - old_subdirs:
+            pending.append(dirname + name + '/')
+
+    return touched
+
+
+def update_totals(dirs, touched):
+    # only touched directories and their ancestors can have new totals
+    affected = set()
+
+    for dirname in touched:
+        while dirname in dirs and dirname not in affected:
+            affected.add(dirname)
+
+            if dirname == '/':
+                break
+
+            dirname = parent(dirname)
+
+    # deepest first so every subdirectory is done before its parent
+    for dirname in sorted(affected, key=lambda dirname: dirname.count('/'), reverse=True):
+        mtime, contents, _total = dirs[dirname]
+        dirs[dirname] = (mtime, contents, sum(dirs[dirname + name + '/'][2] if is_dir and dirname + name + '/' in dirs else usage for name, is_dir, usage in contents))
+
+    return len(affected)
+
+
+def build(index_file, dirs):
+    # every path sorted bytewise so a subtree is always a contiguous run
+    paths = sorted(os.fsencode(dirname + name + ('/' if is_dir else '')) for dirname, (_mtime, contents, _total) in dirs.items() for name, is_dir, _usage in contents)
+
+    names = [os.fsencode(os.fsdecode(path.rstrip(b'/').rpartition(b'/')[2]).lower()) for path in paths]
+
+    path_offsets = array.array('Q', [0])
+    for path in paths:
+        path_offsets.append(path_offsets[-1] + len(path) + 1)
+
+    name_offsets = array.array('Q', [0])
+    for name in names:
+        name_offsets.append(name_offsets[-1] + len(name) + 1)
+
+    prefix_order = array.array('Q', sorted(range(len(names)), key=names.__getitem__))
+
+    # path index and recursive size of every directory
+    totals = array.array('Q')
+    for idx, path in enumerate(paths):
+        if path.endswith(b'/'):
+            totals.append(idx)
+            totals.append(dirs.get(os.fsdecode(path), (0, [], 0))[2])
+
+    # write to a new temporary file in the same directory so the swap is atomic
+    fd, tmpfile = tempfile.mkstemp(prefix=os.path.basename(index_file) + '.', suffix='.tmp', dir=os.path.dirname(index_file))
+
+    try:
+        with open(fd, 'wb') as file:
+            file.write(struct.pack(header_format, magic, len(paths), len(totals) // 2))
+
+            # arrays are in native byte order so they can be used straight from the mapping
+            file.write(path_offsets.tobytes())
+            file.write(name_offsets.tobytes())
+            file.write(prefix_order.tobytes())
+            file.write(totals.tobytes())
+
+            for path in paths:
+                file.write(path + b'\n')
+
+            for name in names:
+                file.write(name + b'\n')
+
+        os.replace(tmpfile, index_file)
+    except BaseException:
+        os.remove(tmpfile)
+        raise
+
+    return len(paths)
+
+
+class Index:
+    def __init__(self, index_file):
+        self.index_file = index_file
+
+        with open(index_file, 'rb') as file:
+            file_stat = os.fstat(file.fileno())
+            self.identity = (file_stat.st_dev, file_stat.st_ino, file_stat.st_mtime_ns, file_stat.st_size)
+
+            self.mapping = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+
+        header_size = struct.calcsize(header_format)
+
+        index_magic, self.length, self.dir_length = struct.unpack(header_format, self.mapping[:header_size])
+        if index_magic != magic:
+            raise ValueError('not a search index: ' + repr(index_file))
+
+        word = array.array('Q').itemsize
+        view = memoryview(self.mapping)
+
+        offset = header_size
+        self.path_offsets = view[offset:offset + (self.length + 1) * word].cast('Q')
+        offset += (self.length + 1) * word
+        self.name_offsets = view[offset:offset + (self.length + 1) * word].cast('Q')
+        offset += (self.length + 1) * word
+        self.prefix_order = view[offset:offset + self.length * word].cast('Q')
+        offset += self.length * word
+        self.totals = view[offset:offset + self.dir_length * 2 * word].cast('Q')
+        offset += self.dir_length * 2 * word
+
+        self.dir_sizes = None
+
+        self.paths_start = offset
+        self.names_start = offset + self.path_offsets[self.length]
+
+    def __len__(self):
+        return self.length
+
+    def path(self, idx):
+        return self.mapping[self.paths_start + self.path_offsets[idx]:self.paths_start + self.path_offsets[idx + 1] - 1]
+
+    def name(self, idx):
+        return self.mapping[self.names_start + self.name_offsets[idx]:self.names_start + self.name_offsets[idx + 1] - 1]
+
+    def sizes(self):
+        # directory -> recursive size, made once per load so listings look sizes up directly
+        if self.dir_sizes is None:
+            self.dir_sizes = {os.fsdecode(self.path(self.totals[idx])): self.totals[idx + 1] for idx in range(0, len(self.totals), 2)}
+
+        return self.dir_sizes
+
+    def subtree(self, prefix):
+        # first path at or after prefix
+        lo, hi = 0, self.length
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self.path(mid) < prefix:
+                lo = mid + 1
+            else:
+                hi = mid
+
+        # first path after that not under prefix
+        start, hi = lo, self.length
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self.path(mid)[:len(prefix)] <= prefix:
+                lo = mid + 1
+            else:
+                hi = mid
+
+        return start, lo
+
+    def find_substring(self, term, lo, hi, limit):
+        found = []
+
+        end = self.names_start + self.name_offsets[hi]
+        pos = self.mapping.find(term, self.names_start + self.name_offsets[lo], end)
+
+        while 0 <= pos < end and len(found) < limit:
+            idx = bisect.bisect_right(self.name_offsets, pos - self.names_start, lo, hi) - 1
+            found.append(idx)
+
+            # skip to the next name
+            pos = self.mapping.find(term, self.names_start + self.name_offsets[idx + 1], end)
+
+        return found
+
+    def find_prefix(self, term, lo, hi, limit):
+        found = []
+
+        # first name at or after term
+        start, end = 0, self.length
+        while start < end:
+            mid = (start + end) // 2
+            if self.name(self.prefix_order[mid]) < term:
+                start = mid + 1
+            else:
+                end = mid
+
+        for order in range(start, self.length):
+            idx = self.prefix_order[order]
+            if not self.name(idx).startswith(term):
+                break
+
+            if lo <= idx < hi:
+                found.append(idx)
+
+                if len(found) >= limit:
+                    break
+
+        return sorted(found)
+
+    def search(self, term, prefix='/', prefix_match=False, limit=max_results):
+        term = os.fsencode(term.lower())
+        prefix = os.fsencode(prefix)
+
+        lo, hi = self.subtree(prefix)
+
+        # leave out the directory being searched
+        if lo < hi and self.path(lo) == prefix:
+            lo += 1
+
+        if prefix_match:
+            found = self.find_prefix(term, lo, hi, limit)
+        else:
+            found = self.find_substring(term, lo, hi, limit)
+
+        paths = (os.fsdecode(self.path(idx)) for idx in found)
+
+        # never hand out anything that would lead outside of prefix
+        return [path for path in paths if path.startswith(os.fsdecode(prefix)) and not any(part in ('', '.', '..') for part in path.rstrip('/').split('/')[1:])]
+
+
+def load(index_file):
+    try:
+        file_stat = os.stat(index_file)
+    except FileNotFoundError:
+        return None
+
+    identity = (file_stat.st_dev, file_stat.st_ino, file_stat.st_mtime_ns, file_stat.st_size)
+
+    # reload if the index was rewritten since it was loaded
+    index = indexes.get(index_file)
+    if index is None or index.identity != identity:
+        index = Index(index_file)
+        indexes[index_file] = index
+
+    return index
+
+
+def run_indexer(local, index_file):
+    local = local.rstrip('/')
+
+    with open(open_lock(index_file), 'rb') as lock:
+        # only one indexer keeps an index up to date at a time
+        try:
+            fcntl.flock(lock.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            return
+
+        fooster.web.file.set_priority()
+
+        dirs = {}
+
+        update_totals(dirs, scan(dirs, local, '/'))
+        build(index_file, dirs)
+
+        dirty = set()
+
+        def notify(path):
+            # a lost event means any directory may have changed
+            if path is None:
+                dirty.update(dirs)
+                return
+
+            # the parent listing picks up whatever happened to path
+            dirty.add(parent(path[len(local):]))
+
+        with fooster.web.watch.Watcher([local or '/']) as watcher:
+            watcher.subscribe(notify)
+
+            while True:
+                if watcher.fileno() is not None and not watcher.exhausted:
+                    # wait for changes and let a burst of them settle
+                    select.select([watcher], [], [], poll_interval)
+                    time.sleep(search_interval)
+
+                    watcher.check()
+                else:
+                    time.sleep(poll_interval)
+
+                    # look for directories whose mtime moved
+                    for dirname, (mtime, _contents, _total) in list(dirs.items()):
+                        try:
+                            if os.stat(local + dirname).st_mtime_ns != mtime:
+                                dirty.add(dirname)
+                        except OSError:
+                            dirty.add(dirname)
+
+                touched = set()
+
+                while dirty:
+                    dirname = dirty.pop()
+
+                    # directories gone with a parent need no rescan
+                    if dirname != '/' and parent(dirname) not in dirs:
+                        continue
+
+                    touched.update(scan(dirs, local, dirname))
+
+                if touched:
+                    update_totals(dirs, touched)
+                    build(index_file, dirs)
+
+
+def start_indexer(local, index_file):
+    process, checked = indexers.get(index_file, (None, 0))
+    if process is not None and process.is_alive():
+        return process
+
+    now = time.time()
+    if now - checked < start_interval:
+        return None
+
+    indexers[index_file] = (None, now)
+
+    # do not bother starting one if another worker's indexer holds the lock
+    with open(open_lock(index_file), 'rb') as lock:
+        try:
+            fcntl.flock(lock.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            return None
+
+        fcntl.flock(lock.fileno(), fcntl.LOCK_UN)
+
+    process = multiprocessing.get_context(web.start_method).Process(target=run_indexer, args=(local, index_file), name='http-indexer', daemon=True)
+    process.start()
+
+    indexers[index_file] = (process, now)
+
+    return process
@@ -0,0 +1,219 @@
+import ctypes
+import ctypes.util
+import errno
+import os
+import struct
+import time
+
+
+__all__ = ['default_ttl', 'inotify_available', 'Watcher']
+
+
+default_ttl = 5  # 5 seconds
+
+# inotify constants from <sys/inotify.h>
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_ISDIR = 0x40000000
+
+IN_NONBLOCK = os.O_NONBLOCK
+IN_CLOEXEC = os.O_CLOEXEC
+
+watch_mask = IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE | IN_DELETE_SELF | IN_MOVE_SELF | IN_ONLYDIR
+
+event_format = 'iIII'  # wd, mask, cookie, name length
+event_size = struct.calcsize(event_format)
+
+
+# find inotify in libc if this is Linux
+try:
+    libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+
+    inotify_init1 = libc.inotify_init1
+    inotify_init1.argtypes = [ctypes.c_int]
+    inotify_init1.restype = ctypes.c_int
+
+    inotify_add_watch = libc.inotify_add_watch
+    inotify_add_watch.argtypes = [ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32]
+    inotify_add_watch.restype = ctypes.c_int
+
+    inotify_rm_watch = libc.inotify_rm_watch
+    inotify_rm_watch.argtypes = [ctypes.c_int, ctypes.c_int]
+    inotify_rm_watch.restype = ctypes.c_int
+
+    inotify_available = True
+except (OSError, AttributeError, TypeError):
+    inotify_available = False
+
+
+class Watcher:
+    def __init__(self, roots=None, *, ttl=default_ttl):
+        # fill in default argument values
+        if roots is None:
+            roots = []
+
+        self.ttl = ttl
+
+        self.callbacks = []
+
+        # wd -> path
+        self.watches = {}
+        # path -> wd
+        self.paths = {}
+
+        self.roots = set()
+
+        # set when the kernel refuses more watches
+        self.exhausted = False
+
+        self.fd = None
+        if inotify_available:
+            fd = inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+            if fd >= 0:
+                self.fd = fd
+
+        for root in roots:
+            self.add(root)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, _, __, ___):
+        self.close()
+
+    def fileno(self):
+        return self.fd
+
+    def close(self):
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+
+        self.watches.clear()
+        self.paths.clear()
+
+    def subscribe(self, callback):
+        self.callbacks.append(callback)
+
+    def notify(self, path):
+        for callback in self.callbacks:
+            callback(path)
+
+    def add_watch(self, path):
+        if path in self.paths:
+            return True
+
+        wd = inotify_add_watch(self.fd, os.fsencode(path), watch_mask)
+        if wd < 0:
+            error = ctypes.get_errno()
+
+            # out of watches so callers fall back to revalidating on their own
+            if error == errno.ENOSPC:
+                self.exhausted = True
+
+            return False
+
+        self.watches[wd] = path
+        self.paths[path] = wd
+
+        return True
+
+    def add(self, root):
+        root = root.rstrip('/') or '/'
+
+        self.roots.add(root)
+
+        if self.fd is None:
+            return False
+
+        # watch every directory under root
+        for dirpath, _dirnames, _filenames in os.walk(root):
+            if not self.add_watch(dirpath) and self.exhausted:
+                return False
+
+        return True
+
+    def remove(self, path):
+        prefix = path.rstrip('/') + '/'
+
+        # stop watching path and everything beneath it
+        for watched in [watched for watched in self.paths if watched == path or watched.startswith(prefix)]:
+            wd = self.paths.pop(watched)
+            del self.watches[wd]
+
+            inotify_rm_watch(self.fd, wd)
+
+    def covers(self, path):
+        # only directories with a live watch are trusted
+        return self.fd is not None and path.rstrip('/') in self.paths
+
+    def fresh(self, path, checked):
+        # trust watched directories and anything checked within the ttl
+        return self.covers(path) or time.time() - checked < self.ttl
+
+    def read(self):
+        try:
+            return os.read(self.fd, 65536)
+        except BlockingIOError:
+            return b''
+
+    def check(self):
+        if self.fd is None:
+            return 0
+
+        events = 0
+
+        while True:
+            data = self.read()
+            if not data:
+                break
+
+            offset = 0
+            while offset + event_size <= len(data):
+                wd, mask, _cookie, length = struct.unpack_from(event_format, data, offset)
+                name = os.fsdecode(data[offset + event_size:offset + event_size + length].rstrip(b'\x00'))
+                offset += event_size + length
+
+                events += 1
+
+                # kernel dropped events so everything is suspect
+                if mask & IN_Q_OVERFLOW:
+                    self.notify(None)
+                    continue
+
+                # watch went away with its directory
+                if mask & IN_IGNORED:
+                    path = self.watches.pop(wd, None)
+                    if path is not None and self.paths.get(path) == wd:
+                        del self.paths[path]
+                    continue
+
+                dirname = self.watches.get(wd)
+                if dirname is None:
+                    continue
+
+                path = os.path.join(dirname, name) if name else dirname
+
+                if mask & IN_ISDIR:
+                    if mask & (IN_CREATE | IN_MOVED_TO):
+                        # start watching new directories
+                        for dirpath, _dirnames, _filenames in os.walk(path):
+                            if not self.add_watch(dirpath) and self.exhausted:
+                                break
+                    elif mask & IN_MOVED_FROM:
+                        # old watches would report the wrong paths
+                        self.remove(path)
+
+                self.notify(path)
+
+        return events
@@ -14,7 +14,7 @@ import time
 
 
 # export everything
-__all__ = ['server_version', 'http_version', 'http_encoding', 'default_encoding', 'start_method', 'max_line_size', 'max_headers', 'max_request_size', 'stream_chunk_size', 'status_messages', 'mktime', 'mklog', 'HTTPServer', 'HTTPHandler', 'HTTPErrorHandler', 'HTTPHandlerWrapper', 'HTTPError', 'HTTPHeaders', 'HTTPLogFormatter', 'HTTPLogFilter', 'default_log', 'default_http_log']
+__all__ = ['server_version', 'http_version', 'http_encoding', 'default_encoding', 'start_method', 'max_line_size', 'max_headers', 'max_request_size', 'stream_chunk_size', 'status_messages', 'mktime', 'mklog', 'resolve_error_routes', 'HTTPServer', 'HTTPHandler', 'HTTPErrorHandler', 'HTTPHandlerWrapper', 'HTTPError', 'HTTPHeaders', 'IterIO', 'HTTPLogFormatter', 'HTTPLogFilter', 'default_log', 'default_http_log']
 
 
 # module details
@@ -342,6 +342,56 @@ class HTTPError(Exception):
         super().__init__(error_str)
 
 
+class IterIO(io.RawIOBase):
+    def __init__(self, iterable):
+        self.iterator = iter(iterable)
+        self.pending = b''
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        view = memoryview(buffer).cast('B')
+
+        filled = 0
+
+        # gather small pieces into one chunk
+        while filled < len(view):
+            if not self.pending:
+                try:
+                    chunk = next(self.iterator)
+                except StopIteration:
+                    break
+
+                # an empty piece sends what has been gathered so far
+                if not chunk:
+                    if filled:
+                        break
+
+                    continue
+
+                if isinstance(chunk, str):
+                    chunk = chunk.encode(default_encoding)
+
+                self.pending = memoryview(chunk).cast('B')
+
+            length = min(len(view) - filled, len(self.pending))
+
+            view[filled:filled + length] = self.pending[:length]
+            self.pending = self.pending[length:]
+
+            filled += length
+
+        return filled
+
+    def close(self):
+        # let generators clean up after themselves
+        if not self.closed and hasattr(self.iterator, 'close'):
+            self.iterator.close()
+
+        super().close()
+
+
 class HTTPHandler:
     reader = ['options', 'head', 'get']
 
@@ -444,6 +494,10 @@ class DummyHandler(HTTPHandler):
         raise self.error
 
 
+# per-process cache of code -> body for errors with neither a message nor a custom status message
+error_bodies = {}
+
+
 class HTTPErrorHandler(HTTPHandler):
     reader = True
 
@@ -456,6 +510,15 @@ class HTTPErrorHandler(HTTPHandler):
         self.error = error
 
     def respond(self):
+        # errors without their own message render the same for a standard status so keep the body
+        if not self.error.message and self.error.status_message == status_messages.get(self.error.code):
+            body = error_bodies.get(self.error.code)
+            if body is None:
+                body = str(self.error) + '\n'
+                error_bodies[self.error.code] = body
+
+            return self.error.code, self.error.status_message, body
+
         return self.error.code, self.error.status_message, str(self.error) + '\n'
 
 
@@ -533,14 +596,13 @@ class HTTPResponse:
                     self.headers = HTTPHeaders()
 
                 # find an appropriate error handler, defaulting to HTTPErrorHandler
-                s_code = str(error.code)
-                for regex, handler in self.server.error_routes.items():
-                    match = regex.match(s_code)
-                    if match:
-                        error_handler = handler(self.request.handler.request, self.request.handler.response, self.request.handler.groups, error)
-                        break
-                else:
-                    error_handler = HTTPErrorHandler(self.request.handler.request, self.request.handler.response, self.request.handler.groups, error)
+                handler = self.server.error_table.get(error.code)
+                if handler is None:
+                    # only nonstandard codes are missing from the table
+                    s_code = str(error.code)
+                    handler = next((route_handler for regex, route_handler in self.server.error_routes.items() if regex.match(s_code)), HTTPErrorHandler)
+
+                error_handler = handler(self.request.handler.request, self.request.handler.response, self.request.handler.groups, error)
 
                 # use the error response as normal
                 raw_response = error_handler.respond()
@@ -610,13 +672,26 @@ class HTTPResponse:
                         if content_length:
                             # if there is a Content-Length, write that much from the stream
                             bytes_left = int(content_length)
-                            while True:
-                                chunk = response.read(min(bytes_left, stream_chunk_size))
-                                # give up if chunk length is zero (when content-length is longer than the stream)
-                                if not chunk:
-                                    break
-                                bytes_left -= len(chunk)
-                                response_length += self.wfile.write(chunk)
+
+                            # check whether stream is backed by a regular file that the kernel can send directly
+                            try:
+                                sendfile = self.connection.sendfile
+                                offset = response.tell()
+                                response.fileno()
+                            except (AttributeError, OSError):
+                                sendfile = None
+
+                            if sendfile and bytes_left > 0:
+                                # let the socket send straight from the file (falls back to send for TLS)
+                                response_length += sendfile(response, offset, bytes_left)
+                            else:
+                                while True:
+                                    chunk = response.read(min(bytes_left, stream_chunk_size))
+                                    # give up if chunk length is zero (when content-length is longer than the stream)
+                                    if not chunk:
+                                        break
+                                    bytes_left -= len(chunk)
+                                    response_length += self.wfile.write(chunk)
                         else:
                             # if no Content-Length, used chunked encoding
                             while True:
@@ -802,6 +877,7 @@ class HTTPServerInfo:
 
         self.routes = server.routes
         self.error_routes = server.error_routes
+        self.error_table = server.error_table
 
         self.keyfile = server.keyfile
         self.certfile = server.certfile
@@ -1052,6 +1128,22 @@ class HTTPSelector:
         self.control.manager_shutdown.value = 0
 
 
+def resolve_error_routes(error_routes):
+    # standard status code -> first matching error handler, defaulting to HTTPErrorHandler
+    error_table = {}
+
+    for code in status_messages:
+        s_code = str(code)
+        for regex, handler in error_routes.items():
+            if regex.match(s_code):
+                error_table[code] = handler
+                break
+        else:
+            error_table[code] = HTTPErrorHandler
+
+    return error_table
+
+
 class HTTPServer:
     def __init__(self, address, routes, error_routes=None, keyfile=None, certfile=None, *, keepalive=5, timeout=20, backlog=5, num_processes=2, max_processes=6, max_queue=4, poll_interval=0.2, log=None, http_log=None):
         # fill in default argument values
@@ -1071,6 +1163,9 @@ class HTTPServer:
         for regex, handler in error_routes.items():
             self.error_routes[re.compile(r'^' + regex + r'$')] = handler
 
+        # resolve error handlers for every standard status up front
+        self.error_table = resolve_error_routes(self.error_routes)
+
         # store constants
         self.keyfile = keyfile
         self.certfile = certfile
@@ -312,6 +312,8 @@ class MockHTTPServer:
         for regex, handler in error_routes.items():
             self.error_routes[re.compile('^' + regex + '$')] = handler
 
+        self.error_table = web.resolve_error_routes(self.error_routes)
+
         # store constants
         self.keyfile = keyfile
         self.certfile = certfile
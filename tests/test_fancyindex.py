@@ -1,10 +1,13 @@
 import html
+import io
 import json
 import os
+import tarfile
 import time
 import urllib.parse
 
-from fooster.web import fancyindex
+from fooster.web import fancyindex, search
+import fooster.web.file
 
 
 import mock
@@ -26,12 +29,44 @@ class FairEntry(fancyindex.DirEntry):
         return self.path < other.path
 
 
+class OldEntry(fancyindex.DirEntry):
+    def __init__(self, dirname, filename):
+        super().__init__(dirname, filename)
+
+        self.filename = self.filename.upper()
+
+
+def read(response):
+    # indexes are streamed
+    if isinstance(response[1], io.IOBase):
+        return response[0], response[1].read().decode()
+
+    return response
+
+
 def run(method, resource, local, remote='', head='', precontent='', preindex='', postindex='', postcontent='', sortclass=fancyindex.DirEntry):
     handler = list(fancyindex.new(local, remote, modify=False, head=head, precontent=precontent, preindex=preindex, postindex=postindex, postcontent=postcontent, sortclass=sortclass, index_template=test_index_template, index_entry=test_index_entry, index_entry_join=test_index_entry_join, index_content_type=test_index_content_type).values())[0]
 
     request = mock.MockHTTPRequest(None, ('', 0), None, method=method, resource=resource, groups={'path': resource[len(remote):]}, handler=handler)
 
-    return request.response.headers, request.handler.respond()
+    return request.response.headers, read(request.handler.respond())
+
+
+def run_query(local, query, **kwargs):
+    handler = list(fancyindex.new(local, index_template=test_index_template, index_entry=test_index_entry, index_entry_join=test_index_entry_join, index_content_type=test_index_content_type, **kwargs).values())[0]
+
+    request = mock.MockHTTPRequest(None, ('', 0), None, method='GET', resource='/' + query, groups={'path': '/', 'query': query}, handler=handler)
+
+    return request.response.headers, read(request.handler.respond())
+
+
+def run_names(local, query, **kwargs):
+    headers, response = run_query(local, query, **kwargs)
+
+    # check status
+    assert response[0] == 200
+
+    return headers, [entry['name'] for entry in json.loads(response[1])['entries']]
 
 
 def run_contents(resource, local, dirname=None):
@@ -293,6 +328,17 @@ def test_list_dir(tmp):
         assert str(dirlist[7]) == 'test'
 
 
+def test_list_dir_old_sortclass(tmp):
+    # check sort classes that only take a dirname and filename still work
+    dirlist = fancyindex.list_dir(tmp['dir'], sortclass=OldEntry)
+
+    assert str(dirlist[0]) == '../'
+    assert sorted(str(direntry) for direntry in dirlist[1:]) == sorted(str(direntry).upper() for direntry in fancyindex.list_dir(tmp['dir'])[1:])
+
+    assert not fancyindex.takes_entry(OldEntry)
+    assert fancyindex.takes_entry(fancyindex.DirEntry)
+
+
 def test_list_dir_custom_sort(tmp):
     dirlist = fancyindex.list_dir(tmp['dir'], sortclass=FairEntry)
 
@@ -341,6 +387,532 @@ def test_list_dir_root(tmp):
         assert str(dirlist[6]) == 'test'
 
 
+def test_list_dir_broken_link(tmp):
+    os.symlink(os.path.join(tmp['dir'], 'nonexistent'), os.path.join(tmp['dir'], 'broken'))
+
+    dirlist = fancyindex.list_dir(tmp['dir'], root=True)
+
+    assert 'broken' in [str(direntry) for direntry in dirlist]
+
+
+def test_fancyindex_listing_cache(tmp, monkeypatch):
+    # make the directory old enough to be trusted
+    os.utime(tmp['dir'], (time.time() - 10, time.time() - 10))
+
+    headers, response = run('GET', '/', tmp['dir'])
+
+    # check status
+    assert response[0] == 200
+
+    # make sure the second listing is not read from the directory
+    def list_dir(*args, **kwargs):
+        raise AssertionError('listing not cached')
+
+    monkeypatch.setattr(fancyindex, 'list_dir', list_dir)
+
+    headers, cached_response = run('GET', '/', tmp['dir'])
+
+    # check status
+    assert cached_response[0] == 200
+
+    # check response
+    assert cached_response[1] == response[1]
+
+    # check that the cache is not shared with other paths
+    with pytest.raises(AssertionError):
+        run('GET', '/testdir/', tmp['dir'])
+
+    monkeypatch.undo()
+
+    # change the directory
+    with open(os.path.join(tmp['dir'], 'new'), 'w'):
+        pass
+
+    os.utime(tmp['dir'], (time.time() - 5, time.time() - 5))
+
+    headers, response = run('GET', '/', tmp['dir'])
+
+    # check status
+    assert response[0] == 200
+
+    # check response
+    assert 'new' in [entry['name'] for entry in json.loads(response[1])['entries']]
+
+
+@pytest.fixture(scope='function')
+def tmp_many(tmpdir):
+    for idx in range(10):
+        with tmpdir.join('build{:02}.tar'.format(idx)).open('w') as file:
+            file.write('x' * (10 - idx))
+
+        os.utime(str(tmpdir.join('build{:02}.tar'.format(idx))), (1000 + (idx * 7) % 10, 1000 + (idx * 7) % 10))
+
+    tmpdir.mkdir('logs')
+
+    return str(tmpdir)
+
+
+def test_fancyindex_page(tmp_many):
+    headers, names = run_names(tmp_many, '?limit=4')
+
+    assert names == ['logs/', 'build00.tar', 'build01.tar', 'build02.tar']
+
+    # check headers
+    assert headers.get('Link') == '<?limit=4&page=2>; rel="next"'
+
+    headers, names = run_names(tmp_many, '?limit=4&page=2')
+
+    assert names == ['build03.tar', 'build04.tar', 'build05.tar', 'build06.tar']
+
+    # check headers
+    assert headers.get('Link') == '<?limit=4&page=1>; rel="prev", <?limit=4&page=3>; rel="next"'
+
+    headers, names = run_names(tmp_many, '?limit=4&page=3')
+
+    assert names == ['build07.tar', 'build08.tar', 'build09.tar']
+
+    # check headers
+    assert headers.get('Link') == '<?limit=4&page=2>; rel="prev"'
+
+    headers, names = run_names(tmp_many, '?limit=4&page=4')
+
+    assert names == []
+
+
+def test_fancyindex_page_default_limit(tmp_many):
+    headers, names = run_names(tmp_many, '?page=3', index_limit=5)
+
+    assert names == ['build09.tar']
+
+    headers, names = run_names(tmp_many, '', index_limit=5)
+
+    assert len(names) == 5
+
+
+def test_fancyindex_page_parent(tmp_many):
+    handler = list(fancyindex.new(os.path.dirname(tmp_many), index_template=test_index_template, index_entry=test_index_entry, index_entry_join=test_index_entry_join, index_content_type=test_index_content_type).values())[0]
+
+    resource = '/' + os.path.basename(tmp_many) + '/'
+
+    request = mock.MockHTTPRequest(None, ('', 0), None, method='GET', resource=resource + '?limit=2&page=2', groups={'path': resource, 'query': '?limit=2&page=2'}, handler=handler)
+    response = read(request.handler.respond())
+
+    # check status
+    assert response[0] == 200
+
+    # check response
+    assert [entry['name'] for entry in json.loads(response[1])['entries']] == ['../', 'build01.tar', 'build02.tar']
+
+
+def test_fancyindex_sort_size(tmp_many):
+    headers, names = run_names(tmp_many, '?sort=size')
+
+    assert names == ['logs/'] + ['build{:02}.tar'.format(idx) for idx in reversed(range(10))]
+
+
+def test_fancyindex_sort_modified(tmp_many):
+    headers, names = run_names(tmp_many, '?sort=modified&filter=*.tar')
+
+    assert names == ['build{:02}.tar'.format(idx) for idx in sorted(range(10), key=lambda idx: (idx * 7) % 10)]
+
+
+def test_fancyindex_sort_desc(tmp_many):
+    headers, names = run_names(tmp_many, '?order=desc&limit=3')
+
+    assert names == ['build09.tar', 'build08.tar', 'build07.tar']
+
+    headers, names = run_names(tmp_many, '?order=desc&limit=3&page=4')
+
+    assert names == ['build00.tar', 'logs/']
+
+
+def test_fancyindex_filter(tmp_many):
+    headers, names = run_names(tmp_many, '?filter=build0[3-5]*')
+
+    assert names == ['build03.tar', 'build04.tar', 'build05.tar']
+
+    headers, names = run_names(tmp_many, '?filter=logs')
+
+    assert names == ['logs/']
+
+
+def test_fancyindex_pagination(tmp_many):
+    handler = list(fancyindex.new(tmp_many).values())[0]
+
+    request = mock.MockHTTPRequest(None, ('', 0), None, method='GET', resource='/?limit=4&sort=size', groups={'path': '/', 'query': '?limit=4&sort=size'}, handler=handler)
+    response = read(request.handler.respond())
+
+    # check status
+    assert response[0] == 200
+
+    # check response
+    assert 'Page 1 of 3' in response[1]
+    assert 'href="?limit=4&amp;sort=size&amp;page=2"' in response[1]
+
+
+@pytest.mark.parametrize('query', ['?sort=color', '?order=sideways', '?page=0', '?page=x', '?limit=0', '?limit=-1'])
+def test_fancyindex_bad_query(tmp_many, query):
+    with pytest.raises(fooster.web.HTTPError) as error:
+        run_query(tmp_many, query)
+
+    assert error.value.code == 400
+
+
+def test_fancyindex_stream(tmp_many, monkeypatch):
+    monkeypatch.setattr(fancyindex, 'index_batch_size', 4)
+
+    handler = list(fancyindex.new(tmp_many, index_template=test_index_template, index_entry=test_index_entry, index_entry_join=test_index_entry_join, index_content_type=test_index_content_type).values())[0]
+
+    request = mock.MockHTTPRequest(None, ('', 0), None, method='GET', resource='/', groups={'path': '/'}, handler=handler)
+    response = request.handler.respond()
+
+    # check status
+    assert response[0] == 200
+
+    # check headers
+    assert request.response.headers.get('Content-Length') is None
+
+    # check that the top of the page comes before the listing
+    stream = response[1].iterator
+    assert next(stream).endswith('"entries":[')
+    assert next(stream) == ''
+
+    # check batches
+    assert len(json.loads('[' + next(stream) + ']')) == 4
+    assert len(json.loads('[' + next(stream)[1:] + ']')) == 4
+    assert len(json.loads('[' + next(stream)[1:] + ']')) == 3
+    assert next(stream) == ']}'
+
+    with pytest.raises(StopIteration):
+        next(stream)
+
+
+def test_fancyindex_stream_escaped_template(tmp):
+    handler = list(fancyindex.new(tmp['dir'], index_template='{{entries}} {entries} {{entries}}', index_entry='{name}', index_entry_join=' ').values())[0]
+
+    request = mock.MockHTTPRequest(None, ('', 0), None, method='GET', resource='/testdir/', groups={'path': '/testdir/'}, handler=handler)
+    response = read(request.handler.respond())
+
+    # check status
+    assert response[0] == 200
+
+    # check response
+    assert response[1] == '{entries} ../ magic {entries}'
+
+
+def run_format(local, query='', headers=None):
+    handler = list(fancyindex.new(local).values())[0]
+
+    request_headers = fooster.web.HTTPHeaders()
+    for name, value in (headers or {}).items():
+        request_headers.set(name, value)
+
+    request = mock.MockHTTPRequest(None, ('', 0), None, method='GET', resource='/' + query, headers=request_headers, groups={'path': '/', 'query': query}, handler=handler)
+
+    return request.response.headers, read(request.handler.respond())
+
+
+def test_fancyindex_json(tmp_many):
+    headers, response = run_format(tmp_many, '?format=json')
+
+    # check status
+    assert response[0] == 200
+
+    # check headers
+    assert headers.get('Content-Type') == 'application/json'
+    assert headers.get('Vary') == 'Accept'
+
+    # check response
+    index = json.loads(response[1])
+
+    assert index['path'] == '/'
+    assert index['entries'][0] == {'name': 'logs', 'size': None, 'modified': os.path.getmtime(os.path.join(tmp_many, 'logs')), 'is_dir': True}
+    assert index['entries'][1] == {'name': 'build00.tar', 'size': 10, 'modified': 1000, 'is_dir': False}
+    assert len(index['entries']) == 11
+
+
+def test_fancyindex_json_accept(tmp_many):
+    headers, response = run_format(tmp_many, '?limit=2&page=2', {'Accept': 'application/json, text/html;q=0.9'})
+
+    # check status
+    assert response[0] == 200
+
+    # check headers
+    assert headers.get('Content-Type') == 'application/json'
+
+    # check response
+    assert [entry['name'] for entry in json.loads(response[1])['entries']] == ['build01.tar', 'build02.tar']
+
+
+def test_fancyindex_json_refused(tmp_many):
+    headers, response = run_format(tmp_many, '', {'Accept': 'application/json;q=0, text/html'})
+
+    # check status
+    assert response[0] == 200
+
+    # check headers
+    assert headers.get('Content-Type') == fancyindex.default_index_content_type
+
+
+def test_fancyindex_ndjson(tmp_many):
+    headers, response = run_format(tmp_many, '?format=ndjson&sort=size&order=desc', {'Accept': 'application/json'})
+
+    # check status
+    assert response[0] == 200
+
+    # check headers
+    assert headers.get('Content-Type') == 'application/x-ndjson'
+
+    # check response
+    lines = response[1].split('\n')
+
+    assert lines[-1] == ''
+    assert [json.loads(line)['name'] for line in lines[:-1]] == ['build{:02}.tar'.format(idx) for idx in range(10)] + ['logs']
+
+
+def test_fancyindex_ndjson_empty(tmp_many):
+    headers, response = run_format(tmp_many, '?format=ndjson&filter=nothing')
+
+    # check status
+    assert response[0] == 200
+
+    # check response
+    assert response[1] == ''
+
+
+def test_fancyindex_bad_format(tmp_many):
+    with pytest.raises(fooster.web.HTTPError) as error:
+        run_format(tmp_many, '?format=xml')
+
+    assert error.value.code == 400
+
+
+def test_fancyindex_etag(tmp_many):
+    # a directory changed just now gets no etag
+    headers, response = run_format(tmp_many, '?format=json')
+
+    assert headers.get('ETag') is None
+
+    os.utime(tmp_many, (time.time() - 10, time.time() - 10))
+
+    headers, response = run_format(tmp_many, '?format=json')
+
+    # check status
+    assert response[0] == 200
+
+    etag = headers.get('ETag')
+    assert etag.startswith('W/')
+
+    # check other representations differ
+    html_headers, response = run_format(tmp_many)
+
+    assert html_headers.get('ETag') != etag
+
+    # check not modified
+    headers, response = run_format(tmp_many, '?format=json', {'If-None-Match': etag})
+
+    assert response[0] == 304
+    assert response[1] == ''
+
+    # check changes
+    with open(os.path.join(tmp_many, 'new'), 'w'):
+        pass
+
+    os.utime(tmp_many, (time.time() - 5, time.time() - 5))
+
+    headers, response = run_format(tmp_many, '?format=json', {'If-None-Match': etag})
+
+    assert response[0] == 200
+    assert headers.get('ETag') != etag
+
+
+def run_search(local, resource, query, index_file):
+    handler = list(fancyindex.new(local, search=True, index_file=index_file, index_template=test_index_template, index_entry=test_index_entry, index_entry_join=test_index_entry_join, index_content_type=test_index_content_type).values())[0]
+
+    request = mock.MockHTTPRequest(None, ('', 0), None, method='GET', resource=resource + query, groups={'path': resource, 'query': query}, handler=handler)
+
+    return request.response.headers, read(request.handler.respond())
+
+
+@pytest.fixture(scope='function')
+def tmp_search(tmp, monkeypatch):
+    started = []
+    monkeypatch.setattr(search, 'start_indexer', lambda local, index_file: started.append((local, index_file)))
+
+    dirs = {}
+    search.scan(dirs, tmp['dir'], '/')
+
+    index_file = tmp['dir'] + '.index'
+    search.build(index_file, dirs)
+
+    return dict(tmp, index=index_file, started=started)
+
+
+def test_fancyindex_search(tmp_search):
+    headers, response = run_search(tmp_search['dir'], '/', '?search=mag', tmp_search['index'])
+
+    # check status
+    assert response[0] == 200
+
+    # check headers
+    assert headers.get('ETag') is None
+
+    # check response
+    entries = json.loads(response[1])['entries']
+
+    assert [entry['name'] for entry in entries] == ['testdir/magic']
+    assert entries[0]['url'] == 'testdir/magic'
+
+    # check the indexer was started
+    assert tmp_search['started'] == [(tmp_search['dir'], tmp_search['index'])]
+
+
+def test_fancyindex_search_subtree(tmp_search):
+    headers, response = run_search(tmp_search['dir'], '/tmp/', '?search=t', tmp_search['index'])
+
+    # check status
+    assert response[0] == 200
+
+    # check response
+    assert [entry['name'] for entry in json.loads(response[1])['entries']] == ['../', 'test', 'tmp/']
+
+
+def test_fancyindex_search_prefix(tmp_search):
+    headers, response = run_search(tmp_search['dir'], '/', '?search=TES&match=prefix&sort=size&filter=*test', tmp_search['index'])
+
+    # check status
+    assert response[0] == 200
+
+    # check response
+    if tmp_search['case_insensitive']:
+        assert [entry['name'] for entry in json.loads(response[1])['entries']] == ['&lt;test&gt;/test', 'tmp/test', 'tëst/test', 'test']
+    else:
+        assert [entry['name'] for entry in json.loads(response[1])['entries']] == ['&lt;test&gt;/test', 'Tmp/test', 'tmp/test', 'tëst/test', 'test']
+
+
+def test_fancyindex_search_gone(tmp_search):
+    os.remove(os.path.join(tmp_search['dir'], 'testdir', 'magic'))
+
+    headers, response = run_search(tmp_search['dir'], '/', '?search=magic', tmp_search['index'])
+
+    # check response
+    assert json.loads(response[1])['entries'] == []
+
+
+def test_fancyindex_search_building(tmp_search):
+    with pytest.raises(fooster.web.HTTPError) as error:
+        run_search(tmp_search['dir'], '/', '?search=magic', tmp_search['index'] + '.missing')
+
+    assert error.value.code == 503
+    assert error.value.headers.get('Retry-After')
+
+
+@pytest.mark.parametrize('query', ['?search=magic&match=fuzzy', '?search=a%0Ab'])
+def test_fancyindex_search_bad_query(tmp_search, query):
+    with pytest.raises(fooster.web.HTTPError) as error:
+        run_search(tmp_search['dir'], '/', query, tmp_search['index'])
+
+    assert error.value.code == 400
+
+
+def test_fancyindex_search_disabled(tmp):
+    headers, response = run_query(tmp['dir'], '?search=magic')
+
+    # check status
+    assert response[0] == 200
+
+    # check the directory is listed instead
+    assert 'testdir/' in [entry['name'] for entry in json.loads(response[1])['entries']]
+
+
+def test_fancyindex_dir_sizes(tmp_search):
+    with open(os.path.join(tmp_search['dir'], 'testdir', 'magic'), 'wb') as file:
+        file.write(b'm' * 65536)
+
+    os.utime(tmp_search['dir'], (time.time() - 10, time.time() - 10))
+
+    dirs = {}
+    search.update_totals(dirs, search.scan(dirs, tmp_search['dir'], '/'))
+    search.build(tmp_search['index'], dirs)
+
+    handler = list(fancyindex.new(tmp_search['dir'], dir_sizes=True, index_file=tmp_search['index']).values())[0]
+
+    request = mock.MockHTTPRequest(None, ('', 0), None, method='GET', resource='/?format=json&sort=size', groups={'path': '/', 'query': '?format=json&sort=size'}, handler=handler)
+    response = read(request.handler.respond())
+
+    # check status
+    assert response[0] == 200
+
+    # check response
+    entries = json.loads(response[1])['entries']
+
+    assert entries[-1] == {'name': 'testdir', 'size': dirs['/testdir/'][2], 'modified': os.path.getmtime(os.path.join(tmp_search['dir'], 'testdir')), 'is_dir': True}
+    assert entries[-1]['size'] > 0
+
+    # check the etag follows the index
+    etag = request.response.headers.get('ETag')
+
+    search.build(tmp_search['index'], dirs)
+    os.utime(tmp_search['index'], (time.time() + 10, time.time() + 10))
+
+    request = mock.MockHTTPRequest(None, ('', 0), None, method='GET', resource='/?format=json&sort=size', headers=fooster.web.HTTPHeaders(), groups={'path': '/', 'query': '?format=json&sort=size'}, handler=handler)
+    request.headers.set('If-None-Match', etag)
+    response = read(request.handler.respond())
+
+    assert response[0] == 200
+    assert request.response.headers.get('ETag') != etag
+
+    # check the html column
+    request = mock.MockHTTPRequest(None, ('', 0), None, method='GET', resource='/', groups={'path': '/'}, handler=handler)
+    response = read(request.handler.respond())
+
+    assert '<td class="size">' + fancyindex.human_readable_size(dirs['/testdir/'][2]) + '</td>' in response[1]
+
+
+def test_fancyindex_dir_sizes_building(tmp_search):
+    handler = list(fancyindex.new(tmp_search['dir'], dir_sizes=True, index_file=tmp_search['index'] + '.missing').values())[0]
+
+    request = mock.MockHTTPRequest(None, ('', 0), None, method='GET', resource='/?format=json', groups={'path': '/', 'query': '?format=json'}, handler=handler)
+    response = read(request.handler.respond())
+
+    # check status
+    assert response[0] == 200
+
+    # check sizes are left out until the index is built
+    assert {entry['size'] for entry in json.loads(response[1])['entries'] if entry['is_dir']} == {None}
+
+
+def test_fancyindex_cache_policy(tmp):
+    policy = fooster.web.file.CachePolicy(default=fooster.web.file.CacheRule(no_cache=True))
+
+    handler = list(fancyindex.new(tmp['dir'], cache_policy=policy, index_template=test_index_template, index_entry=test_index_entry, index_entry_join=test_index_entry_join, index_content_type=test_index_content_type).values())[0]
+
+    request = mock.MockHTTPRequest(None, ('', 0), None, method='GET', resource='/', groups={'path': '/'}, handler=handler)
+    response = request.handler.respond()
+
+    # check status
+    assert response[0] == 200
+
+    # check headers
+    assert request.response.headers.get('Cache-Control') == 'no-cache'
+
+
+def test_fancyindex_archive(tmp):
+    handler = list(fancyindex.new(tmp['dir'], archive=True).values())[0]
+
+    request = mock.MockHTTPRequest(None, ('', 0), None, method='GET', resource='/?archive=tar', groups={'path': '/', 'query': '?archive=tar'}, handler=handler)
+    response = request.handler.respond()
+
+    # check status
+    assert response[0] == 200
+
+    # check headers
+    assert request.response.headers.get('Content-Type') == 'application/x-tar'
+
+    with tarfile.open(fileobj=io.BytesIO(response[1].read())) as archive:
+        assert sorted(name for name in archive.getnames() if '/' not in name) == sorted(os.listdir(tmp['dir']))
+
+
 def test_human_readable_size():
     units = ['B', 'KiB']
 
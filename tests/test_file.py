@@ -1,7 +1,15 @@
+import collections
+import errno
+import hashlib
+import io
+import json
 import stat
 import os
+import re
+import tarfile
+import zipfile
 
-from fooster.web import web, file
+from fooster.web import web, file, watch
 
 
 import mock
@@ -40,6 +48,12 @@ class PathHandler(file.PathHandler):
     remote = ''
 
 
+class MappedPathHandler(file.PathHandler):
+    local = ''
+    remote = ''
+    use_mmap = True
+
+
 class PathDirIndexHandler(file.PathHandler):
     local = ''
     dir_index = True
@@ -65,12 +79,12 @@ class CustomGroupHandler(file.PathHandler):
         return super().respond()
 
 
-def run(method, resource, local, body='', headers=None, handler=None, groups=None, remote='', index_files=None, dir_index=False, modify=False, return_handler=False):
+def run(method, resource, local, body='', headers=None, handler=None, groups=None, remote='', index_files=None, dir_index=False, modify=False, cache_policy=None, return_handler=False):
     if not isinstance(body, bytes):
         body = body.encode('utf-8')
 
     if not handler:
-        route = file.new(local, remote, index_files=index_files, dir_index=dir_index, modify=modify)
+        route = file.new(local, remote, index_files=index_files, dir_index=dir_index, modify=modify, cache_policy=cache_policy)
 
         handler = list(route.values())[0]
 
@@ -208,542 +222,1867 @@ def test_get_extra_range(tmp_get):
     assert int(headers.get('Content-Length')) == len(test_string)
     assert headers.get('Accept-Ranges') == 'bytes'
     assert headers.get('Content-Type') is None
-    assert headers.get('Content-Range') is None
+    assert headers.get('Content-Range') == 'bytes 0-' + str(len(test_string) - 1) + '/' + str(len(test_string))
 
     # check response
-    assert response[0] == 200
+    assert response[0] == 206
     assert response[1].read() == test_string
 
 
-def test_get_inverted_range(tmp_get):
+def test_get_suffix_range(tmp_get):
+    suffix = 5
+
     request_headers = web.HTTPHeaders()
-    request_headers.set('Range', 'bytes=' + str(len(test_string) - 1) + '-0')
+    request_headers.set('Range', 'bytes=-' + str(suffix))
     headers, response = run('GET', '/test', tmp_get, headers=request_headers)
 
     # check headers
-    assert int(headers.get('Content-Length')) == len(test_string)
-    assert headers.get('Accept-Ranges') == 'bytes'
-    assert headers.get('Content-Type') is None
-    assert headers.get('Content-Range') is None
+    assert int(headers.get('Content-Length')) == suffix
+    assert headers.get('Content-Range') == 'bytes ' + str(len(test_string) - suffix) + '-' + str(len(test_string) - 1) + '/' + str(len(test_string))
 
     # check response
-    assert response[0] == 200
-    assert response[1].read() == test_string
+    assert response[0] == 206
+    assert response[1].read(suffix) == test_string[-suffix:]
 
 
-def test_get_bad_value_range(tmp_get):
+def test_get_large_suffix_range(tmp_get):
     request_headers = web.HTTPHeaders()
-    request_headers.set('Range', 'bytes=a-b')
+    request_headers.set('Range', 'bytes=-' + str(len(test_string) * 2))
     headers, response = run('GET', '/test', tmp_get, headers=request_headers)
 
     # check headers
     assert int(headers.get('Content-Length')) == len(test_string)
-    assert headers.get('Accept-Ranges') == 'bytes'
-    assert headers.get('Content-Type') is None
-    assert headers.get('Content-Range') is None
+    assert headers.get('Content-Range') == 'bytes 0-' + str(len(test_string) - 1) + '/' + str(len(test_string))
 
     # check response
-    assert response[0] == 200
+    assert response[0] == 206
     assert response[1].read() == test_string
 
 
-def test_get_mime(tmp_get):
-    headers, response = run('GET', '/test.txt', tmp_get)
+def test_get_multi_range(tmp_get):
+    request_headers = web.HTTPHeaders()
+    request_headers.set('Range', 'bytes=0-1, 4-6, -2')
+    headers, response = run('GET', '/test.txt', tmp_get, headers=request_headers)
 
     # check headers
-    assert int(headers.get('Content-Length')) == len(test_string)
-    assert headers.get('Accept-Ranges') == 'bytes'
-    assert headers.get('Content-Type') == 'text/plain'
+    content_type = headers.get('Content-Type')
+    assert content_type.startswith('multipart/byteranges; boundary=')
     assert headers.get('Content-Range') is None
 
-    # check response
-    assert response[0] == 200
-    assert response[1].read() == test_string
+    boundary = content_type.split('boundary=', 1)[1]
+    size = str(len(test_string))
 
+    expected = b''
+    for lower, upper in [(0, 1), (4, 6), (len(test_string) - 2, len(test_string) - 1)]:
+        expected += ('--' + boundary + '\r\nContent-Type: text/plain\r\nContent-Range: bytes ' + str(lower) + '-' + str(upper) + '/' + size + '\r\n\r\n').encode(web.http_encoding)
+        expected += test_string[lower:upper + 1] + b'\r\n'
+    expected += ('--' + boundary + '--\r\n').encode(web.http_encoding)
 
-def test_get_notfound(tmp_get):
-    with pytest.raises(web.HTTPError) as error:
-        headers, response = run('GET', '/nonexistent', tmp_get)
+    # check response
+    assert response[0] == 206
+    assert int(headers.get('Content-Length')) == len(expected)
+    assert response[1].read() == expected
 
-    assert error.value.code == 404
 
-    with pytest.raises(web.HTTPError) as error:
-        headers, response = run('GET', '/test/', tmp_get)
+def test_get_multi_range_coalesce(tmp_get):
+    request_headers = web.HTTPHeaders()
+    request_headers.set('Range', 'bytes=4-6, 0-2, 3-4')
+    headers, response = run('GET', '/test', tmp_get, headers=request_headers)
 
-    assert error.value.code == 404
+    # check headers
+    assert int(headers.get('Content-Length')) == 7
+    assert headers.get('Content-Range') == 'bytes 0-6/' + str(len(test_string))
 
-    with pytest.raises(web.HTTPError) as error:
-        headers, response = run('GET', '/test/nonexistent', tmp_get)
+    # check response
+    assert response[0] == 206
+    assert response[1].read(7) == test_string[:7]
 
-    assert error.value.code == 404
 
+def test_get_unsatisfiable_range(tmp_get):
+    request_headers = web.HTTPHeaders()
+    request_headers.set('Range', 'bytes=' + str(len(test_string)) + '-, -0')
 
-def test_get_forbidden(tmp_get):
     with pytest.raises(web.HTTPError) as error:
-        headers, response = run('GET', '/forbidden', tmp_get)
+        run('GET', '/test', tmp_get, headers=request_headers)
 
-    assert error.value.code == 403
+    assert error.value.code == 416
+    assert error.value.headers.get('Content-Range') == 'bytes */' + str(len(test_string))
 
 
-def test_get_dir(tmp_get):
-    headers, response = run('GET', '/testdir', tmp_get)
+def test_get_if_range(tmp_get):
+    headers, response = run('GET', '/test', tmp_get)
+    response[1].close()
 
-    # check headers
-    assert headers.get('Location') == '/testdir/'
+    etag = headers.get('ETag')
+    last_modified = headers.get('Last-Modified')
 
-    # check resposne
-    assert response[0] == 307
-    assert response[1] == ''
+    assert etag
+    assert last_modified
 
+    for validator in [etag, last_modified]:
+        request_headers = web.HTTPHeaders()
+        request_headers.set('Range', 'bytes=2-6')
+        request_headers.set('If-Range', validator)
+        headers, response = run('GET', '/test', tmp_get, headers=request_headers)
 
-def test_get_null(tmp_get):
-    with pytest.raises(web.HTTPError) as error:
-        headers, response = run('GET', '/\x00', tmp_get)
+        # check response
+        assert response[0] == 206
+        assert headers.get('Content-Range') == 'bytes 2-6/' + str(len(test_string))
+        assert response[1].read(5) == test_string[2:7]
 
-    assert error.value.code == 400
 
+def test_get_if_range_mismatch(tmp_get):
+    request_headers = web.HTTPHeaders()
+    request_headers.set('Range', 'bytes=2-6')
+    request_headers.set('If-Range', '"stale"')
+    headers, response = run('GET', '/test', tmp_get, headers=request_headers)
 
-def test_get_dir_index_listing(tmp_get):
-    headers, response = run('GET', '/testdir/', tmp_get, dir_index=True)
+    # check headers
+    assert int(headers.get('Content-Length')) == len(test_string)
+    assert headers.get('Content-Range') is None
 
-    # check resposne
+    # check response
     assert response[0] == 200
-    assert response[1] == 'magic\n'
-
-
-def test_get_no_dir_index_listing(tmp_get):
-    with pytest.raises(web.HTTPError) as error:
-        headers, response = run('GET', '/testdir/', tmp_get)
-
-    assert error.value.code == 403
-
-
-def test_get_dir_no_index_file(tmp_get):
-    with pytest.raises(web.HTTPError) as error:
-        headers, response = run('GET', '/indexdir/', tmp_get)
-
-    assert error.value.code == 403
+    assert response[1].read() == test_string
 
 
-def test_get_dir_index_file(tmp_get):
-    headers, response = run('GET', '/indexdir/', tmp_get, dir_index=True)
+def test_get_inverted_range(tmp_get):
+    request_headers = web.HTTPHeaders()
+    request_headers.set('Range', 'bytes=' + str(len(test_string) - 1) + '-0')
+    headers, response = run('GET', '/test', tmp_get, headers=request_headers)
 
     # check headers
-    assert headers.get('Content-Type') == 'text/html'
     assert int(headers.get('Content-Length')) == len(test_string)
+    assert headers.get('Accept-Ranges') == 'bytes'
+    assert headers.get('Content-Type') is None
+    assert headers.get('Content-Range') is None
 
-    # check resposne
+    # check response
     assert response[0] == 200
     assert response[1].read() == test_string
 
 
-def test_get_dir_index_file_custom(tmp_get):
-    headers, response = run('GET', '/txtdir/', tmp_get, index_files=['index.html', 'index.txt'])
+def test_get_bad_value_range(tmp_get):
+    request_headers = web.HTTPHeaders()
+    request_headers.set('Range', 'bytes=a-b')
+    headers, response = run('GET', '/test', tmp_get, headers=request_headers)
 
     # check headers
-    assert headers.get('Content-Type') == 'text/plain'
     assert int(headers.get('Content-Length')) == len(test_string)
+    assert headers.get('Accept-Ranges') == 'bytes'
+    assert headers.get('Content-Type') is None
+    assert headers.get('Content-Range') is None
 
-    # check resposne
+    # check response
     assert response[0] == 200
     assert response[1].read() == test_string
 
 
-def test_get_dir_index_file_no_mime(tmp_get):
-    headers, response = run('GET', '/baddir/', tmp_get, index_files=['index.bad'])
+@pytest.fixture(scope='function')
+def mmap_all(monkeypatch):
+    monkeypatch.setattr(file, 'mmap_min_size', 0)
+    monkeypatch.setattr(file, 'mmap_cache', collections.OrderedDict())
+
+
+def test_get_mmap(tmp_get, mmap_all):
+    headers, response = run('GET', '/test', tmp_get, handler=MappedPathHandler)
 
     # check headers
-    assert headers.get('Content-Type') is None
     assert int(headers.get('Content-Length')) == len(test_string)
+    assert headers.get('Accept-Ranges') == 'bytes'
 
-    # check resposne
+    # check response
     assert response[0] == 200
-    assert response[1].read() == test_string
-
+    assert isinstance(response[1], file.MappedIO)
+    assert bytes(response[1].read()) == test_string
 
-def test_get_emptydir(tmp_get):
-    headers, response = run('GET', '/..', tmp_get)
+    # check mapping is reused
+    assert len(file.mmap_cache) == 1
+    view = file.mmap_cache[os.path.join(tmp_get, 'test')][1]
 
-    # check headers
-    assert headers.get('Location') == '/'
+    headers, response = run('GET', '/test', tmp_get, handler=MappedPathHandler)
 
-    # check resposne
-    assert response[0] == 307
-    assert response[1] == ''
+    assert file.mmap_cache[os.path.join(tmp_get, 'test')][1] is view
+    assert bytes(response[1].read()) == test_string
 
 
-def test_get_backdir(tmp_get):
-    headers, response = run('GET', '/testdir/../test', tmp_get)
+def test_get_mmap_range(tmp_get, mmap_all):
+    request_headers = web.HTTPHeaders()
+    request_headers.set('Range', 'bytes=2-6')
+    headers, response = run('GET', '/test', tmp_get, headers=request_headers, handler=MappedPathHandler)
 
     # check headers
-    assert headers.get('Location') == '/test'
+    assert int(headers.get('Content-Length')) == 5
+    assert headers.get('Content-Range') == 'bytes 2-6/' + str(len(test_string))
 
-    # check resposne
-    assert response[0] == 307
-    assert response[1] == ''
+    # check response
+    assert response[0] == 206
+    assert bytes(response[1].read(5)) == test_string[2:7]
 
 
-def test_get_backdir_filename(tmp_get):
-    headers, response, handler = run('GET', '/testdir/../test', tmp_get, return_handler=True)
+def test_get_mmap_invalidate(tmp_get, mmap_all):
+    headers, response = run('GET', '/test', tmp_get, handler=MappedPathHandler)
 
-    assert handler.filename is None
+    assert bytes(response[1].read()) == test_string
 
+    # change contents and size
+    with open(os.path.join(tmp_get, 'test'), 'wb') as test_file:
+        test_file.write(test_multibyte)
 
-def test_get_backdir_past_remote(tmp_get):
-    headers, response, handler = run('GET', '/test2/testdir/../../', tmp_get, remote='/test2', return_handler=True)
+    headers, response = run('GET', '/test', tmp_get, handler=MappedPathHandler)
 
     # check headers
-    assert headers.get('Location') == '/test2/'
-
-    # check resposne
-    assert response[0] == 307
-    assert response[1] == ''
+    assert int(headers.get('Content-Length')) == len(test_multibyte)
 
+    # check response
+    assert bytes(response[1].read()) == test_multibyte
 
-def test_get_slash_handling(tmp_get):
-    headers, response, handler = run('GET', '/test', tmp_get + '/', remote='/', return_handler=True)
-
-    assert handler.local == tmp_get
-    assert handler.remote == ''
 
+def test_get_mmap_too_small(tmp_get):
+    headers, response = run('GET', '/test', tmp_get, handler=MappedPathHandler)
 
-def test_get_filename_handling(tmp_get):
-    headers, response, handler = run('GET', '/test2/magic', os.path.join(tmp_get, 'testdir/'), remote='/test2/', return_handler=True)
+    # check response
+    assert response[0] == 200
+    assert not isinstance(response[1], file.MappedIO)
+    assert response[1].read() == test_string
 
-    assert handler.local == os.path.join(tmp_get, 'testdir')
-    assert handler.remote == '/test2'
-    assert handler.filename == os.path.join(tmp_get, 'testdir', 'magic')
 
+def test_get_cache_policy(tmp_get):
+    policy = file.CachePolicy([file.CacheRule('*.txt', max_age=60, public=True), file.CacheRule(mime='text/*', no_cache=True)], default=file.CacheRule(no_store=True, expires=False))
 
-def test_get_custom_handler(tmp_get):
-    headers, response = run('GET', '/', os.path.join(tmp_get, 'test'), handler=FileHandler)
+    headers, response = run('GET', '/test.txt', tmp_get, cache_policy=policy)
 
     # check headers
-    assert int(headers.get('Content-Length')) == len(test_string)
-    assert headers.get('Accept-Ranges') == 'bytes'
-    assert headers.get('Content-Type') is None
-    assert headers.get('Content-Range') is None
+    assert headers.get('Cache-Control') == 'public, max-age=60'
+    assert headers.get('Expires')
 
     # check response
     assert response[0] == 200
     assert response[1].read() == test_string
 
-    # try dir_index
-    headers, response = run('GET', '/', os.path.join(tmp_get, 'testdir/'), handler=FileDirIndexHandler)
+    headers, response = run('GET', '/indexdir/', tmp_get, dir_index=True, cache_policy=policy)
 
-    # check resposne
-    assert response[0] == 200
-    assert response[1] == 'magic\n'
+    # check headers
+    assert headers.get('Cache-Control') == 'no-cache'
+    assert headers.get('Expires') is None
 
-    # try index function
-    headers, response = run('GET', '/', os.path.join(tmp_get, 'testdir/'), handler=FileSpecialIndexHandler)
+    headers, response = run('GET', '/test', tmp_get, cache_policy=policy)
 
-    # check resposne
-    assert response[0] == 200
-    assert response[1] == test_string
+    # check headers
+    assert headers.get('Cache-Control') == 'no-store'
+    assert headers.get('Expires') is None
 
 
-def test_get_custom_path_handler(tmp_get):
-    headers, response = run('GET', '/test', tmp_get, handler=PathHandler)
+def test_get_cache_policy_fingerprint(tmp_get):
+    for name in ['app.0123abcd.js', 'report-20240101.js']:
+        with open(os.path.join(tmp_get, name), 'wb') as asset:
+            asset.write(test_string)
 
-    # check headers
-    assert int(headers.get('Content-Length')) == len(test_string)
-    assert headers.get('Accept-Ranges') == 'bytes'
-    assert headers.get('Content-Type') is None
-    assert headers.get('Content-Range') is None
+    policy = file.CachePolicy([file.CacheRule('*.js', no_cache=True)])
 
-    # check response
-    assert response[0] == 200
-    assert response[1].read() == test_string
+    manifest = file.build_manifest(tmp_get)
+    entry = manifest.get('/test.txt')
 
-    # try dir_index
-    headers, response = run('GET', '/testdir/', tmp_get, handler=PathDirIndexHandler)
+    handler = list(file.new(tmp_get, cache_policy=policy, manifest=manifest).values())[0]
 
-    # check resposne
-    assert response[0] == 200
-    assert response[1] == 'magic\n'
+    headers, response = run('GET', entry.fingerprinted, tmp_get, handler=handler)
 
-    # try index function
-    headers, response = run('GET', '/testdir/', tmp_get, handler=PathSpecialIndexHandler)
+    # check headers
+    assert headers.get('Cache-Control') == 'public, max-age=31536000, immutable'
 
-    # check resposne
-    assert response[0] == 200
-    assert response[1] == test_string
+    # check names that only look fingerprinted are left to the other rules
+    for name in ['/app.0123abcd.js', '/report-20240101.js']:
+        headers, response = run('GET', name, tmp_get, cache_policy=policy)
 
+        assert headers.get('Cache-Control') == 'no-cache'
 
-def test_get_custom_path_handler_group(tmp_get):
-    headers, response = run('GET', '/indexdir/', tmp_get, handler=CustomGroupHandler, groups={'custom': '/indexdir/'})
+    headers, response = run('GET', '/test', tmp_get, cache_policy=policy)
 
     # check headers
-    assert headers.get('Content-Type') == 'text/html'
-    assert int(headers.get('Content-Length')) == len(test_string)
+    assert headers.get('Cache-Control') is None
 
-    # check resposne
-    assert response[0] == 200
-    assert response[1].read() == test_string
 
+def test_get_cache_policy_regex(tmp_get):
+    policy = file.CachePolicy([file.CacheRule(re.compile(r'/testdir/'), private=True, must_revalidate=True)], fingerprint=False)
 
-def test_get_bad_path_handler(tmp_get):
-    headers, response = run('GET', '/', tmp_get, handler=PathHandler, groups={'bad': '/'})
+    headers, response = run('GET', '/testdir/magic', tmp_get, cache_policy=policy)
 
     # check headers
-    assert headers.get('Location') == '/'
+    assert headers.get('Cache-Control') == 'private, must-revalidate'
 
-    # check resposne
-    assert response[0] == 307
-    assert response[1] == ''
+    # check lookup is remembered
+    assert policy.lookup('/testdir/magic') is policy.rules[0]
+    assert len(policy.lookups) == 1
 
 
-@pytest.fixture(scope='function')
-def tmp_put(tmpdir):
-    with tmpdir.join('exists').open('wb'):
-        pass
-    with tmpdir.join('forbidden').open('wb'):
-        pass
-    tmpdir.join('forbidden').chmod(stat.S_IREAD)
+def test_manifest(tmp_get):
+    manifest = file.build_manifest(tmp_get, '/static')
 
-    return str(tmpdir)
+    digest = hashlib.sha256(test_string).hexdigest()
 
+    # check entries
+    assert '/test.txt' in manifest
+    assert '/testdir/magic' in manifest
+    assert manifest.get('/test.txt').fingerprinted == '/test.' + digest[:file.fingerprint_length] + '.txt'
+    assert manifest.get('/test').fingerprinted == '/test.' + digest[:file.fingerprint_length]
+    assert manifest.get('/test.txt').etag == '"' + digest + '"'
+    assert manifest.url('/test.txt') == '/static/test.' + digest[:file.fingerprint_length] + '.txt'
+    assert '{assets[/test.txt]}'.format(assets=manifest) == manifest.url('/test.txt')
 
-def test_put_file(tmp_put):
-    headers, response = run('PUT', '/test', tmp_put, body=test_string, modify=True)
 
-    # check response
-    assert response[0] == 204
-    assert response[1] == ''
+def test_manifest_parallel(tmp_get):
+    serial = file.build_manifest(tmp_get)
+    parallel = file.build_manifest(tmp_get, processes=2)
 
-    headers, response = run('GET', '/test', tmp_put)
+    assert len(serial) == len(parallel)
+    for name in serial:
+        assert serial.get(name).fingerprinted == parallel.get(name).fingerprinted
 
-    # check response
-    assert response[0] == 200
-    assert response[1].read() == test_string
 
+def test_get_manifest(tmp_get):
+    manifest = file.build_manifest(tmp_get)
+    entry = manifest.get('/test.txt')
 
-def test_put_continue(tmp_put):
-    expect = web.HTTPHeaders()
-    expect.set('Expect', '100-continue')
+    route = file.new(tmp_get, manifest=manifest)
+    handler = list(route.values())[0]
 
-    headers, response, handler = run('PUT', '/continue', tmp_put, headers=expect, body=test_string, modify=True, return_handler=True)
+    headers, response = run('GET', entry.fingerprinted, tmp_get, handler=handler)
+
+    # check headers
+    assert int(headers.get('Content-Length')) == len(test_string)
+    assert headers.get('Content-Type') == 'text/plain'
+    assert headers.get('ETag') == entry.etag
+    assert headers.get('Cache-Control') == file.Manifest.cache_control
 
     # check response
-    assert response[0] == 204
-    assert response[1] == ''
+    assert response[0] == 200
+    assert response[1].read() == test_string
 
-    # check continue
-    assert handler.response.wfile.getvalue() == b'HTTP/1.1 100 Continue\r\n\r\n'
+    # check validation
+    request_headers = web.HTTPHeaders()
+    request_headers.set('If-None-Match', entry.etag)
+    headers, response = run('GET', entry.fingerprinted, tmp_get, headers=request_headers, handler=handler)
 
-    headers, response = run('GET', '/continue', tmp_put)
+    assert response[0] == 304
+    assert response[1] == ''
+
+    # check logical name still works
+    headers, response = run('GET', '/test.txt', tmp_get, handler=handler)
 
-    # check response
     assert response[0] == 200
+    assert headers.get('Cache-Control') is None
     assert response[1].read() == test_string
 
 
-def test_put_existing_file(tmp_put):
-    headers, response = run('PUT', '/exists', tmp_put, body=test_string, modify=True)
+def test_get_manifest_changed(tmp_get):
+    manifest = file.build_manifest(tmp_get)
+    entry = manifest.get('/test.txt')
+
+    handler = list(file.new(tmp_get, manifest=manifest).values())[0]
+
+    with open(os.path.join(tmp_get, 'test.txt'), 'ab') as changed:
+        changed.write(b'more')
+
+    # check a file changed since the manifest was built is not sent under its old fingerprint
+    with pytest.raises(web.HTTPError) as error:
+        run('GET', entry.fingerprinted, tmp_get, handler=handler)
+
+    assert error.value.code == 404
+
+
+def test_get_not_modified(tmp_get):
+    headers, response = run('GET', '/test', tmp_get)
+    response[1].close()
+
+    request_headers = web.HTTPHeaders()
+    request_headers.set('If-None-Match', '"other", W/' + headers.get('ETag'))
+    headers, response = run('GET', '/test', tmp_get, headers=request_headers)
+
+    assert response[0] == 304
+    assert response[1] == ''
+
+
+def test_get_mime(tmp_get):
+    headers, response = run('GET', '/test.txt', tmp_get)
+
+    # check headers
+    assert int(headers.get('Content-Length')) == len(test_string)
+    assert headers.get('Accept-Ranges') == 'bytes'
+    assert headers.get('Content-Type') == 'text/plain'
+    assert headers.get('Content-Range') is None
+
+    # check response
+    assert response[0] == 200
+    assert response[1].read() == test_string
+
+
+def test_get_notfound(tmp_get):
+    with pytest.raises(web.HTTPError) as error:
+        headers, response = run('GET', '/nonexistent', tmp_get)
+
+    assert error.value.code == 404
+
+    with pytest.raises(web.HTTPError) as error:
+        headers, response = run('GET', '/test/', tmp_get)
+
+    assert error.value.code == 404
+
+    with pytest.raises(web.HTTPError) as error:
+        headers, response = run('GET', '/test/nonexistent', tmp_get)
+
+    assert error.value.code == 404
+
+
+def test_get_forbidden(tmp_get):
+    with pytest.raises(web.HTTPError) as error:
+        headers, response = run('GET', '/forbidden', tmp_get)
+
+    assert error.value.code == 403
+
+
+@pytest.fixture(scope='function')
+def negative_cache(monkeypatch, tmp_get):
+    monkeypatch.setattr(file, 'negative_cache', collections.OrderedDict())
+
+    # make directory mtimes old enough to be trusted
+    for dirname in [tmp_get, os.path.join(tmp_get, 'testdir')]:
+        os.utime(dirname, (0, 0))
+
+
+def test_get_notfound_cached(tmp_get, negative_cache, monkeypatch):
+    with pytest.raises(web.HTTPError) as error:
+        run('GET', '/nonexistent', tmp_get)
+
+    assert error.value.code == 404
+    assert os.path.join(tmp_get, 'nonexistent') in file.negative_cache
+
+    # check second miss does not look at the file
+    def fail(*args, **kwargs):
+        raise AssertionError()
+
+    with monkeypatch.context() as context:
+        context.setattr(os.path, 'isdir', fail)
+
+        with pytest.raises(web.HTTPError) as error:
+            run('GET', '/nonexistent', tmp_get)
+
+        assert error.value.code == 404
+
+        with pytest.raises(web.HTTPError) as error:
+            run('HEAD', '/nonexistent', tmp_get)
+
+        assert error.value.code == 404
+
+
+def test_get_notfound_cached_deep(tmp_get, negative_cache):
+    with pytest.raises(web.HTTPError) as error:
+        run('GET', '/testdir/missing/deeper', tmp_get)
+
+    assert error.value.code == 404
+    assert file.negative_cache[os.path.join(tmp_get, 'testdir/missing/deeper')][0] == os.path.join(tmp_get, 'testdir')
+
+
+def test_get_notfound_cached_invalidate(tmp_get, negative_cache):
+    with pytest.raises(web.HTTPError) as error:
+        run('GET', '/nonexistent', tmp_get)
+
+    assert error.value.code == 404
+    assert file.is_missing(os.path.join(tmp_get, 'nonexistent'))
+
+    headers, response = run('PUT', '/nonexistent', tmp_get, body=test_string, modify=True)
+
+    # check response
+    assert response[0] == 204
+
+    headers, response = run('GET', '/nonexistent', tmp_get)
+
+    # check response
+    assert response[0] == 200
+    assert response[1].read() == test_string
+    assert os.path.join(tmp_get, 'nonexistent') not in file.negative_cache
+
+
+@pytest.mark.skipif(not watch.inotify_available, reason='inotify not available')
+def test_get_notfound_watched(tmp_get, monkeypatch):
+    monkeypatch.setattr(file, 'negative_cache', collections.OrderedDict())
+    monkeypatch.setattr(file, 'watcher', None)
+
+    route = file.new(tmp_get, watch=True)
+    handler = list(route.values())[0]
+
+    with pytest.raises(web.HTTPError) as error:
+        run('GET', '/nonexistent', tmp_get, handler=handler)
+
+    # check fresh directory is trusted when watched
+    assert error.value.code == 404
+    assert file.watcher.covers(tmp_get)
+    assert os.path.join(tmp_get, 'nonexistent') in file.negative_cache
+
+    # check cached miss needs no stat
+    def fail(*args, **kwargs):
+        raise AssertionError()
+
+    with monkeypatch.context() as context:
+        context.setattr(os, 'stat', fail)
+
+        assert file.is_missing(os.path.join(tmp_get, 'nonexistent'))
+
+    with open(os.path.join(tmp_get, 'nonexistent'), 'wb') as created:
+        created.write(test_string)
+
+    headers, response = run('GET', '/nonexistent', tmp_get, handler=handler)
+
+    # check response
+    assert response[0] == 200
+    assert response[1].read() == test_string
+
+    file.watcher.close()
+
+
+def test_get_notfound_recent(tmp_get, monkeypatch):
+    monkeypatch.setattr(file, 'negative_cache', collections.OrderedDict())
+
+    with pytest.raises(web.HTTPError) as error:
+        run('GET', '/nonexistent', tmp_get)
+
+    # check fresh directory is not trusted
+    assert error.value.code == 404
+    assert not file.negative_cache
+
+
+@pytest.fixture(scope='function')
+def tmp_symlink(tmp_get, tmpdir_factory):
+    outside = tmpdir_factory.mktemp('outside')
+    with outside.join('secret').open('wb') as secret:
+        secret.write(test_string)
+
+    os.symlink(str(outside.join('secret')), os.path.join(tmp_get, 'escape'))
+    os.symlink(os.path.join(tmp_get, 'test'), os.path.join(tmp_get, 'testdir', 'inside'))
+
+    return tmp_get
+
+
+def test_get_symlink(tmp_symlink):
+    headers, response = run('GET', '/escape', tmp_symlink)
+
+    # check response
+    assert response[0] == 200
+    assert response[1].read() == test_string
+
+
+@pytest.mark.parametrize('openat2', [True, False])
+def test_get_confine(tmp_symlink, monkeypatch, openat2):
+    if not openat2:
+        monkeypatch.setattr(file, 'openat2_available', False)
+
+    route = file.new(tmp_symlink, confine=True)
+    handler = list(route.values())[0]
+
+    with pytest.raises(web.HTTPError) as error:
+        run('GET', '/escape', tmp_symlink, handler=handler)
+
+    assert error.value.code == 403
+
+    headers, response = run('GET', '/testdir/magic', tmp_symlink, handler=handler)
+
+    # check response
+    assert response[0] == 200
+    assert response[1].read() == b''
+
+    headers, response = run('GET', '/testdir', tmp_symlink, handler=handler)
+
+    # check response
+    assert response[0] == 307
+
+
+def test_get_mmap_confine(tmp_symlink, mmap_all):
+    route = file.new(tmp_symlink, use_mmap=True, confine=True)
+    handler = list(route.values())[0]
+
+    # check mapped files are confined too
+    with pytest.raises(web.HTTPError) as error:
+        run('GET', '/escape', tmp_symlink, handler=handler)
+
+    assert error.value.code == 403
+    assert not file.mmap_cache
+
+    headers, response = run('GET', '/test', tmp_symlink, handler=handler)
+
+    # check response
+    assert response[0] == 200
+    assert isinstance(response[1], file.MappedIO)
+    assert bytes(response[1].read()) == test_string
+
+
+def test_open_root(tmp_get, tmpdir_factory, monkeypatch):
+    monkeypatch.setattr(file, 'root_fds', {})
+    monkeypatch.setattr(file, 'root_check_interval', 0)
+
+    fd = file.open_root(tmp_get)
+
+    # check descriptor is reused
+    assert file.open_root(tmp_get) == fd
+
+    # check swapped directory is reopened
+    other = tmpdir_factory.mktemp('other')
+    os.rename(tmp_get, str(other) + '.old')
+    os.rename(str(other), tmp_get)
+
+    new_fd = file.open_root(tmp_get)
+    assert os.fstat(new_fd).st_ino == os.stat(tmp_get).st_ino
+
+    os.close(new_fd)
+
+
+def test_get_dir(tmp_get):
+    headers, response = run('GET', '/testdir', tmp_get)
+
+    # check headers
+    assert headers.get('Location') == '/testdir/'
+
+    # check resposne
+    assert response[0] == 307
+    assert response[1] == ''
+
+
+def test_get_null(tmp_get):
+    with pytest.raises(web.HTTPError) as error:
+        headers, response = run('GET', '/\x00', tmp_get)
+
+    assert error.value.code == 400
+
+
+def test_get_dir_index_listing(tmp_get):
+    headers, response = run('GET', '/testdir/', tmp_get, dir_index=True)
+
+    # check resposne
+    assert response[0] == 200
+    assert response[1] == 'magic\n'
+
+
+def test_get_no_dir_index_listing(tmp_get):
+    with pytest.raises(web.HTTPError) as error:
+        headers, response = run('GET', '/testdir/', tmp_get)
+
+    assert error.value.code == 403
+
+
+def test_get_dir_no_index_file(tmp_get):
+    with pytest.raises(web.HTTPError) as error:
+        headers, response = run('GET', '/indexdir/', tmp_get)
+
+    assert error.value.code == 403
+
+
+def test_get_dir_index_file(tmp_get):
+    headers, response = run('GET', '/indexdir/', tmp_get, dir_index=True)
+
+    # check headers
+    assert headers.get('Content-Type') == 'text/html'
+    assert int(headers.get('Content-Length')) == len(test_string)
+
+    # check resposne
+    assert response[0] == 200
+    assert response[1].read() == test_string
+
+
+def test_get_dir_index_file_custom(tmp_get):
+    headers, response = run('GET', '/txtdir/', tmp_get, index_files=['index.html', 'index.txt'])
+
+    # check headers
+    assert headers.get('Content-Type') == 'text/plain'
+    assert int(headers.get('Content-Length')) == len(test_string)
+
+    # check resposne
+    assert response[0] == 200
+    assert response[1].read() == test_string
+
+
+def test_get_dir_index_file_no_mime(tmp_get):
+    headers, response = run('GET', '/baddir/', tmp_get, index_files=['index.bad'])
+
+    # check headers
+    assert headers.get('Content-Type') is None
+    assert int(headers.get('Content-Length')) == len(test_string)
+
+    # check resposne
+    assert response[0] == 200
+    assert response[1].read() == test_string
+
+
+def test_get_emptydir(tmp_get):
+    headers, response = run('GET', '/..', tmp_get)
+
+    # check headers
+    assert headers.get('Location') == '/'
+
+    # check resposne
+    assert response[0] == 307
+    assert response[1] == ''
+
+
+def test_get_backdir(tmp_get):
+    headers, response = run('GET', '/testdir/../test', tmp_get)
+
+    # check headers
+    assert headers.get('Location') == '/test'
+
+    # check resposne
+    assert response[0] == 307
+    assert response[1] == ''
+
+
+def test_get_backdir_filename(tmp_get):
+    headers, response, handler = run('GET', '/testdir/../test', tmp_get, return_handler=True)
+
+    assert handler.filename is None
+
+
+def test_get_backdir_past_remote(tmp_get):
+    headers, response, handler = run('GET', '/test2/testdir/../../', tmp_get, remote='/test2', return_handler=True)
+
+    # check headers
+    assert headers.get('Location') == '/test2/'
+
+    # check resposne
+    assert response[0] == 307
+    assert response[1] == ''
+
+
+def test_get_slash_handling(tmp_get):
+    headers, response, handler = run('GET', '/test', tmp_get + '/', remote='/', return_handler=True)
+
+    assert handler.local == tmp_get
+    assert handler.remote == ''
+
+
+def test_get_filename_handling(tmp_get):
+    headers, response, handler = run('GET', '/test2/magic', os.path.join(tmp_get, 'testdir/'), remote='/test2/', return_handler=True)
+
+    assert handler.local == os.path.join(tmp_get, 'testdir')
+    assert handler.remote == '/test2'
+    assert handler.filename == os.path.join(tmp_get, 'testdir', 'magic')
+
+
+def test_get_custom_handler(tmp_get):
+    headers, response = run('GET', '/', os.path.join(tmp_get, 'test'), handler=FileHandler)
+
+    # check headers
+    assert int(headers.get('Content-Length')) == len(test_string)
+    assert headers.get('Accept-Ranges') == 'bytes'
+    assert headers.get('Content-Type') is None
+    assert headers.get('Content-Range') is None
+
+    # check response
+    assert response[0] == 200
+    assert response[1].read() == test_string
+
+    # try dir_index
+    headers, response = run('GET', '/', os.path.join(tmp_get, 'testdir/'), handler=FileDirIndexHandler)
+
+    # check resposne
+    assert response[0] == 200
+    assert response[1] == 'magic\n'
+
+    # try index function
+    headers, response = run('GET', '/', os.path.join(tmp_get, 'testdir/'), handler=FileSpecialIndexHandler)
+
+    # check resposne
+    assert response[0] == 200
+    assert response[1] == test_string
+
+
+def test_get_custom_path_handler(tmp_get):
+    headers, response = run('GET', '/test', tmp_get, handler=PathHandler)
+
+    # check headers
+    assert int(headers.get('Content-Length')) == len(test_string)
+    assert headers.get('Accept-Ranges') == 'bytes'
+    assert headers.get('Content-Type') is None
+    assert headers.get('Content-Range') is None
+
+    # check response
+    assert response[0] == 200
+    assert response[1].read() == test_string
+
+    # try dir_index
+    headers, response = run('GET', '/testdir/', tmp_get, handler=PathDirIndexHandler)
+
+    # check resposne
+    assert response[0] == 200
+    assert response[1] == 'magic\n'
+
+    # try index function
+    headers, response = run('GET', '/testdir/', tmp_get, handler=PathSpecialIndexHandler)
+
+    # check resposne
+    assert response[0] == 200
+    assert response[1] == test_string
+
+
+def test_get_custom_path_handler_group(tmp_get):
+    headers, response = run('GET', '/indexdir/', tmp_get, handler=CustomGroupHandler, groups={'custom': '/indexdir/'})
+
+    # check headers
+    assert headers.get('Content-Type') == 'text/html'
+    assert int(headers.get('Content-Length')) == len(test_string)
+
+    # check resposne
+    assert response[0] == 200
+    assert response[1].read() == test_string
+
+
+def test_get_bad_path_handler(tmp_get):
+    headers, response = run('GET', '/', tmp_get, handler=PathHandler, groups={'bad': '/'})
+
+    # check headers
+    assert headers.get('Location') == '/'
+
+    # check resposne
+    assert response[0] == 307
+    assert response[1] == ''
+
+
+def run_archive(local, resource, query, handler=None):
+    if handler is None:
+        handler = list(file.new(local, archive=True).values())[0]
+
+    return run('GET', resource, local, handler=handler, groups={'path': resource, 'query': query})
+
+
+def test_get_archive_tar(tmp_get):
+    headers, response = run_archive(tmp_get, '/testdir/', '?archive=tar')
+
+    # check response
+    assert response[0] == 200
+    assert headers.get('Content-Type') == 'application/x-tar'
+    assert headers.get('Content-Disposition') == "attachment; filename*=UTF-8''testdir.tar"
+    assert headers.get('Content-Length') is None
+
+    with tarfile.open(fileobj=io.BytesIO(response[1].read())) as archive:
+        assert archive.getnames() == ['magic']
+        assert archive.extractfile('magic').read() == b''
+
+    headers, response = run_archive(tmp_get, '/', '?archive=tar')
+
+    with tarfile.open(fileobj=io.BytesIO(response[1].read())) as archive:
+        names = archive.getnames()
+
+        assert 'testdir' in names
+        assert 'testdir/magic' in names
+        assert archive.getmember('testdir').isdir()
+        assert archive.extractfile('test').read() == test_string
+
+
+@pytest.mark.parametrize('query', ['?archive=zip', '?archive=zip&store'])
+def test_get_archive_zip(tmp_get, query):
+    headers, response = run_archive(tmp_get, '/', query)
+
+    # check response
+    assert response[0] == 200
+    assert headers.get('Content-Type') == 'application/zip'
+    assert headers.get('Content-Disposition') == "attachment; filename*=UTF-8''index.zip"
+
+    with zipfile.ZipFile(io.BytesIO(response[1].read())) as archive:
+        assert archive.testzip() is None
+
+        assert 'testdir/' in archive.namelist()
+        assert archive.read('test') == test_string
+        assert archive.read('testdir/magic') == b''
+
+        assert archive.getinfo('test').compress_type == (zipfile.ZIP_STORED if 'store' in query else zipfile.ZIP_DEFLATED)
+
+
+def test_get_archive_zip_level(tmp_get, monkeypatch):
+    text = b''.join(str(idx).encode() + b' bottles of beer\n' for idx in range(4096))
+    with open(os.path.join(tmp_get, 'testdir', 'text'), 'wb') as text_file:
+        text_file.write(text)
+
+    sizes = {}
+    for level in [1, 9]:
+        monkeypatch.setattr(file, 'archive_compresslevel', level)
+
+        headers, response = run_archive(tmp_get, '/testdir/', '?archive=zip')
+
+        with zipfile.ZipFile(io.BytesIO(response[1].read())) as archive:
+            assert archive.read('text') == text
+
+            sizes[level] = archive.getinfo('text').compress_size
+
+    # check the configured level is used where zipfile supports one
+    if hasattr(zipfile.ZipInfo('text'), '_compresslevel'):
+        assert sizes[1] > sizes[9]
+
+
+def test_get_archive_large_file(tmp_get, monkeypatch):
+    monkeypatch.setattr(file, 'archive_chunk_size', 7)
+
+    large = os.urandom(100)
+    with open(os.path.join(tmp_get, 'testdir', 'large'), 'wb') as large_file:
+        large_file.write(large)
+
+    for query in ['?archive=tar', '?archive=zip']:
+        headers, response = run_archive(tmp_get, '/testdir/', query)
+
+        body = response[1].read()
+
+        if query.endswith('tar'):
+            with tarfile.open(fileobj=io.BytesIO(body)) as archive:
+                assert archive.extractfile('large').read() == large
+        else:
+            with zipfile.ZipFile(io.BytesIO(body)) as archive:
+                assert archive.read('large') == large
+
+
+def test_get_archive_disabled(tmp_get):
+    headers, response = run('GET', '/testdir/', tmp_get, dir_index=True, groups={'path': '/testdir/', 'query': '?archive=tar'})
+
+    # check the listing is sent instead
+    assert response[0] == 200
+    assert response[1] == 'magic\n'
+
+
+def test_get_archive_unknown(tmp_get):
+    with pytest.raises(web.HTTPError) as error:
+        run_archive(tmp_get, '/testdir/', '?archive=rar')
+
+    assert error.value.code == 400
+
+
+def test_get_archive_confine(tmp_symlink):
+    handler = list(file.new(tmp_symlink, archive=True, confine=True).values())[0]
+
+    headers, response = run_archive(tmp_symlink, '/', '?archive=tar', handler=handler)
+
+    with tarfile.open(fileobj=io.BytesIO(response[1].read())) as archive:
+        names = archive.getnames()
+
+        # check escaping symlinks are left out
+        assert 'escape' not in names
+        assert 'test' in names
+
+
+@pytest.fixture(scope='function')
+def tmp_put(tmpdir):
+    with tmpdir.join('exists').open('wb'):
+        pass
+    with tmpdir.join('forbidden').open('wb'):
+        pass
+    tmpdir.join('forbidden').chmod(stat.S_IREAD)
+
+    return str(tmpdir)
+
+
+def test_put_file(tmp_put):
+    headers, response = run('PUT', '/test', tmp_put, body=test_string, modify=True)
+
+    # check response
+    assert response[0] == 204
+    assert response[1] == ''
+
+    headers, response = run('GET', '/test', tmp_put)
+
+    # check response
+    assert response[0] == 200
+    assert response[1].read() == test_string
+
+
+def test_put_continue(tmp_put):
+    expect = web.HTTPHeaders()
+    expect.set('Expect', '100-continue')
+
+    headers, response, handler = run('PUT', '/continue', tmp_put, headers=expect, body=test_string, modify=True, return_handler=True)
+
+    # check response
+    assert response[0] == 204
+    assert response[1] == ''
+
+    # check continue
+    assert handler.response.wfile.getvalue() == b'HTTP/1.1 100 Continue\r\n\r\n'
+
+    headers, response = run('GET', '/continue', tmp_put)
+
+    # check response
+    assert response[0] == 200
+    assert response[1].read() == test_string
+
+
+def test_put_existing_file(tmp_put):
+    headers, response = run('PUT', '/exists', tmp_put, body=test_string, modify=True)
+
+    # check response
+    assert response[0] == 204
+    assert response[1] == ''
+
+    headers, response = run('GET', '/exists', tmp_put)
+
+    # check response
+    assert response[0] == 200
+    assert response[1].read() == test_string
+
+
+def test_put_forbidden(tmp_put):
+    with pytest.raises(web.HTTPError) as error:
+        headers, response = run('PUT', '/forbidden', tmp_put, body=test_string, modify=True)
+
+    assert error.value.code == 403
+
+    headers, response = run('GET', '/forbidden', tmp_put)
+
+    # check response
+    assert response[0] == 200
+    assert response[1].read() != test_string
+
+
+def test_put_dir(tmp_put):
+    with pytest.raises(web.HTTPError) as error:
+        run('PUT', '/testdir/', tmp_put, body=test_string, modify=True)
+
+    assert error.value.code == 403
+
+    headers, response = run('GET', '/testdir/', tmp_put, dir_index=True)
+
+    # check response
+    assert response[0] == 200
+    assert response[1] == ''
+
+
+def test_put_null(tmp_put):
+    with pytest.raises(web.HTTPError) as error:
+        headers, response = run('PUT', '/\x00', tmp_put, body=test_string, modify=True)
+
+    assert error.value.code == 400
+
+
+def test_put_nomodify(tmp_put):
+    with pytest.raises(web.HTTPError) as error:
+        headers, response = run('PUT', '/test', tmp_put, body=test_string, modify=False)
+
+    assert error.value.code == 405
+
+
+def test_put_no_length(tmp_put):
+    headers, response = run('PUT', '/test', tmp_put, body=test_string, modify=True)
+
+    # check response
+    assert response[0] == 204
+    assert response[1] == ''
+
+    headers, response = run('GET', '/test', tmp_put)
+
+    # check response
+    assert response[0] == 200
+    assert response[1].read() == test_string
+
+    headers, response = run('PUT', '/test', tmp_put, modify=True)
+
+    # check response
+    assert response[0] == 204
+    assert response[1] == ''
+
+    headers, response = run('GET', '/test', tmp_put)
+
+    # check response
+    assert response[0] == 200
+    assert response[1].read() == b''
+
+
+def test_put_too_large(tmp_put):
+    # check response
+    request_headers = web.HTTPHeaders()
+    request_headers.set('Content-Length', str(file.max_file_size + 1))
+    with pytest.raises(web.HTTPError) as error:
+        headers, response = run('PUT', '/test', tmp_put, headers=request_headers, body='', modify=True)
+
+    assert error.value.code == 413
+
+
+def test_put_chunked(tmp_put):
+    request_headers = web.HTTPHeaders()
+    request_headers.set('Transfer-Encoding', 'chunked')
+    headers, response = run('PUT', '/test', tmp_put, headers=request_headers, body=test_chunked, modify=True)
+
+    # check response
+    assert response[0] == 204
+    assert response[1] == ''
+
+    headers, response = run('GET', '/test', tmp_put)
+
+    # check response
+    assert response[0] == 200
+    assert response[1].read() == test_multibyte
+
+
+def test_put_chunked_no_body(tmp_put):
+    # check response
+    request_headers = web.HTTPHeaders()
+    request_headers.set('Transfer-Encoding', 'chunked')
+    with pytest.raises(web.HTTPError) as error:
+        headers, response = run('PUT', '/test', tmp_put, headers=request_headers, body='', modify=True)
+
+    assert error.value.code == 400
+
+
+def test_put_chunked_bad_length(tmp_put):
+    # check response
+    request_headers = web.HTTPHeaders()
+    request_headers.set('Transfer-Encoding', 'chunked')
+    with pytest.raises(web.HTTPError) as error:
+        headers, response = run('PUT', '/test', tmp_put, headers=request_headers, body='g\r\n\r\n', modify=True)
+
+    assert error.value.code == 400
+
+
+def test_put_chunked_no_zero(tmp_put):
+    # check response
+    request_headers = web.HTTPHeaders()
+    request_headers.set('Transfer-Encoding', 'chunked')
+    with pytest.raises(web.HTTPError) as error:
+        headers, response = run('PUT', '/test', tmp_put, headers=request_headers, body='3\r\n123\r\n', modify=True)
+
+    assert error.value.code == 400
+
+
+def test_put_chunked_no_trailer(tmp_put):
+    # check response
+    request_headers = web.HTTPHeaders()
+    request_headers.set('Transfer-Encoding', 'chunked')
+    with pytest.raises(web.HTTPError) as error:
+        headers, response = run('PUT', '/test', tmp_put, headers=request_headers, body='3\r\n123\r\n0\r\n', modify=True)
+
+    assert error.value.code == 400
+
+
+def test_put_chunked_no_separator(tmp_put):
+    # check response
+    request_headers = web.HTTPHeaders()
+    request_headers.set('Transfer-Encoding', 'chunked')
+    with pytest.raises(web.HTTPError) as error:
+        headers, response = run('PUT', '/test', tmp_put, headers=request_headers, body='3\r\n1230\r\n\r\n', modify=True)
+
+    assert error.value.code == 400
+
+
+def test_put_chunked_incomplete(tmp_put):
+    # check response
+    request_headers = web.HTTPHeaders()
+    request_headers.set('Transfer-Encoding', 'chunked')
+    with pytest.raises(web.HTTPError) as error:
+        headers, response = run('PUT', '/test', tmp_put, headers=request_headers, body='3\r\n12', modify=True)
+
+    assert error.value.code == 400
+
+
+def test_put_chunked_too_large(tmp_put):
+    # check response
+    request_headers = web.HTTPHeaders()
+    request_headers.set('Transfer-Encoding', 'chunked')
+    with pytest.raises(web.HTTPError) as error:
+        headers, response = run('PUT', '/test', tmp_put, headers=request_headers, body='{:x}\r\n'.format(file.max_file_size + 1), modify=True)
+
+    assert error.value.code == 413
+
+
+def test_put_chunked_second_too_large(tmp_put):
+    # check response
+    request_headers = web.HTTPHeaders()
+    request_headers.set('Transfer-Encoding', 'chunked')
+    with pytest.raises(web.HTTPError) as error:
+        headers, response = run('PUT', '/test', tmp_put, headers=request_headers, body='{:x}\r\n'.format(file.max_file_size) + 'a' * file.max_file_size + '\r\n1\r\na\r\n0\r\n\r\n', modify=True)
+
+    assert error.value.code == 413
+
+
+def test_put_custom_handler(tmp_put):
+    headers, response = run('PUT', '/', os.path.join(tmp_put, 'test'), body=test_string, handler=ModifyFileHandler)
 
     # check response
     assert response[0] == 204
     assert response[1] == ''
 
+    headers, response = run('GET', '/', os.path.join(tmp_put, 'test'), handler=ModifyFileHandler)
+
+    # check response
+    assert response[0] == 200
+    assert response[1].read() == test_string
+
+
+def test_put_custom_handler_nomodify(tmp_put):
+    with pytest.raises(web.HTTPError) as error:
+        headers, response = run('PUT', '/', os.path.join(tmp_put, 'test'), body=test_string, handler=FileHandler)
+
+    assert error.value.code == 405
+
+
+def test_put_incomplete(tmp_put):
+    request_headers = web.HTTPHeaders()
+    request_headers.set('Content-Length', str(len(test_string) + 10))
+    with pytest.raises(web.HTTPError) as error:
+        headers, response = run('PUT', '/test', tmp_put, headers=request_headers, body=test_string, modify=True)
+
+    assert error.value.code == 400
+
+    # check no partial file or temporary file is left behind
+    assert sorted(os.listdir(tmp_put)) == ['exists', 'forbidden']
+
+
+def test_put_incomplete_existing(tmp_put):
+    with open(os.path.join(tmp_put, 'exists'), 'wb') as existing:
+        existing.write(test_string)
+
+    request_headers = web.HTTPHeaders()
+    request_headers.set('Content-Length', '100')
+    with pytest.raises(web.HTTPError) as error:
+        headers, response = run('PUT', '/exists', tmp_put, headers=request_headers, body=b'partial', modify=True)
+
+    assert error.value.code == 400
+
     headers, response = run('GET', '/exists', tmp_put)
 
-    # check response
-    assert response[0] == 200
-    assert response[1].read() == test_string
+    # check old file is untouched
+    assert response[0] == 200
+    assert response[1].read() == test_string
+
+    assert sorted(os.listdir(tmp_put)) == ['exists', 'forbidden']
+
+
+def test_put_small_buffer(tmp_put, monkeypatch):
+    monkeypatch.setattr(file, 'upload_buffer_size', 3)
+    monkeypatch.setattr(file, 'upload_view', None)
+
+    request_headers = web.HTTPHeaders()
+    request_headers.set('Transfer-Encoding', 'chunked')
+    headers, response = run('PUT', '/chunked', tmp_put, headers=request_headers, body='{:x}\r\n'.format(len(test_string)).encode() + test_string + b'\r\n0\r\n\r\n', modify=True)
+
+    assert response[0] == 204
+
+    headers, response = run('PUT', '/test', tmp_put, body=test_string, modify=True)
+
+    assert response[0] == 204
+
+    for resource in ['/chunked', '/test']:
+        headers, response = run('GET', resource, tmp_put)
+
+        assert response[0] == 200
+        assert response[1].read() == test_string
+
+
+def test_put_keeps_mode(tmp_put):
+    os.chmod(os.path.join(tmp_put, 'exists'), 0o640)
+
+    headers, response = run('PUT', '/exists', tmp_put, body=test_string, modify=True)
+
+    assert response[0] == 204
+
+    assert stat.S_IMODE(os.stat(os.path.join(tmp_put, 'exists')).st_mode) == 0o640
+
+
+def test_put_fsync(tmp_put):
+    for fsync in ['file', 'full']:
+        headers, response = run('PUT', '/sync/' + fsync, tmp_put, body=test_string, handler=web.HTTPHandlerWrapper(file.ModifyPathHandler, fsync=fsync))
+
+        assert response[0] == 204
+
+        with open(os.path.join(tmp_put, 'sync', fsync), 'rb') as synced:
+            assert synced.read() == test_string
+
+
+def range_headers(content_range, etag=None):
+    request_headers = web.HTTPHeaders()
+    request_headers.set('Content-Range', content_range)
+
+    if etag:
+        request_headers.set('If-Match', etag)
+
+    return request_headers
+
+
+def test_put_range(tmp_put):
+    headers, response, handler = run('PUT', '/ranged', tmp_put, headers=range_headers('bytes 5-{}/{}'.format(len(test_string) - 1, len(test_string))), body=test_string[5:], modify=True, return_handler=True)
+
+    # check response
+    assert response[0] == 202
+    assert headers.get('Range') == 'bytes=5-{}'.format(len(test_string) - 1)
+    assert headers.get('ETag')
+
+    # check ranged writes do not lock each other out
+    assert 'put' in handler.reader
+
+    # check nothing is visible yet
+    assert not os.path.exists(os.path.join(tmp_put, 'ranged'))
+
+    headers, response = run('PUT', '/ranged', tmp_put, headers=range_headers('bytes 0-4/{}'.format(len(test_string)), headers.get('ETag')), body=test_string[:5], modify=True)
+
+    # check response
+    assert response[0] == 204
+    assert response[1] == ''
+
+    headers, response = run('GET', '/ranged', tmp_put)
+
+    # check response
+    assert response[0] == 200
+    assert response[1].read() == test_string
+
+    # check staging files are cleaned up
+    assert sorted(os.listdir(tmp_put)) == ['exists', 'forbidden', 'ranged']
+
+
+def test_put_range_status(tmp_put):
+    headers, response = run('PUT', '/ranged', tmp_put, headers=range_headers('bytes 0-1/10'), body=b'01', modify=True)
+
+    etag = headers.get('ETag')
+
+    run('PUT', '/ranged', tmp_put, headers=range_headers('bytes 2-3/10', etag), body=b'23', modify=True)
+    run('PUT', '/ranged', tmp_put, headers=range_headers('bytes 6-7/10', etag), body=b'67', modify=True)
+
+    headers, response = run('PUT', '/ranged', tmp_put, headers=range_headers('bytes */10', etag), modify=True)
+
+    # check response
+    assert response[0] == 202
+    assert headers.get('Range') == 'bytes=0-3,6-7'
+    assert headers.get('ETag') == etag
+
+
+def test_put_range_reserve(tmp_put):
+    # check an upload cannot be started without sending any of it
+    with pytest.raises(web.HTTPError) as error:
+        run('PUT', '/ranged', tmp_put, headers=range_headers('bytes */20000000'), modify=True)
+
+    assert error.value.code == 400
+
+    assert sorted(os.listdir(tmp_put)) == ['exists', 'forbidden']
+
+
+def test_put_range_expire(tmp_put):
+    headers, response = run('PUT', '/ranged', tmp_put, headers=range_headers('bytes 0-1/4'), body=b'01', modify=True)
+    etag = headers.get('ETag')
+
+    staging = sorted(name for name in os.listdir(tmp_put) if name.startswith('.ranged.'))
+    assert len(staging) == 2
+
+    # check staging files are not served
+    for name in staging:
+        with pytest.raises(web.HTTPError) as error:
+            run('GET', '/' + name, tmp_put, modify=True)
+
+        assert error.value.code == 404
+
+    for name in staging:
+        os.utime(os.path.join(tmp_put, name), (0, 0))
+
+    run('PUT', '/other', tmp_put, headers=range_headers('bytes 0-1/4'), body=b'01', modify=True)
+
+    # check abandoned uploads are cleared out when another one starts
+    assert not any(name in os.listdir(tmp_put) for name in staging)
+
+    with pytest.raises(web.HTTPError) as error:
+        run('PUT', '/ranged', tmp_put, headers=range_headers('bytes 2-3/4', etag), body=b'23', modify=True)
+
+    assert error.value.code == 412
+
+
+def test_put_range_separate(tmp_put):
+    headers, response = run('PUT', '/ranged', tmp_put, headers=range_headers('bytes 0-1/4'), body=b'01', modify=True)
+    first = headers.get('ETag')
+
+    headers, response = run('PUT', '/ranged', tmp_put, headers=range_headers('bytes 0-1/4'), body=b'ab', modify=True)
+    second = headers.get('ETag')
+
+    # check two uploads of the same path do not share a staging file
+    assert first != second
+
+    headers, response = run('PUT', '/ranged', tmp_put, headers=range_headers('bytes 2-3/4', second), body=b'cd', modify=True)
+
+    assert response[0] == 204
+
+    with open(os.path.join(tmp_put, 'ranged'), 'rb') as ranged:
+        assert ranged.read() == b'abcd'
+
+    headers, response = run('PUT', '/ranged', tmp_put, headers=range_headers('bytes 2-3/4', first), body=b'23', modify=True)
+
+    assert response[0] == 204
+
+    with open(os.path.join(tmp_put, 'ranged'), 'rb') as ranged:
+        assert ranged.read() == b'0123'
+
+
+def test_put_range_foreign(tmp_put):
+    headers, response = run('PUT', '/ranged', tmp_put, headers=range_headers('bytes 0-1/10'), body=b'01', modify=True)
+    etag = headers.get('ETag')
+
+    # check ranges of a different length are refused
+    with pytest.raises(web.HTTPError) as error:
+        run('PUT', '/ranged', tmp_put, headers=range_headers('bytes 0-1/4', etag), body=b'ab', modify=True)
+
+    assert error.value.code == 416
+    assert error.value.headers.get('Content-Range') == 'bytes */10'
+
+    # check unknown and malformed tokens are refused
+    for token in ['"' + '0' * 32 + '"', '"../../etc"', '*']:
+        with pytest.raises(web.HTTPError) as error:
+            run('PUT', '/ranged', tmp_put, headers=range_headers('bytes 2-3/10', token), body=b'23', modify=True)
+
+        assert error.value.code == 412
+
+    with pytest.raises(web.HTTPError) as error:
+        run('PUT', '/ranged', tmp_put, headers=range_headers('bytes */10', '"' + '0' * 32 + '"'), modify=True)
+
+    assert error.value.code == 412
+
+    # check the started upload is untouched
+    headers, response = run('PUT', '/ranged', tmp_put, headers=range_headers('bytes */10', etag), modify=True)
+
+    assert headers.get('Range') == 'bytes=0-1'
+
+
+def test_put_range_empty(tmp_put):
+    headers, response = run('PUT', '/ranged', tmp_put, headers=range_headers('bytes */0'), modify=True)
+
+    assert response[0] == 204
+
+    with open(os.path.join(tmp_put, 'ranged'), 'rb') as ranged:
+        assert ranged.read() == b''
+
+
+def test_put_range_invalid(tmp_put):
+    for content_range, body, code in [('bytes 0-1', b'01', 400), ('bytes 1-0/2', b'01', 400), ('bytes 0-1/*', b'01', 400), ('bytes 0-2/2', b'012', 416), ('bytes 0-3/4', b'01', 400), ('bytes 0-1/{}'.format(file.max_file_size + 1), b'01', 413)]:
+        with pytest.raises(web.HTTPError) as error:
+            run('PUT', '/ranged', tmp_put, headers=range_headers(content_range), body=body, modify=True)
+
+        assert error.value.code == code
+
+    # check no file was made
+    assert not os.path.exists(os.path.join(tmp_put, 'ranged'))
+
+
+def test_patch_range(tmp_put):
+    headers, response = run('PATCH', '/ranged', tmp_put, headers=range_headers('bytes 0-{}/{}'.format(len(test_string) - 1, len(test_string))), body=test_string, modify=True)
+
+    assert response[0] == 204
+
+    headers, response = run('GET', '/ranged', tmp_put)
+
+    assert response[0] == 200
+    assert response[1].read() == test_string
+
+
+def test_patch_no_range(tmp_put):
+    with pytest.raises(web.HTTPError) as error:
+        run('PATCH', '/ranged', tmp_put, body=test_string, modify=True)
+
+    assert error.value.code == 400
+
+
+def test_parse_content_range():
+    assert file.parse_content_range('bytes 0-499/1234') == (0, 499, 1234)
+    assert file.parse_content_range('bytes */1234') == (None, None, 1234)
+    assert file.parse_content_range('bytes 500-499/1234') is None
+    assert file.parse_content_range('items 0-1/2') is None
+
+
+def test_add_range():
+    assert file.add_range([], 5, 9) == [[5, 9]]
+    assert file.add_range([[5, 9]], 0, 4) == [[0, 9]]
+    assert file.add_range([[0, 1], [8, 9]], 4, 5) == [[0, 1], [4, 5], [8, 9]]
+    assert file.add_range([[0, 1], [8, 9]], 1, 8) == [[0, 9]]
+
+
+def make_tar(files, compression='', links=None):
+    archive_bytes = io.BytesIO()
+
+    with tarfile.open(fileobj=archive_bytes, mode='w:' + compression) as archive:
+        for name, contents in files.items():
+            info = tarfile.TarInfo(name)
+            info.size = len(contents)
+            info.mode = 0o644
+            archive.addfile(info, io.BytesIO(contents))
+
+        for name, target in (links or {}).items():
+            info = tarfile.TarInfo(name)
+            info.type = tarfile.SYMTYPE
+            info.linkname = target
+            archive.addfile(info)
+
+    return archive_bytes.getvalue()
+
+
+def archive_headers(content_type='application/x-tar'):
+    request_headers = web.HTTPHeaders()
+    request_headers.set('Content-Type', content_type)
+
+    return request_headers
+
+
+def test_put_archive(tmp_put):
+    headers, response = run('PUT', '/site/', tmp_put, headers=archive_headers(), body=make_tar({'index.html': test_string, 'css/style.css': b'body {}', '../escape': b'escape'}), modify=True)
+
+    # check response
+    assert response[0] == 204
+    assert response[1] == ''
+
+    assert sorted(os.listdir(os.path.join(tmp_put, 'site'))) == ['css', 'escape', 'index.html']
+
+    headers, response = run('GET', '/site/css/style.css', tmp_put)
+
+    # check response
+    assert response[0] == 200
+    assert response[1].read() == b'body {}'
+
+    # check no temporary directories are left
+    assert sorted(os.listdir(tmp_put)) == ['exists', 'forbidden', 'site']
+
+
+def test_put_archive_replace(tmp_put):
+    run('PUT', '/site/', tmp_put, headers=archive_headers(), body=make_tar({'old': b'old'}), modify=True)
+
+    headers, response = run('PUT', '/site/', tmp_put, headers=archive_headers('application/x-tar; charset=binary'), body=make_tar({'new': b'new'}, 'gz'), modify=True)
+
+    # check response
+    assert response[0] == 204
+
+    # check the old tree was swapped out as a whole
+    assert os.listdir(os.path.join(tmp_put, 'site')) == ['new']
+    assert sorted(os.listdir(tmp_put)) == ['exists', 'forbidden', 'site']
+
+
+def test_put_archive_no_exchange(tmp_put, monkeypatch):
+    monkeypatch.setattr(file, 'renameat2_available', False)
+
+    run('PUT', '/site/', tmp_put, headers=archive_headers(), body=make_tar({'old': b'old'}), modify=True)
+    headers, response = run('PUT', '/site/', tmp_put, headers=archive_headers(), body=make_tar({'new': b'new'}), modify=True)
+
+    # check response
+    assert response[0] == 204
+
+    assert os.listdir(os.path.join(tmp_put, 'site')) == ['new']
+    assert sorted(os.listdir(tmp_put)) == ['exists', 'forbidden', 'site']
+
+
+def test_put_archive_bomb(tmp_put, monkeypatch):
+    monkeypatch.setattr(file, 'max_extract_size', 16)
+
+    # check the total unpacked size is limited
+    with pytest.raises(web.HTTPError) as error:
+        run('PUT', '/site/', tmp_put, headers=archive_headers(), body=make_tar({'a': b'0' * 10, 'b': b'0' * 10}, 'gz'), modify=True)
+
+    assert error.value.code == 413
+
+    monkeypatch.setattr(file, 'max_extract_size', 1048576)
+    monkeypatch.setattr(file, 'max_extract_members', 2)
+
+    # check the number of members is limited
+    with pytest.raises(web.HTTPError) as error:
+        run('PUT', '/site/', tmp_put, headers=archive_headers(), body=make_tar({'a': b'', 'b': b'', 'c': b''}), modify=True)
+
+    assert error.value.code == 413
+
+    assert sorted(os.listdir(tmp_put)) == ['exists', 'forbidden']
+
+
+def test_exchange_fallback_restores(tmp_put, monkeypatch):
+    monkeypatch.setattr(file, 'renameat2_available', False)
+
+    src = os.path.join(tmp_put, 'missing')
+    dst = os.path.join(tmp_put, 'exists')
+
+    # check the original is put back when the second rename fails
+    with pytest.raises(FileNotFoundError):
+        file.exchange(src, dst)
+
+    assert sorted(os.listdir(tmp_put)) == ['exists', 'forbidden']
+
 
+def test_put_archive_link(tmp_put):
+    run('PUT', '/site/', tmp_put, headers=archive_headers(), body=make_tar({'old': b'old'}), modify=True)
 
-def test_put_forbidden(tmp_put):
     with pytest.raises(web.HTTPError) as error:
-        headers, response = run('PUT', '/forbidden', tmp_put, body=test_string, modify=True)
+        run('PUT', '/site/', tmp_put, headers=archive_headers(), body=make_tar({'new': b'new'}, links={'passwd': '/etc/passwd'}), modify=True)
 
-    assert error.value.code == 403
+    assert error.value.code == 400
 
-    headers, response = run('GET', '/forbidden', tmp_put)
+    # check nothing changed
+    assert os.listdir(os.path.join(tmp_put, 'site')) == ['old']
+    assert sorted(os.listdir(tmp_put)) == ['exists', 'forbidden', 'site']
 
-    # check response
-    assert response[0] == 200
-    assert response[1].read() != test_string
 
+def test_put_archive_invalid(tmp_put):
+    for body in [b'', b'not a tar file' * 100]:
+        with pytest.raises(web.HTTPError) as error:
+            run('PUT', '/site/', tmp_put, headers=archive_headers(), body=body, modify=True)
 
-def test_put_dir(tmp_put):
+        assert error.value.code == 400
+
+    assert sorted(os.listdir(tmp_put)) == ['exists', 'forbidden']
+
+
+def test_put_archive_root(tmp_put):
     with pytest.raises(web.HTTPError) as error:
-        run('PUT', '/testdir/', tmp_put, body=test_string, modify=True)
+        run('PUT', '/', tmp_put, headers=archive_headers(), body=make_tar({'new': b'new'}), modify=True)
 
     assert error.value.code == 403
 
-    headers, response = run('GET', '/testdir/', tmp_put, dir_index=True)
 
-    # check response
-    assert response[0] == 200
-    assert response[1] == ''
+def test_put_archive_file(tmp_put):
+    tar = make_tar({'new': b'new'})
 
+    headers, response = run('PUT', '/site.tar', tmp_put, headers=archive_headers(), body=tar, modify=True)
 
-def test_put_null(tmp_put):
-    with pytest.raises(web.HTTPError) as error:
-        headers, response = run('PUT', '/\x00', tmp_put, body=test_string, modify=True)
+    # check archives sent to a file are stored as they are
+    assert response[0] == 204
 
-    assert error.value.code == 400
+    with open(os.path.join(tmp_put, 'site.tar'), 'rb') as stored:
+        assert stored.read() == tar
 
 
-def test_put_nomodify(tmp_put):
-    with pytest.raises(web.HTTPError) as error:
-        headers, response = run('PUT', '/test', tmp_put, body=test_string, modify=False)
+@pytest.fixture(scope='function')
+def tmp_copy(tmpdir):
+    with tmpdir.join('test').open('wb') as test:
+        test.write(test_string)
+    with tmpdir.join('other').open('wb'):
+        pass
+    testdir = tmpdir.mkdir('testdir')
+    with testdir.join('magic').open('wb') as magic:
+        magic.write(test_string)
+    testdir.mkdir('nested')
 
-    assert error.value.code == 405
+    return str(tmpdir)
 
 
-def test_put_no_length(tmp_put):
-    headers, response = run('PUT', '/test', tmp_put, body=test_string, modify=True)
+def destination_headers(destination, **extra):
+    request_headers = web.HTTPHeaders()
+    request_headers.set('Destination', destination)
+    for key, value in extra.items():
+        request_headers.set(key, value)
 
-    # check response
-    assert response[0] == 204
-    assert response[1] == ''
+    return request_headers
 
-    headers, response = run('GET', '/test', tmp_put)
+
+def test_copy_file(tmp_copy):
+    headers, response = run('COPY', '/test', tmp_copy, headers=destination_headers('http://localhost/copied/test'), modify=True)
 
     # check response
-    assert response[0] == 200
-    assert response[1].read() == test_string
+    assert response[0] == 201
+    assert response[1] == ''
 
-    headers, response = run('PUT', '/test', tmp_put, modify=True)
+    for name in ['test', 'copied/test']:
+        with open(os.path.join(tmp_copy, name), 'rb') as copied:
+            assert copied.read() == test_string
+
+    headers, response = run('COPY', '/test', tmp_copy, headers=destination_headers('/other'), modify=True)
 
     # check response
     assert response[0] == 204
-    assert response[1] == ''
 
-    headers, response = run('GET', '/test', tmp_put)
+    with open(os.path.join(tmp_copy, 'other'), 'rb') as copied:
+        assert copied.read() == test_string
 
-    # check response
-    assert response[0] == 200
-    assert response[1].read() == b''
+    # check no temporary files are left
+    assert sorted(os.listdir(tmp_copy)) == ['copied', 'other', 'test', 'testdir']
 
 
-def test_put_too_large(tmp_put):
-    # check response
-    request_headers = web.HTTPHeaders()
-    request_headers.set('Content-Length', str(file.max_file_size + 1))
+def test_copy_no_overwrite(tmp_copy):
     with pytest.raises(web.HTTPError) as error:
-        headers, response = run('PUT', '/test', tmp_put, headers=request_headers, body='', modify=True)
+        run('COPY', '/test', tmp_copy, headers=destination_headers('/other', Overwrite='F'), modify=True)
 
-    assert error.value.code == 413
+    assert error.value.code == 412
 
+    with open(os.path.join(tmp_copy, 'other'), 'rb') as other:
+        assert other.read() == b''
 
-def test_put_chunked(tmp_put):
-    request_headers = web.HTTPHeaders()
-    request_headers.set('Transfer-Encoding', 'chunked')
-    headers, response = run('PUT', '/test', tmp_put, headers=request_headers, body=test_chunked, modify=True)
+
+def test_copy_dir(tmp_copy):
+    headers, response = run('COPY', '/testdir/', tmp_copy, headers=destination_headers('/copydir/'), modify=True)
 
     # check response
-    assert response[0] == 204
-    assert response[1] == ''
+    assert response[0] == 201
 
-    headers, response = run('GET', '/test', tmp_put)
+    assert sorted(os.listdir(os.path.join(tmp_copy, 'copydir'))) == ['magic', 'nested']
+
+    with open(os.path.join(tmp_copy, 'copydir', 'magic'), 'rb') as magic:
+        assert magic.read() == test_string
+
+    headers, response = run('COPY', '/testdir/', tmp_copy, headers=destination_headers('/shallow/', Depth='0'), modify=True)
 
     # check response
-    assert response[0] == 200
-    assert response[1].read() == test_multibyte
+    assert response[0] == 201
 
+    assert os.listdir(os.path.join(tmp_copy, 'shallow')) == []
+
+
+def test_copy_fallback(tmp_copy, monkeypatch):
+    def copy_file_range(*args):
+        raise OSError(errno.EXDEV, os.strerror(errno.EXDEV))
+
+    monkeypatch.setattr(os, 'copy_file_range', copy_file_range, raising=False)
+    monkeypatch.setattr(file, 'upload_buffer_size', 3)
+
+    headers, response = run('COPY', '/test', tmp_copy, headers=destination_headers('/copied'), modify=True)
 
-def test_put_chunked_no_body(tmp_put):
     # check response
-    request_headers = web.HTTPHeaders()
-    request_headers.set('Transfer-Encoding', 'chunked')
-    with pytest.raises(web.HTTPError) as error:
-        headers, response = run('PUT', '/test', tmp_put, headers=request_headers, body='', modify=True)
+    assert response[0] == 201
 
-    assert error.value.code == 400
+    with open(os.path.join(tmp_copy, 'copied'), 'rb') as copied:
+        assert copied.read() == test_string
 
 
-def test_put_chunked_bad_length(tmp_put):
+def test_move_file(tmp_copy):
+    headers, response = run('MOVE', '/test', tmp_copy, headers=destination_headers('/moved/test'), modify=True)
+
     # check response
-    request_headers = web.HTTPHeaders()
-    request_headers.set('Transfer-Encoding', 'chunked')
-    with pytest.raises(web.HTTPError) as error:
-        headers, response = run('PUT', '/test', tmp_put, headers=request_headers, body='g\r\n\r\n', modify=True)
+    assert response[0] == 201
 
-    assert error.value.code == 400
+    assert not os.path.exists(os.path.join(tmp_copy, 'test'))
 
+    with open(os.path.join(tmp_copy, 'moved', 'test'), 'rb') as moved:
+        assert moved.read() == test_string
+
+
+def test_move_dir_over_file(tmp_copy):
+    headers, response = run('MOVE', '/testdir/', tmp_copy, headers=destination_headers('/other'), modify=True)
 
-def test_put_chunked_no_zero(tmp_put):
     # check response
-    request_headers = web.HTTPHeaders()
-    request_headers.set('Transfer-Encoding', 'chunked')
+    assert response[0] == 204
+
+    assert not os.path.exists(os.path.join(tmp_copy, 'testdir'))
+    assert sorted(os.listdir(os.path.join(tmp_copy, 'other'))) == ['magic', 'nested']
+
+
+def test_move_invalid(tmp_copy):
+    for resource, request_headers, code in [('/test', web.HTTPHeaders(), 400), ('/test', destination_headers('/test'), 403), ('/testdir/', destination_headers('/testdir/nested/inner'), 403), ('/nonexistent', destination_headers('/moved'), 404)]:
+        with pytest.raises(web.HTTPError) as error:
+            run('MOVE', resource, tmp_copy, headers=request_headers, modify=True)
+
+        assert error.value.code == code
+
+
+def test_move_outside_remote(tmp_copy):
     with pytest.raises(web.HTTPError) as error:
-        headers, response = run('PUT', '/test', tmp_put, headers=request_headers, body='3\r\n123\r\n', modify=True)
+        run('MOVE', '/files/test', tmp_copy, remote='/files', headers=destination_headers('/elsewhere/test'), modify=True)
 
-    assert error.value.code == 400
+    assert error.value.code == 403
 
+    headers, response = run('MOVE', '/files/test', tmp_copy, remote='/files', headers=destination_headers('/files/../moved'), modify=True)
 
-def test_put_chunked_no_trailer(tmp_put):
-    # check response
-    request_headers = web.HTTPHeaders()
-    request_headers.set('Transfer-Encoding', 'chunked')
+    # check destination is kept inside local
+    assert response[0] == 201
+    assert os.path.exists(os.path.join(tmp_copy, 'moved'))
+
+
+def test_copy_nomodify(tmp_copy):
     with pytest.raises(web.HTTPError) as error:
-        headers, response = run('PUT', '/test', tmp_put, headers=request_headers, body='3\r\n123\r\n0\r\n', modify=True)
+        run('COPY', '/test', tmp_copy, headers=destination_headers('/copied'), modify=False)
 
-    assert error.value.code == 400
+    assert error.value.code == 405
 
 
-def test_put_chunked_no_separator(tmp_put):
-    # check response
-    request_headers = web.HTTPHeaders()
-    request_headers.set('Transfer-Encoding', 'chunked')
+def test_copy_confine(tmp_symlink):
+    route = file.new(tmp_symlink, modify=True, confine=True)
+    handler = list(route.values())[0]
+
     with pytest.raises(web.HTTPError) as error:
-        headers, response = run('PUT', '/test', tmp_put, headers=request_headers, body='3\r\n1230\r\n\r\n', modify=True)
+        run('COPY', '/escape', tmp_symlink, headers=destination_headers('/stolen'), handler=handler)
 
-    assert error.value.code == 400
+    assert error.value.code == 403
 
+    assert not os.path.exists(os.path.join(tmp_symlink, 'stolen'))
 
-def test_put_chunked_incomplete(tmp_put):
-    # check response
-    request_headers = web.HTTPHeaders()
-    request_headers.set('Transfer-Encoding', 'chunked')
+
+def test_copy_confine_destination(tmp_symlink, tmpdir_factory):
+    outside = tmpdir_factory.mktemp('outside_dir')
+    outside.mkdir('victim')
+    with outside.join('victim').join('keep').open('wb'):
+        pass
+
+    os.symlink(str(outside), os.path.join(tmp_symlink, 'link'))
+
+    route = file.new(tmp_symlink, modify=True, confine=True)
+    handler = list(route.values())[0]
+
+    # check directories are not made outside of local through a symlinked parent
     with pytest.raises(web.HTTPError) as error:
-        headers, response = run('PUT', '/test', tmp_put, headers=request_headers, body='3\r\n12', modify=True)
+        run('COPY', '/test', tmp_symlink, headers=destination_headers('/link/new/test'), handler=handler)
 
-    assert error.value.code == 400
+    assert error.value.code == 403
+    assert not outside.join('new').exists()
 
+    # check directories outside of local are not cleared out of the way
+    with pytest.raises(web.HTTPError) as error:
+        run('COPY', '/test', tmp_symlink, headers=destination_headers('/link/victim'), handler=handler)
 
-def test_put_chunked_too_large(tmp_put):
-    # check response
-    request_headers = web.HTTPHeaders()
-    request_headers.set('Transfer-Encoding', 'chunked')
+    assert error.value.code == 403
+    assert outside.join('victim').join('keep').exists()
+
+
+@pytest.fixture(scope='function')
+def tmp_outside(tmp_symlink, tmpdir_factory):
+    outside = tmpdir_factory.mktemp('outside_link')
+    with outside.join('victim').open('wb') as victim:
+        victim.write(test_string)
+
+    os.symlink(str(outside), os.path.join(tmp_symlink, 'link'))
+
+    return outside
+
+
+@pytest.mark.parametrize('openat2', [True, False])
+def test_modify_confine(tmp_symlink, tmp_outside, monkeypatch, openat2):
+    if not openat2:
+        monkeypatch.setattr(file, 'openat2_available', False)
+
+    route = file.new(tmp_symlink, modify=True, confine=True)
+    handler = list(route.values())[0]
+
+    # check files are not written through a symlinked parent
     with pytest.raises(web.HTTPError) as error:
-        headers, response = run('PUT', '/test', tmp_put, headers=request_headers, body='{:x}\r\n'.format(file.max_file_size + 1), modify=True)
+        run('PUT', '/link/evil', tmp_symlink, body=test_string, handler=handler)
 
-    assert error.value.code == 413
+    assert error.value.code == 403
 
+    # check ranges are not staged through a symlinked parent
+    with pytest.raises(web.HTTPError) as error:
+        run('PUT', '/link/evil', tmp_symlink, headers=range_headers('bytes 0-{}/{}'.format(len(test_string) - 1, len(test_string))), body=test_string, handler=handler)
 
-def test_put_chunked_second_too_large(tmp_put):
-    # check response
-    request_headers = web.HTTPHeaders()
-    request_headers.set('Transfer-Encoding', 'chunked')
+    assert error.value.code == 403
+
+    # check archives are not unpacked through a symlinked parent
     with pytest.raises(web.HTTPError) as error:
-        headers, response = run('PUT', '/test', tmp_put, headers=request_headers, body='{:x}\r\n'.format(file.max_file_size) + 'a' * file.max_file_size + '\r\n1\r\na\r\n0\r\n\r\n', modify=True)
+        run('PUT', '/link/site/', tmp_symlink, headers=archive_headers(), body=make_tar({'evil': test_string}), handler=handler)
 
-    assert error.value.code == 413
+    assert error.value.code == 403
 
+    # check files are not deleted through a symlinked parent
+    with pytest.raises(web.HTTPError) as error:
+        run('DELETE', '/link/victim', tmp_symlink, handler=handler)
 
-def test_put_custom_handler(tmp_put):
-    headers, response = run('PUT', '/', os.path.join(tmp_put, 'test'), body=test_string, handler=ModifyFileHandler)
+    assert error.value.code == 403
+
+    assert sorted(os.listdir(str(tmp_outside))) == ['victim']
+
+    # check the symlink itself is removed rather than what it points to
+    headers, response = run('DELETE', '/link', tmp_symlink, handler=handler)
 
-    # check response
     assert response[0] == 204
-    assert response[1] == ''
+    assert not os.path.lexists(os.path.join(tmp_symlink, 'link'))
+    assert tmp_outside.join('victim').exists()
 
-    headers, response = run('GET', '/', os.path.join(tmp_put, 'test'), handler=ModifyFileHandler)
 
-    # check response
-    assert response[0] == 200
-    assert response[1].read() == test_string
+def test_copy_dir_symlinks(tmp_copy, tmpdir_factory):
+    outside = tmpdir_factory.mktemp('outside_copy')
+    with outside.join('secret').open('wb') as secret:
+        secret.write(test_string)
 
+    os.symlink(str(outside.join('secret')), os.path.join(tmp_copy, 'testdir', 'link'))
 
-def test_put_custom_handler_nomodify(tmp_put):
-    with pytest.raises(web.HTTPError) as error:
-        headers, response = run('PUT', '/', os.path.join(tmp_put, 'test'), body=test_string, handler=FileHandler)
+    headers, response = run('COPY', '/testdir/', tmp_copy, headers=destination_headers('/copydir/'), modify=True)
 
-    assert error.value.code == 405
+    assert response[0] == 201
+
+    # check symlinks are copied as they are and contents come along
+    assert os.readlink(os.path.join(tmp_copy, 'copydir', 'link')) == str(outside.join('secret'))
+    assert os.path.isdir(os.path.join(tmp_copy, 'copydir', 'nested'))
+
+    with open(os.path.join(tmp_copy, 'copydir', 'magic'), 'rb') as magic:
+        assert magic.read() == test_string
 
 
 @pytest.fixture(scope='function')
@@ -833,6 +2172,142 @@ def test_delete_custom_handler_nomodify(tmp_delete):
     assert error.value.code == 405
 
 
+@pytest.fixture(scope='function')
+def trash(tmp_delete, monkeypatch):
+    started = []
+    monkeypatch.setattr(file, 'start_reaper', started.append)
+
+    with open(os.path.join(tmp_delete, 'testdir', 'inner'), 'wb'):
+        pass
+
+    return file.default_trash(tmp_delete), started
+
+
+def test_default_trash():
+    assert file.default_trash('/srv/www/') == '/srv/.www.trash'
+
+
+def test_delete_trash(tmp_delete, trash):
+    trash, started = trash
+
+    headers, response = run('DELETE', '/testdir', tmp_delete, handler=web.HTTPHandlerWrapper(file.ModifyPathHandler, trash=trash))
+
+    # check response
+    assert response[0] == 204
+    assert response[1] == ''
+
+    # check it was moved out of the way and handed to a reaper
+    assert not os.path.exists(os.path.join(tmp_delete, 'testdir'))
+    assert len(os.listdir(trash)) == 1
+    assert started == [trash]
+
+    assert file.reap(trash) == 2
+
+    assert os.listdir(trash) == ['.lock']
+
+
+def test_delete_trash_missing(tmp_delete, trash):
+    trash, started = trash
+
+    with pytest.raises(web.HTTPError) as error:
+        run('DELETE', '/nonexistent', tmp_delete, handler=web.HTTPHandlerWrapper(file.ModifyPathHandler, trash=trash))
+
+    assert error.value.code == 404
+
+    assert started == []
+
+
+def test_delete_trash_unusable(tmp_delete, trash):
+    trash, started = trash
+
+    # a trash that cannot be made falls back to removing straight away
+    unusable = os.path.join(tmp_delete, 'test', 'trash')
+
+    headers, response = run('DELETE', '/testdir', tmp_delete, handler=web.HTTPHandlerWrapper(file.ModifyPathHandler, trash=unusable))
+
+    # check response
+    assert response[0] == 204
+
+    assert not os.path.exists(os.path.join(tmp_delete, 'testdir'))
+    assert started == []
+
+
+def test_delete_trash_progress(tmp_delete, trash):
+    trash, started = trash
+
+    handler = web.HTTPHandlerWrapper(file.ModifyPathHandler, trash=trash, trash_progress=True)
+
+    headers, response = run('DELETE', '/testdir/', tmp_delete, handler=handler)
+
+    # check response
+    assert response[0] == 202
+
+    location = headers.get('Location')
+    assert location.startswith('/?deleting=')
+
+    headers, response = run('GET', '/', tmp_delete, handler=handler, groups={'path': '/', 'query': location[1:]})
+
+    # check response
+    assert response[0] == 200
+    assert headers.get('Content-Type') == 'application/json'
+    assert json.loads(response[1]) == {'removed': 0, 'done': False}
+
+    file.reap(trash)
+
+    headers, response = run('GET', '/', tmp_delete, handler=handler, groups={'path': '/', 'query': location[1:]})
+
+    # check response
+    assert json.loads(response[1]) == {'removed': 0, 'done': True}
+
+    with pytest.raises(web.HTTPError) as error:
+        run('GET', '/', tmp_delete, handler=handler, groups={'path': '/', 'query': '?deleting=../test'})
+
+    assert error.value.code == 400
+
+
+def test_reap_entry(tmpdir_factory, monkeypatch):
+    monkeypatch.setattr(file, 'reaper_batch', 2)
+    monkeypatch.setattr(file, 'reaper_pause', 0)
+
+    progress = []
+    save_progress = file.save_progress
+    monkeypatch.setattr(file, 'save_progress', lambda trash, name, removed: progress.append(removed) or save_progress(trash, name, removed))
+
+    outside = tmpdir_factory.mktemp('outside')
+    with outside.join('keep').open('wb'):
+        pass
+
+    trash = tmpdir_factory.mktemp('trash')
+    entry = trash.mkdir('0123456789abcdef')
+    entry.mkdir('a').mkdir('b')
+    with entry.join('a', 'b', 'c').open('wb'):
+        pass
+    os.symlink(str(outside), str(entry.join('link')))
+
+    assert file.reap_entry(str(trash), '0123456789abcdef') == 5
+
+    # check progress was recorded in batches and symlinks were not followed
+    assert progress == [2, 4]
+    assert os.listdir(str(trash)) == []
+    assert os.listdir(str(outside)) == ['keep']
+
+
+def test_start_reaper(tmpdir):
+    trash = tmpdir.mkdir('trash')
+    trash.mkdir('0123456789abcdef').mkdir('nested')
+    with trash.join('fedcba9876543210').open('wb'):
+        pass
+
+    process = file.start_reaper(str(trash))
+
+    # check a running reaper is reused
+    assert file.start_reaper(str(trash)) is process or not process.is_alive()
+
+    process.join(30)
+
+    assert os.listdir(str(trash)) == ['.lock']
+
+
 def test_normpath():
     assert file.normpath('/A/B/C/') == '/A/B/C/'
 
@@ -891,3 +2366,29 @@ def test_normpath_many_double_dots_no_root():
 
 def test_normpath_all_fixes():
     assert file.normpath('/A/./B//C/../../D') == '/A/D'
+
+
+def test_normpath_single_dot():
+    assert file.normpath('.') == '/'
+
+
+def test_normpath_double_slash_only():
+    assert file.normpath('//') == '/'
+
+
+def test_normpath_dotfiles():
+    assert file.normpath('/.A/..B/.../C.') == '/.A/..B/.../C.'
+
+
+def test_normpath_leading_dots():
+    assert file.normpath('./A/../../B') == 'B'
+
+
+def test_resolve():
+    file.resolve.cache_clear()
+
+    assert file.resolve('/A/t%C3%ABst/../B') == ('/A/tëst/../B', '/A/B')
+    assert file.resolve('/A/t%C3%ABst/../B') == ('/A/tëst/../B', '/A/B')
+
+    assert file.resolve.cache_info().hits == 1
+    assert file.quote('/A/tëst') == '/A/t%C3%ABst'
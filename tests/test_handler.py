@@ -196,6 +196,11 @@ def test_error_handler():
     assert response[1] == web.status_messages[test_error.code]
     assert response[2] == str(test_error.code) + ' - ' + web.status_messages[test_error.code] + '\n'
 
+    # check the body is reused
+    headers, again = run('GET', handler=web.HTTPErrorHandler, handler_args={'error': web.HTTPError(102)})
+
+    assert again[2] is response[2]
+
 
 def test_error_handler_status():
     test_error = web.HTTPError(102, status_message=test_status)
@@ -206,6 +211,9 @@ def test_error_handler_status():
     assert response[1] == test_status
     assert response[2] == str(test_error.code) + ' - ' + test_status + '\n'
 
+    # check a custom status message is not kept
+    assert all(test_status not in body for body in web.error_bodies.values())
+
 
 def test_error_handler_message():
     test_error = web.HTTPError(102, test_message)
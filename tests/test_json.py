@@ -34,6 +34,57 @@ class JSONEmptyHandler(wjson.JSONHandler):
         return 204, None
 
 
+class JSONStreamHandler(wjson.JSONHandler):
+    json_stream_length = 2
+
+    def do_get(self):
+        return 200, [test_object] * 3
+
+
+class JSONIterHandler(wjson.JSONHandler):
+    def do_get(self):
+        return 200, (item for item in [test_object, 1, 'a'])
+
+
+class JSONLinesHandler(wjson.JSONHandler):
+    json_lines = True
+
+    def do_get(self):
+        return 200, (item for item in [test_object, 1, 'a'])
+
+
+class JSONIterEmptyHandler(wjson.JSONHandler):
+    def do_get(self):
+        return 200, iter([])
+
+
+class JSONIterErrorHandler(wjson.JSONHandler):
+    def do_get(self):
+        def items():
+            raise web.HTTPError(403)
+            yield test_object  # pylint: disable=unreachable
+
+        return 200, items()
+
+
+class JSONSortedHandler(wjson.JSONHandler):
+    json_codec = 'json'
+    json_options = {'separators': (',', ':'), 'sort_keys': True}
+
+    def do_get(self):
+        return 200, {'b': 1, 'a': [1, 2]}
+
+
+class RecordCodec(wjson.JSONCodec):
+    def loads(self, body):
+        return {'type': str(type(body))}
+
+
+class JSONEchoHandler(wjson.JSONHandler):
+    def do_post(self):
+        return 200, self.request.body
+
+
 class JSONDecodeHandler(wjson.JSONHandler):
     def do_post(self):
         return 200, {'type': str(type(self.request.body))}
@@ -64,6 +115,98 @@ def test_json_encode():
     assert response[1] == test_string
 
 
+def test_json_stream():
+    request = mock.MockHTTPRequest(None, ('', 0), None, method='GET', handler=JSONStreamHandler)
+
+    headers, response = request.response.headers, request.handler.respond()
+
+    assert headers.get('Content-Type') == 'application/json'
+
+    assert response[0] == 200
+    assert isinstance(response[1], web.IterIO)
+    assert response[1].read() == json.dumps([test_object] * 3).encode(web.default_encoding)
+
+
+def test_json_stream_small():
+    request = mock.MockHTTPRequest(None, ('', 0), None, method='GET', handler=JSONStreamHandler)
+    request.handler.json_stream_length = 3
+
+    response = request.handler.respond()
+
+    assert response[1] == json.dumps([test_object] * 3).encode(web.default_encoding)
+
+
+def test_json_stream_error():
+    request = mock.MockHTTPRequest(None, ('', 0), None, method='GET', handler=JSONStreamHandler)
+    request.handler.do_get = lambda: (200, [test_object, object(), test_object])
+
+    # check errors in the first chunk of a streamed container still become error responses
+    with pytest.raises(TypeError):
+        request.handler.respond()
+
+
+def test_json_iter():
+    request = mock.MockHTTPRequest(None, ('', 0), None, method='GET', handler=JSONIterHandler)
+
+    headers, response = request.response.headers, request.handler.respond()
+
+    assert headers.get('Content-Type') == 'application/json'
+
+    assert response[0] == 200
+    assert response[1].read() == json.dumps([test_object, 1, 'a']).encode(web.default_encoding)
+
+
+def test_json_iter_lines():
+    request = mock.MockHTTPRequest(None, ('', 0), None, method='GET', handler=JSONLinesHandler)
+
+    headers, response = request.response.headers, request.handler.respond()
+
+    assert headers.get('Content-Type') == 'application/x-ndjson'
+
+    assert response[0] == 200
+    assert response[1].read() == ''.join(json.dumps(item) + '\n' for item in [test_object, 1, 'a']).encode(web.default_encoding)
+
+
+def test_json_iter_empty():
+    request = mock.MockHTTPRequest(None, ('', 0), None, method='GET', handler=JSONIterEmptyHandler)
+
+    response = request.handler.respond()
+
+    assert response[1] == b'[]'
+
+
+def test_json_iter_error():
+    request = mock.MockHTTPRequest(None, ('', 0), None, method='GET', handler=JSONIterErrorHandler)
+
+    # check errors before the first item still become error responses
+    with pytest.raises(web.HTTPError) as error:
+        request.handler.respond()
+
+    assert error.value.code == 403
+
+
+def test_json_iterencode_chunks():
+    body = [{'key': 'value' * 16}] * 1024
+
+    chunks = list(wjson.iterencode(body, codec=wjson.JSONCodec()))
+
+    # check the encoder pieces are gathered into chunks near the stream chunk size
+    assert b''.join(chunks) == json.dumps(body).encode(web.default_encoding)
+    assert len(chunks) > 1
+    assert all(web.stream_chunk_size <= len(chunk) < 2 * web.stream_chunk_size for chunk in chunks[:-1])
+
+
+def test_json_iterencode_batches():
+    codec = wjson.get_codec('json', sort_keys=True)
+
+    # check batches of items come out the same as encoding all at once
+    for body in [[], {}, tuple(range(4096)), {str(idx): [idx] * 8 for idx in range(4096)}, {2: 'b', 1: 'a'}]:
+        chunks = list(wjson.iterencode(body, codec=codec))
+
+        assert b''.join(chunks) == json.dumps(body, sort_keys=True).encode(web.default_encoding)
+        assert all(len(chunk) < 2 * web.stream_chunk_size for chunk in chunks)
+
+
 def test_json_noencode():
     request = mock.MockHTTPRequest(None, ('', 0), None, method='GET', handler=JSONEmptyHandler)
 
@@ -100,6 +243,23 @@ def test_json_nodecode():
     assert response[1] == json.dumps({'type': str(bytes)}).encode(web.default_encoding)
 
 
+def test_json_decode_bytes():
+    wjson.register_codec('record', RecordCodec)
+
+    try:
+        json_headers = web.HTTPHeaders()
+        json_headers.set('Content-Type', 'application/json')
+
+        request = mock.MockHTTPRequest(None, ('', 0), None, headers=json_headers, body=test_string, method='POST', handler=JSONEchoHandler, handler_args={'json_codec': 'record'})
+
+        response = request.handler.respond()
+
+        # check the request body goes to the codec as bytes without decoding it first
+        assert json.loads(response[1]) == {'type': str(bytes)}
+    finally:
+        del wjson.codecs['record']
+
+
 def test_json_bad_decode():
     json_headers = web.HTTPHeaders()
     json_headers.set('Content-Type', 'application/json')
@@ -116,6 +276,68 @@ def test_json_new_error():
     assert wjson.new_error() == {'[0-9]{3}': wjson.JSONErrorHandler}
 
 
+def test_json_new_error_codec():
+    handler = wjson.new_error(json_codec='json', json_options={'separators': (',', ':')})['[0-9]{3}']
+
+    assert isinstance(handler, web.HTTPHandlerWrapper)
+    assert handler.kwargs == {'json_codec': 'json', 'json_options': {'separators': (',', ':')}}
+
+
+def test_json_codec_options():
+    request = mock.MockHTTPRequest(None, ('', 0), None, method='GET', handler=JSONSortedHandler)
+
+    response = request.handler.respond()
+
+    assert response[1] == b'{"a":[1,2],"b":1}'
+
+    # check handlers with the same options share one compiled codec
+    assert request.handler.codec is wjson.get_codec('json', sort_keys=True, separators=(',', ':'))
+
+
+def test_json_codec_wrapper():
+    request = mock.MockHTTPRequest(None, ('', 0), None, method='GET', handler=web.HTTPHandlerWrapper(JSONHandler, json_codec='json', json_options={'sort_keys': True}))
+
+    response = request.handler.respond()
+
+    assert response[1] == json.dumps(test_object, sort_keys=True).encode(web.default_encoding)
+
+
+def test_json_codec_default_hook():
+    codec = wjson.get_codec('json', default=repr)
+
+    assert codec.dumps({'set': {1}}) == json.dumps({'set': '{1}'}).encode(web.default_encoding)
+
+
+def test_json_codec_list_options():
+    codec = wjson.get_codec('json', separators=[',', ':'])
+
+    # check list options are compiled once like the equivalent tuple
+    assert codec is wjson.get_codec('json', separators=(',', ':'))
+    assert codec.dumps({'a': [1, 2]}) == b'{"a":[1,2]}'
+
+
+def test_json_codec_missing():
+    with pytest.raises(KeyError):
+        wjson.get_codec('nonexistent')
+
+
+@pytest.mark.skipif(wjson.orjson is None, reason='orjson is not installed')
+def test_json_orjson():
+    codec = wjson.get_codec('orjson', sort_keys=True)
+
+    # check orjson has to be asked for
+    assert wjson.default_codec == 'json'
+
+    # check the output is compact and keys are handled like stdlib json
+    assert codec.dumps({'b': 1, 2: [1, 2]}) == b'{"2":[1,2],"b":1}'
+    assert codec.loads(b'{"a": [1, 2]}') == {'a': [1, 2]}
+
+    assert b''.join(wjson.iterencode(iter([{'a': 1}, 2]), codec=codec)) == b'[{"a":1},2]'
+
+    with pytest.raises(ValueError):
+        wjson.get_codec('orjson', separators=(', ', ': '))
+
+
 def test_json_error():
     request = mock.MockHTTPRequest(None, ('', 0), None, handler=JSONErrorHandler)
 
@@ -124,7 +346,13 @@ def test_json_error():
     assert headers.get('Content-Type') == 'application/json'
 
     assert response[0] == 500
-    assert response[2] == json.dumps({'error': 500, 'status': web.status_messages[500]}).encode(web.http_encoding)
+    assert response[2] == json.dumps({'error': 500, 'status': web.status_messages[500]}).encode(web.default_encoding)
+
+    # check the encoded body is reused
+    request = mock.MockHTTPRequest(None, ('', 0), None, handler=JSONErrorHandler)
+
+    assert request.handler.respond()[2] is response[2]
+    assert request.response.headers.get('Content-Type') == 'application/json'
 
 
 def test_json_error_message():
@@ -136,4 +364,35 @@ def test_json_error_message():
 
     assert response[0] == 500
     assert response[1] == 'a'
-    assert response[2] == test_string
+    assert response[2] == json.dumps(test_object).encode(web.default_encoding)
+
+
+def test_json_error_status():
+    class JSONErrorStatusHandler(wjson.JSONErrorHandler):
+        def respond(self):
+            self.error = web.HTTPError(500, status_message='a')
+
+            return super().respond()
+
+    wjson.error_bodies.clear()
+
+    request = mock.MockHTTPRequest(None, ('', 0), None, handler=JSONErrorStatusHandler)
+
+    response = request.handler.respond()
+
+    # check a custom status message is used but not kept
+    assert response[1] == 'a'
+    assert response[2] == json.dumps({'error': 500, 'status': 'a'}).encode(web.default_encoding)
+    assert wjson.error_bodies == {}
+
+
+@pytest.mark.skipif(wjson.orjson is None, reason='orjson is not installed')
+def test_json_orjson_chunks():
+    codec = wjson.get_codec('orjson', sort_keys=True)
+
+    for body in [[{'key': 'value' * 16}] * 1024, {str(idx): 'value' * 16 for idx in range(1024)}, {10: 1, 2: 2, 'a': 3}]:
+        chunks = list(wjson.iterencode(body, codec=codec))
+
+        # check containers are encoded an item at a time but match encoding all at once
+        assert b''.join(chunks) == codec.dumps(body)
+        assert len(chunks) > 1 or len(body) < 1024
@@ -0,0 +1,183 @@
+import gzip
+import hashlib
+import os
+
+from fooster.web import web, pack
+
+
+import mock
+
+import pytest
+
+
+test_string = b'packed test message'
+test_large = b'compress me please ' * 64
+
+
+def run(method, resource, packfile, headers=None, remote='', index_files=None, dir_index=False):
+    handler = list(pack.new(packfile, remote, index_files=index_files, dir_index=dir_index).values())[0]
+
+    request = mock.MockHTTPRequest(None, ('', 0), None, headers=headers, method=method, resource=resource, groups={'path': resource[len(remote):]}, handler=handler)
+
+    return request.response.headers, request.handler.respond()
+
+
+@pytest.fixture(scope='function')
+def tmp_pack(tmpdir):
+    root = tmpdir.mkdir('root')
+    with root.join('test').open('wb') as file:
+        file.write(test_string)
+    with root.join('large.txt').open('wb') as file:
+        file.write(test_large)
+    testdir = root.mkdir('testdir')
+    with testdir.join('magic').open('wb'):
+        pass
+    indexdir = root.mkdir('indexdir')
+    with indexdir.join('index.html').open('wb') as file:
+        file.write(test_string)
+
+    packfile = str(tmpdir.join('root.pack'))
+
+    assert pack.build(str(root), packfile) == 4
+
+    return packfile
+
+
+def test_pack_load(tmp_pack):
+    loaded = pack.load(tmp_pack)
+
+    assert len(loaded) == 4
+    assert '/test' in loaded
+    assert '/testdir/magic' in loaded
+
+    assert sorted(loaded.dirs['/']) == ['indexdir/', 'large.txt', 'test', 'testdir/']
+    assert loaded.dirs['/testdir/'] == ['magic']
+
+    # check pack is reused
+    assert pack.load(tmp_pack) is loaded
+
+
+def test_pack_bad_magic(tmpdir):
+    packfile = str(tmpdir.join('bad.pack'))
+    with open(packfile, 'wb') as file:
+        file.write(b'\x00' * 64)
+
+    with pytest.raises(ValueError):
+        pack.Pack(packfile)
+
+
+def test_pack_get(tmp_pack):
+    headers, response = run('GET', '/test', tmp_pack)
+
+    # check headers
+    assert int(headers.get('Content-Length')) == len(test_string)
+    assert headers.get('ETag') == '"' + hashlib.sha256(test_string).hexdigest() + '"'
+    assert headers.get('Content-Encoding') is None
+
+    # check response
+    assert response[0] == 200
+    assert bytes(response[1].read()) == test_string
+
+
+def test_pack_get_range(tmp_pack):
+    request_headers = web.HTTPHeaders()
+    request_headers.set('Range', 'bytes=2-6')
+    headers, response = run('GET', '/test', tmp_pack, headers=request_headers)
+
+    # check headers
+    assert headers.get('Content-Range') == 'bytes 2-6/' + str(len(test_string))
+
+    # check response
+    assert response[0] == 206
+    assert bytes(response[1].read(5)) == test_string[2:7]
+
+
+def test_pack_get_gzip(tmp_pack):
+    headers, response = run('GET', '/large.txt', tmp_pack)
+
+    # check headers
+    assert headers.get('Content-Type') == 'text/plain'
+    assert headers.get('Vary') == 'Accept-Encoding'
+    assert headers.get('Content-Encoding') is None
+
+    # check response
+    assert bytes(response[1].read()) == test_large
+
+    request_headers = web.HTTPHeaders()
+    request_headers.set('Accept-Encoding', 'deflate, gzip;q=0.5')
+    headers, response = run('GET', '/large.txt', tmp_pack, headers=request_headers)
+
+    # check headers
+    assert headers.get('Content-Encoding') == 'gzip'
+    assert int(headers.get('Content-Length')) < len(test_large)
+
+    # check response
+    assert gzip.decompress(bytes(response[1].read())) == test_large
+
+    request_headers = web.HTTPHeaders()
+    request_headers.set('Accept-Encoding', 'gzip;q=0')
+    headers, response = run('GET', '/large.txt', tmp_pack, headers=request_headers)
+
+    # check headers
+    assert headers.get('Content-Encoding') is None
+
+
+def test_pack_get_notfound(tmp_pack):
+    with pytest.raises(web.HTTPError) as error:
+        run('GET', '/nonexistent', tmp_pack)
+
+    assert error.value.code == 404
+
+    with pytest.raises(web.HTTPError) as error:
+        run('GET', '/test', tmp_pack + '.nonexistent')
+
+    assert error.value.code == 404
+
+
+def test_pack_get_dir(tmp_pack):
+    headers, response = run('GET', '/testdir', tmp_pack)
+
+    # check headers
+    assert headers.get('Location') == '/testdir/'
+
+    # check response
+    assert response[0] == 307
+
+    with pytest.raises(web.HTTPError) as error:
+        run('GET', '/testdir/', tmp_pack)
+
+    assert error.value.code == 403
+
+    headers, response = run('GET', '/testdir/', tmp_pack, dir_index=True)
+
+    # check response
+    assert response[0] == 200
+    assert response[1] == 'magic\n'
+
+
+def test_pack_get_index_file(tmp_pack):
+    headers, response = run('GET', '/indexdir/', tmp_pack, dir_index=True)
+
+    # check headers
+    assert headers.get('Content-Type') == 'text/html'
+
+    # check response
+    assert response[0] == 200
+    assert bytes(response[1].read()) == test_string
+
+
+def test_pack_swap(tmp_pack, tmpdir):
+    loaded = pack.load(tmp_pack)
+
+    other = tmpdir.mkdir('other')
+    with other.join('test').open('wb') as file:
+        file.write(test_large)
+
+    pack.build(str(other), tmp_pack, compress=False)
+
+    headers, response = run('GET', '/test', tmp_pack)
+
+    # check response
+    assert bytes(response[1].read()) == test_large
+    assert pack.load(tmp_pack) is not loaded
+    assert not os.path.exists(tmp_pack + '.tmp')
@@ -1,4 +1,8 @@
+import os
+import time
+
 from fooster.web import web, page
+import fooster.web.file
 
 
 import mock
@@ -25,6 +29,14 @@ class PageFormatHandler(page.PageHandler):
         return test_string.format(test_fill)
 
 
+class PageAssetHandler(page.PageHandler):
+    directory = ''
+    page = 'asset.html'
+
+    def format(self, page):
+        return page.format(style=self.asset('/style.css'), missing=self.asset('/missing.css'))
+
+
 class PageErrorHandler(page.PageErrorHandler):
     directory = ''
 
@@ -80,6 +92,29 @@ def test_page_format(tmp):
     assert response[1] == test_string.format(test_fill)
 
 
+def test_page_asset(tmp):
+    static = os.path.join(tmp, 'static')
+    os.mkdir(static)
+    with open(os.path.join(static, 'style.css'), 'w') as file:
+        file.write(test_fill)
+
+    with open(os.path.join(tmp, 'asset.html'), 'w') as file:
+        file.write('{style} {missing}')
+
+    manifest = fooster.web.file.build_manifest(static, '/static')
+
+    request = mock.MockHTTPRequest(None, ('', 0), None, method='GET', handler=PageAssetHandler)
+
+    request.handler.directory = tmp
+    request.handler.manifest = manifest
+
+    headers, response = request.response.headers, request.handler.respond()
+
+    assert response[0] == 200
+    assert response[1] == manifest.url('/style.css') + ' /missing.css'
+    assert response[1].startswith('/static/style.')
+
+
 def test_page_new_error():
     assert page.new_error() == {'[0-9]{3}': page.PageErrorHandler}
 
@@ -109,3 +144,82 @@ def test_page_error_message(tmp):
     assert response[0] == 500
     assert response[1] == 'a'
     assert response[2] == test_fill
+
+
+def test_page_cache(tmp, monkeypatch):
+    monkeypatch.setattr(page, 'template_check_interval', 0)
+
+    request = mock.MockHTTPRequest(None, ('', 0), None, method='GET', handler=PageHandler)
+    request.handler.directory = tmp
+
+    assert request.handler.respond()[1] == test_string
+
+    template = page.load_template(tmp, 'test.html')
+
+    # check the template is reused while the file is unchanged
+    assert page.load_template(tmp, 'test.html') is template
+
+    with open(os.path.join(tmp, 'test.html'), 'w') as file:
+        file.write(test_fill)
+
+    os.utime(os.path.join(tmp, 'test.html'), (time.time() + 10, time.time() + 10))
+
+    assert request.handler.respond()[1] == test_fill
+    assert page.load_template(tmp, 'test.html') is not template
+
+
+def test_page_cache_interval(tmp, monkeypatch):
+    monkeypatch.setattr(page, 'template_check_interval', 60)
+
+    template = page.load_template(tmp, 'test.html')
+
+    # check the file is not even looked at within the interval
+    os.remove(os.path.join(tmp, 'test.html'))
+
+    assert page.load_template(tmp, 'test.html') is template
+
+
+def test_page_error_rendered(tmp):
+    request = mock.MockHTTPRequest(None, ('', 0), None, handler=PageErrorHandler)
+    request.handler.directory = tmp
+
+    response = request.handler.respond()
+
+    request = mock.MockHTTPRequest(None, ('', 0), None, handler=PageErrorHandler)
+    request.handler.directory = tmp
+
+    # check the rendered page is looked up rather than formatted again
+    assert request.handler.respond()[2] is response[2]
+    assert page.load_template(tmp, 'error.html').rendered[(500, 'Internal Server Error')] is response[2]
+
+
+def test_page_error_custom_format(tmp):
+    class PageErrorFormatHandler(PageErrorHandler):
+        def format(self, page):
+            return page.replace('{message}', test_fill)
+
+    request = mock.MockHTTPRequest(None, ('', 0), None, handler=PageErrorFormatHandler)
+    request.handler.directory = tmp
+
+    response = request.handler.respond()
+
+    # check overridden formatting is still used and gets the page text
+    assert response[2] == test_fill
+    assert page.load_template(tmp, 'error.html').rendered == {}
+
+
+def test_page_error_status_message(tmp):
+    class PageErrorStatusHandler(PageErrorHandler):
+        def respond(self):
+            self.error = web.HTTPError(500, status_message='<b>')
+
+            return super(PageErrorHandler, self).respond()
+
+    request = mock.MockHTTPRequest(None, ('', 0), None, handler=PageErrorStatusHandler)
+    request.handler.directory = tmp
+
+    response = request.handler.respond()
+
+    # check a custom status message is escaped but not kept
+    assert response[2] == '500 - &lt;b&gt;'
+    assert page.load_template(tmp, 'error.html').rendered == {}
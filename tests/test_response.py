@@ -65,6 +65,11 @@ class IOHandler(web.HTTPHandler):
         return 200, io.BytesIO(test_message)
 
 
+class IterHandler(web.HTTPHandler):
+    def respond(self):
+        return 200, web.IterIO(iter([test_message[:4], test_string[4:]]))
+
+
 class LengthIOHandler(web.HTTPHandler):
     def respond(self):
         self.response.headers.set('Content-Length', '2')
@@ -304,6 +309,27 @@ def test_error_handler():
     assert body == b''
 
 
+def test_error_table():
+    server = mock.MockHTTPServer(error_routes=collections.OrderedDict([('4[0-9]{2}', HeaderErrorHandler), ('404', HeaderErrorRaiseHandler)]))
+
+    # check the first matching route wins for every standard status
+    assert server.error_table[400] is HeaderErrorHandler
+    assert server.error_table[404] is HeaderErrorHandler
+    assert server.error_table[500] is web.HTTPErrorHandler
+    assert set(server.error_table) == set(web.status_messages)
+
+
+def test_error_handler_nonstandard():
+    server = mock.MockHTTPServer(error_routes={'5[0-9]{2}': HeaderErrorHandler})
+
+    response, response_line, headers, body = run(web.DummyHandler, {'error': web.HTTPError(599, status_message='Custom')}, server=server)
+
+    # check codes outside the table still go through the routes
+    assert response_line == 'HTTP/1.1 402 Payment Required'.encode(web.http_encoding)
+
+    assert headers.get('Test') == 'True'
+
+
 def test_error_handler_error():
     server = mock.MockHTTPServer(error_routes={'500': HeaderErrorRaiseHandler})
 
@@ -328,6 +354,15 @@ def test_response_io():
     assert body == ('{:x}'.format(len(test_message)) + '\r\n').encode(web.http_encoding) + test_message + '\r\n'.encode(web.http_encoding) + '0\r\n\r\n'.encode(web.http_encoding)
 
 
+def test_response_iter():
+    response, response_line, headers, body = run(IterHandler)
+
+    assert headers.get('Transfer-Encoding') == 'chunked'
+
+    # check small pieces are joined into one chunk
+    assert body == ('{:x}'.format(len(test_message)) + '\r\n').encode(web.http_encoding) + test_message + '\r\n'.encode(web.http_encoding) + '0\r\n\r\n'.encode(web.http_encoding)
+
+
 def test_response_io_length():
     response, response_line, headers, body = run(LengthIOHandler)
 
@@ -0,0 +1,280 @@
+import os
+import shutil
+import stat
+import time
+
+from fooster.web import search
+
+
+import pytest
+
+
+@pytest.fixture(scope='function')
+def tmp(tmpdir):
+    tmpdir.mkdir('a').mkdir('b')
+    tmpdir.mkdir('a-b')
+
+    for path in ['a/Foo.txt', 'a/b/foobar', 'a/b/zz', 'a-b/xfoo', 'top']:
+        with tmpdir.join(path).open('w'):
+            pass
+
+    dirs = {}
+    search.scan(dirs, str(tmpdir), '/')
+
+    index_file = str(tmpdir) + '.index'
+    search.build(index_file, dirs)
+
+    return {'dir': str(tmpdir), 'dirs': dirs, 'index': index_file}
+
+
+def test_scan(tmp):
+    assert sorted(tmp['dirs']) == ['/', '/a-b/', '/a/', '/a/b/']
+    assert tmp['dirs']['/a/'][1] == [('Foo.txt', False, 0), ('b', True, 0)]
+
+    # check nothing changed
+    assert not search.scan(tmp['dirs'], tmp['dir'], '/')
+
+
+def test_scan_changes(tmp):
+    os.mkdir(os.path.join(tmp['dir'], 'new'))
+    shutil.rmtree(os.path.join(tmp['dir'], 'a'))
+
+    assert search.scan(tmp['dirs'], tmp['dir'], '/')
+
+    # check removed directories are forgotten and new ones are walked
+    assert sorted(tmp['dirs']) == ['/', '/a-b/', '/new/']
+
+
+def test_scan_symlink(tmp):
+    os.symlink(os.path.join(tmp['dir'], 'a'), os.path.join(tmp['dir'], 'link'))
+
+    search.scan(tmp['dirs'], tmp['dir'], '/')
+
+    # check symlinked directories are not followed
+    assert ('link', False) in [(name, is_dir) for name, is_dir, _usage in tmp['dirs']['/'][1]]
+    assert '/link/' not in tmp['dirs']
+
+
+def du(path):
+    return sum(os.lstat(os.path.join(dirpath, filename)).st_blocks * 512 for dirpath, _dirnames, filenames in os.walk(path) for filename in filenames)
+
+
+def test_update_totals(tmp):
+    with open(os.path.join(tmp['dir'], 'a', 'b', 'zz'), 'wb') as file:
+        file.write(b'z' * 65536)
+
+    with open(os.path.join(tmp['dir'], 'top'), 'wb') as file:
+        file.write(b't' * 4096)
+
+    dirs = {}
+    search.update_totals(dirs, search.scan(dirs, tmp['dir'], '/'))
+
+    assert dirs['/'][2] == du(tmp['dir'])
+    assert dirs['/a/'][2] == du(os.path.join(tmp['dir'], 'a'))
+    assert dirs['/a/b/'][2] == du(os.path.join(tmp['dir'], 'a', 'b')) > 0
+
+    # check changes deep down only recompute the way up
+    os.mkdir(os.path.join(tmp['dir'], 'a', 'b', 'c'))
+    with open(os.path.join(tmp['dir'], 'a', 'b', 'c', 'new'), 'wb') as file:
+        file.write(b'n' * 8192)
+
+    assert search.update_totals(dirs, search.scan(dirs, tmp['dir'], '/a/b/')) == 4
+
+    assert dirs['/'][2] == du(tmp['dir'])
+    assert dirs['/a/b/c/'][2] == du(os.path.join(tmp['dir'], 'a', 'b', 'c')) > 0
+
+    # check removals
+    shutil.rmtree(os.path.join(tmp['dir'], 'a', 'b'))
+
+    search.update_totals(dirs, search.scan(dirs, tmp['dir'], '/a/'))
+
+    assert dirs['/'][2] == du(tmp['dir'])
+    assert dirs['/a/'][2] == 0
+
+
+def test_sizes(tmp):
+    with open(os.path.join(tmp['dir'], 'a', 'b', 'zz'), 'wb') as file:
+        file.write(b'z' * 65536)
+
+    dirs = {}
+    search.update_totals(dirs, search.scan(dirs, tmp['dir'], '/'))
+    search.build(tmp['index'], dirs)
+
+    sizes = search.load(tmp['index']).sizes()
+
+    assert sizes == {'/a/': dirs['/a/'][2], '/a/b/': dirs['/a/b/'][2], '/a-b/': 0}
+    assert sizes['/a/'] == du(os.path.join(tmp['dir'], 'a')) > 0
+
+    # check the lookup table is only made once
+    assert search.load(tmp['index']).sizes() is sizes
+
+
+def test_load(tmp):
+    index = search.load(tmp['index'])
+
+    assert len(index) == 8
+    assert search.load(tmp['index']) is index
+
+    # check reload after the index is rebuilt
+    with open(os.path.join(tmp['dir'], 'new'), 'w'):
+        pass
+
+    search.scan(tmp['dirs'], tmp['dir'], '/')
+    search.build(tmp['index'], tmp['dirs'])
+
+    assert len(search.load(tmp['index'])) == 9
+
+
+def test_load_missing(tmpdir):
+    assert search.load(str(tmpdir.join('nonexistent'))) is None
+
+
+def test_load_bad(tmpdir):
+    with tmpdir.join('bad').open('wb') as file:
+        file.write(b'\x00' * 64)
+
+    with pytest.raises(ValueError):
+        search.load(str(tmpdir.join('bad')))
+
+
+def test_search_substring(tmp):
+    index = search.load(tmp['index'])
+
+    assert index.search('foo') == ['/a-b/xfoo', '/a/Foo.txt', '/a/b/foobar']
+    assert index.search('oo.t') == ['/a/Foo.txt']
+    assert index.search('nothing') == []
+
+
+def test_search_prefix(tmp):
+    index = search.load(tmp['index'])
+
+    assert index.search('FOO', prefix_match=True) == ['/a/Foo.txt', '/a/b/foobar']
+    assert index.search('x', prefix_match=True) == ['/a-b/xfoo']
+    assert index.search('zzz', prefix_match=True) == []
+
+
+def test_search_subtree(tmp):
+    index = search.load(tmp['index'])
+
+    assert index.search('foo', '/a/') == ['/a/Foo.txt', '/a/b/foobar']
+    assert index.search('foo', '/a-b/', prefix_match=True) == []
+
+    # check the directory itself is left out
+    assert index.search('b', '/a/') == ['/a/b/', '/a/b/foobar']
+    assert index.search('b', '/a/b/') == ['/a/b/foobar']
+
+
+def test_search_limit(tmp):
+    index = search.load(tmp['index'])
+
+    assert index.search('', limit=2) == ['/a-b/', '/a-b/xfoo']
+    assert index.search('foo', prefix_match=True, limit=1) == ['/a/Foo.txt']
+
+
+def test_search_empty(tmpdir):
+    index_file = str(tmpdir) + '.index'
+    search.build(index_file, {'/': (0, [], 0)})
+
+    assert search.load(index_file).search('foo') == []
+
+
+def test_default_index_file(tmpdir):
+    index_file = search.default_index_file(str(tmpdir))
+
+    assert not index_file.startswith(str(tmpdir))
+    assert index_file == search.default_index_file(str(tmpdir) + '/')
+
+
+def test_private_dir(tmpdir, monkeypatch):
+    monkeypatch.setattr(search.tempfile, 'gettempdir', lambda: str(tmpdir))
+
+    dirname = search.private_dir()
+
+    # check only the owner can get in
+    assert os.path.dirname(dirname) == str(tmpdir)
+    assert stat.S_IMODE(os.stat(dirname).st_mode) == 0o700
+    assert search.private_dir() == dirname
+
+    # check a directory someone else could have made is not trusted
+    os.chmod(dirname, 0o777)
+
+    other = search.private_dir()
+
+    assert other != dirname
+    assert stat.S_IMODE(os.stat(other).st_mode) == 0o700
+
+
+def test_private_dir_symlink(tmpdir, monkeypatch):
+    monkeypatch.setattr(search.tempfile, 'gettempdir', lambda: str(tmpdir))
+
+    planted = tmpdir.mkdir('planted')
+    os.symlink(str(planted), str(tmpdir.join('fooster-search-' + str(os.getuid()))))
+
+    # check a planted symlink is not followed
+    assert os.path.realpath(search.private_dir()) != str(planted)
+
+
+def test_open_lock_symlink(tmpdir):
+    target = tmpdir.join('target')
+    with target.open('w'):
+        pass
+
+    os.symlink(str(target), str(tmpdir.join('index.lock')))
+
+    # check a planted lock cannot be used to write elsewhere
+    with pytest.raises(OSError):
+        search.open_lock(str(tmpdir.join('index')))
+
+
+def test_build_no_leftovers(tmp):
+    # check the temporary file is renamed into place
+    assert sorted(name for name in os.listdir(os.path.dirname(tmp['index'])) if name.startswith(os.path.basename(tmp['index']))) == [os.path.basename(tmp['index'])]
+
+
+def test_search_outside(tmpdir):
+    index_file = str(tmpdir) + '.index'
+    search.build(index_file, {'/': (0, [('..', True, 0), ('ok', False, 0)], 0), '/../': (0, [('passwd', False, 0)], 0)})
+
+    # check paths leading outside of the prefix are left out
+    assert search.load(index_file).search('') == ['/ok']
+
+
+def test_start_indexer(tmpdir):
+    local = tmpdir.mkdir('local')
+    with local.join('test').open('w'):
+        pass
+
+    index_file = str(tmpdir.join('index'))
+
+    process = search.start_indexer(str(local), index_file)
+
+    try:
+        # check a running indexer is reused
+        assert search.start_indexer(str(local), index_file) is process
+
+        for _ in range(100):
+            index = search.load(index_file)
+            if index is not None:
+                break
+
+            time.sleep(0.1)
+
+        assert index.search('test') == ['/test']
+
+        # check changes are picked up
+        local.mkdir('new')
+        with local.join('new').join('test').open('w'):
+            pass
+
+        for _ in range(100):
+            if search.load(index_file).search('test') == ['/new/test', '/test']:
+                break
+
+            time.sleep(0.1)
+
+        assert search.load(index_file).search('test') == ['/new/test', '/test']
+    finally:
+        process.terminate()
+        process.join()
+
+    search.indexers.clear()
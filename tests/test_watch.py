@@ -0,0 +1,109 @@
+import errno
+import os
+
+from fooster.web import watch
+
+
+import pytest
+
+
+pytestmark = pytest.mark.skipif(not watch.inotify_available, reason='inotify not available')
+
+
+@pytest.fixture(scope='function')
+def watcher(tmpdir):
+    tmpdir.mkdir('testdir')
+
+    events = []
+
+    with watch.Watcher([str(tmpdir)]) as watcher:
+        watcher.subscribe(events.append)
+        watcher.events = events
+
+        yield watcher
+
+
+def test_watch_create(tmpdir, watcher):
+    assert watcher.covers(str(tmpdir))
+    assert watcher.covers(str(tmpdir.join('testdir')) + '/')
+
+    with tmpdir.join('test').open('w'):
+        pass
+
+    assert watcher.check() > 0
+    assert str(tmpdir.join('test')) in watcher.events
+
+
+def test_watch_nested(tmpdir, watcher):
+    with tmpdir.join('testdir').join('magic').open('w'):
+        pass
+
+    watcher.check()
+
+    assert str(tmpdir.join('testdir').join('magic')) in watcher.events
+
+
+def test_watch_new_dir(tmpdir, watcher):
+    newdir = tmpdir.mkdir('newdir')
+
+    watcher.check()
+
+    assert str(newdir) in watcher.events
+    assert watcher.covers(str(newdir))
+
+    with newdir.join('test').open('w'):
+        pass
+
+    watcher.check()
+
+    assert str(newdir.join('test')) in watcher.events
+
+
+def test_watch_move_dir(tmpdir, watcher):
+    os.rename(str(tmpdir.join('testdir')), str(tmpdir.join('moved')))
+
+    watcher.check()
+
+    assert str(tmpdir.join('testdir')) in watcher.events
+    assert str(tmpdir.join('moved')) in watcher.events
+    assert not watcher.covers(str(tmpdir.join('testdir')))
+    assert watcher.covers(str(tmpdir.join('moved')))
+
+
+def test_watch_delete_dir(tmpdir, watcher):
+    tmpdir.join('testdir').remove()
+
+    watcher.check()
+
+    assert str(tmpdir.join('testdir')) in watcher.events
+    assert not watcher.covers(str(tmpdir.join('testdir')))
+
+
+def test_watch_no_events(watcher):
+    assert watcher.check() == 0
+    assert watcher.events == []
+
+
+def test_watch_exhausted(tmpdir, monkeypatch):
+    def exhausted(fd, path, mask):
+        watch.ctypes.set_errno(errno.ENOSPC)
+        return -1
+
+    monkeypatch.setattr(watch, 'inotify_add_watch', exhausted)
+
+    with watch.Watcher([str(tmpdir)], ttl=60) as watcher:
+        assert watcher.exhausted
+        assert not watcher.covers(str(tmpdir))
+
+        # check ttl fallback
+        assert watcher.fresh(str(tmpdir), watch.time.time())
+        assert not watcher.fresh(str(tmpdir), watch.time.time() - 120)
+
+
+def test_watch_closed(tmpdir):
+    watcher = watch.Watcher([str(tmpdir)])
+    watcher.close()
+
+    assert watcher.fileno() is None
+    assert not watcher.covers(str(tmpdir))
+    assert watcher.check() == 0
@@ -19,3 +19,60 @@ def test_mklog_http():
 
     assert http_log is logging.getLogger('http')
     assert any(any(isinstance(filter, web.HTTPLogFilter) for filter in handler.filters) and isinstance(handler.formatter, web.HTTPLogFormatter) for handler in http_log.handlers)
+
+
+def test_iter_io():
+    closed = []
+
+    def generate():
+        try:
+            yield b'abc'
+            yield 'def'
+            yield memoryview(b'ghi')
+        finally:
+            closed.append(True)
+
+    stream = web.IterIO(generate())
+
+    assert stream.read(2) == b'ab'
+    assert stream.read(4) == b'cdef'
+    assert stream.read() == b'ghi'
+    assert stream.read(1) == b''
+
+    stream.close()
+
+    assert closed == [True]
+
+
+def test_iter_io_flush():
+    def generate():
+        yield b'abc'
+        yield b''
+        yield b''
+        yield b'def'
+
+    stream = web.IterIO(generate())
+
+    assert stream.read(8) == b'abc'
+    assert stream.read(8) == b'def'
+    assert stream.read(8) == b''
+
+
+def test_iter_io_close_early():
+    closed = []
+
+    def generate():
+        try:
+            yield b'abc'
+            yield b'def'
+        finally:
+            closed.append(True)
+
+    stream = web.IterIO(generate())
+
+    assert stream.read(1) == b'a'
+
+    stream.close()
+
+    # check the generator was stopped
+    assert closed == [True]